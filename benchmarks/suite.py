@@ -0,0 +1,391 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+"""
+Performance benchmark suite of the main computational paths
+(response, dispersion, soil and sitedb), with sweeps over the number
+of layers, frequencies, models and calculation depths.
+
+Each case is run in a separate process, recording the best wall time
+over a number of repetitions and the peak memory increase. Results are
+written to a json file, and can be compared against a stored baseline:
+cases slower (or larger) than the baseline by more than the given
+relative thresholds are reported as regressions (exit status 1).
+
+Usage:
+
+    python benchmarks/suite.py -o results.json
+    python benchmarks/suite.py -o new.json -b results.json -t 0.2 -m 0.5
+    python benchmarks/suite.py --quick -k shtf
+"""
+
+import sys
+import json
+import time
+import platform
+import argparse
+import itertools
+import multiprocessing as mp
+import numpy as np
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from openquake.srtk import sitedb
+from openquake.srtk import soil
+from openquake.srtk import response
+from openquake.srtk import randomise
+from openquake.srtk import dispersion
+
+
+# =============================================================================
+# Sweeps of the benchmark cases (full and quick)
+
+SWEEPS = {'shtf': {'layers': [5, 20, 50], 'freqs': [100, 1000]},
+          'psv': {'models': [1, 100], 'layers': [5, 20], 'freqs': [1000]},
+          'dispersion': {'models': [1, 20], 'layers': [10, 50],
+                         'freqs': [50], 'wave': ['rayleigh', 'love']},
+          'hv': {'models': [1, 20], 'layers': [10, 50], 'freqs': [50]},
+          'qwl': {'layers': [5, 20, 50], 'freqs': [100, 1000]},
+          'qwl_amp': {'references': [1, 50], 'models': [100, 1000],
+                      'freqs': [200]},
+          'vsz': {'layers': [5, 50], 'depths': [1, 10, 100]},
+          'add_layer': {'layers': [10, 100, 1000]},
+          'site_shtf': {'models': [100, 1000], 'layers': [10],
+                        'freqs': [200]},
+          'site_stat': {'models': [1000, 10000], 'freqs': [1000]}}
+
+QUICK = {'shtf': {'layers': [5], 'freqs': [100]},
+         'psv': {'models': [10], 'layers': [5], 'freqs': [100]},
+         'dispersion': {'models': [2], 'layers': [5], 'freqs': [20],
+                        'wave': ['rayleigh']},
+         'hv': {'models': [2], 'layers': [5], 'freqs': [20]},
+         'qwl': {'layers': [5], 'freqs': [100]},
+         'qwl_amp': {'references': [5], 'models': [20], 'freqs': [50]},
+         'vsz': {'layers': [5], 'depths': [1, 10]},
+         'add_layer': {'layers': [10]},
+         'site_shtf': {'models': [20], 'layers': [5], 'freqs': [50]},
+         'site_stat': {'models': [100], 'freqs': [100]}}
+
+
+# =============================================================================
+# Test profiles
+
+def profile(lnum):
+
+    return {'hl': np.append(np.full(lnum - 1, 10.), 0.),
+            'vp': np.linspace(400., 3000., lnum),
+            'vs': np.linspace(200., 1500., lnum),
+            'dn': np.linspace(1800., 2500., lnum),
+            'qp': np.full(lnum, 50.),
+            'qs': np.full(lnum, 20.)}
+
+
+def build_site(models, layers, freqs):
+
+    site = sitedb.Site1D()
+    site.frequency_axis(0.1, 20., freqs)
+    site.add_model_array(randomise.toro_randomisation(profile(layers),
+                                                      models, seed=0))
+
+    return site
+
+
+# =============================================================================
+# Benchmark cases: return a function to be timed
+
+def case_shtf(layers, freqs):
+
+    geo = profile(layers)
+    freq = response.frequency_axis(0.1, 20., freqs)
+
+    return lambda: response.sh_transfer_function(freq, geo['hl'], geo['vs'],
+                                                 geo['dn'], geo['qs'])
+
+
+def case_psv(models, layers, freqs):
+
+    geo = profile(layers)
+    freq = response.frequency_axis(0.1, 20., freqs)
+    geo = dict((k, np.tile(v, (models, 1))) for k, v in geo.items())
+
+    return lambda: response.psv_transfer_function_array(
+        freq, geo['hl'], geo['vp'], geo['vs'], geo['dn'], geo['qp'],
+        geo['qs'], 0.3)
+
+
+def case_dispersion(models, layers, freqs, wave):
+
+    geo = profile(layers)
+    freq = response.frequency_axis(0.5, 20., freqs)
+    geo = randomise.toro_randomisation(geo, models, seed=0)
+
+    return lambda: dispersion.dispersion_curve_array(
+        freq, geo['hl'], geo['vp'], geo['vs'], geo['dn'], wave)
+
+
+def case_hv(models, layers, freqs):
+
+    geo = profile(layers)
+    freq = response.frequency_axis(0.5, 20., freqs)
+    geo = randomise.toro_randomisation(geo, models, seed=0)
+
+    return lambda: dispersion.ellipticity_array(
+        freq, geo['hl'], geo['vp'], geo['vs'], geo['dn'])
+
+
+def case_qwl(layers, freqs):
+
+    geo = profile(layers)
+    freq = response.frequency_axis(0.1, 20., freqs)
+
+    return lambda: soil.quarter_wavelength_average(geo['hl'], geo['vs'],
+                                                   geo['dn'], freq)
+
+
+def case_qwl_amp(references, models, freqs):
+
+    site = sitedb.Site1D()
+    site.frequency_axis(0.1, 20., freqs)
+    site.model = sitedb.Ensemble.from_arrays(
+        {k: np.tile(v, (models, 1)) for k, v in profile(5).items()})
+
+    rnd = np.random.RandomState(0)
+    for key, value in [('vs', 400.), ('dn', 2000.)]:
+        site.model.set_array(('eng', 'qwl', key),
+                             value*np.exp(rnd.normal(0., 0.2, (models, freqs))))
+
+    vs_ref = np.linspace(800., 3000., references)
+
+    return lambda: site.quarter_wavelength_amplification_array(vs_ref, 2500.)
+
+
+def case_vsz(layers, depths):
+
+    geo = profile(layers)
+    depth = list(np.linspace(5., 100., depths))
+
+    def func():
+        for z in depth:
+            soil.traveltime_velocity(geo['hl'], geo['vs'], z)
+
+    return func
+
+
+def case_add_layer(layers):
+
+    def func():
+        mod = sitedb.Model()
+        for _ in range(layers):
+            mod.add_layer([10., 800., 400., 1900., 40., 20.])
+
+    return func
+
+
+def case_site_shtf(models, layers, freqs):
+
+    site = build_site(models, layers, freqs)
+
+    return site.sh_transfer_function
+
+
+def case_site_stat(models, freqs):
+
+    site = sitedb.Site1D()
+    site.model = sitedb.Ensemble.from_arrays(
+        {k: np.tile(v, (models, 1)) for k, v in profile(3).items()})
+    rnd = np.random.RandomState(0)
+    site.model.set_array(('amp', 'shtf'),
+                         np.exp(rnd.normal(0., 0.3, (models, freqs))))
+
+    return lambda: site._update_stat(('amp', 'shtf'))
+
+
+CASES = {'shtf': case_shtf,
+         'psv': case_psv,
+         'dispersion': case_dispersion,
+         'hv': case_hv,
+         'qwl': case_qwl,
+         'qwl_amp': case_qwl_amp,
+         'vsz': case_vsz,
+         'add_layer': case_add_layer,
+         'site_shtf': case_site_shtf,
+         'site_stat': case_site_stat}
+
+
+# =============================================================================
+
+def expand(sweeps, pattern=None):
+    """
+    List of (case id, case name, parameters) from the sweeps
+    """
+
+    cases = []
+
+    for name in sorted(sweeps):
+        keys = sorted(sweeps[name])
+        for values in itertools.product(*[sweeps[name][k] for k in keys]):
+            params = dict(zip(keys, values))
+            case_id = name + ':' + ','.join(
+                '{0}={1}'.format(k, params[k]) for k in keys)
+            if pattern is None or pattern in case_id:
+                cases.append((case_id, name, params))
+
+    return cases
+
+
+def run_case(task):
+    """
+    Run a benchmark case (in a separate process): best wall time
+    over the repetitions and peak memory increase (in MB), measured
+    by tracemalloc if available or from the peak resident size.
+    """
+
+    name, params, repeat = task
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+    elif resource is not None:
+        rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    func = CASES[name](**params)
+
+    best = np.inf
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        best = min(best, time.time() - start)
+
+    if tracemalloc is not None:
+        memory = tracemalloc.get_traced_memory()[1]/1024.**2
+        tracemalloc.stop()
+    elif resource is not None:
+        rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        memory = (rss1 - rss0)/1024.
+    else:
+        memory = None
+
+    return {'time': best, 'memory': memory, 'params': params}
+
+
+def run_suite(sweeps, repeat=3, pattern=None, stream=sys.stdout):
+    """
+    Run all the benchmark cases, each in a new process
+    """
+
+    results = {}
+
+    for case_id, name, params in expand(sweeps, pattern):
+        pool = mp.Pool(1)
+        results[case_id] = pool.apply(run_case, ((name, params, repeat),))
+        pool.close()
+        pool.join()
+
+        stream.write('{0:45s} {1:10.5f} s {2:10.2f} MB\n'.format(
+            case_id, results[case_id]['time'],
+            results[case_id]['memory'] or 0.))
+        stream.flush()
+
+    return {'meta': {'python': platform.python_version(),
+                     'numpy': np.__version__,
+                     'platform': platform.platform(),
+                     'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     'repeat': repeat},
+            'results': results}
+
+
+def compare(results, baseline, threshold=0.2, mem_threshold=0.5):
+    """
+    Compare results against a baseline; return the list of the
+    regressions as (case id, quantity, baseline, new value).
+    Cases missing from the baseline are ignored.
+    """
+
+    regressions = []
+
+    for case_id, new in sorted(results['results'].items()):
+        old = baseline['results'].get(case_id)
+        if old is None:
+            continue
+
+        if new['time'] > old['time']*(1. + threshold):
+            regressions.append((case_id, 'time', old['time'], new['time']))
+
+        if (new['memory'] is not None and old['memory'] is not None and
+                new['memory'] > max(old['memory'], 1.)*(1. + mem_threshold)):
+            regressions.append((case_id, 'memory', old['memory'],
+                                new['memory']))
+
+    return regressions
+
+
+# =============================================================================
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='OQ-SRTK benchmark suite')
+    parser.add_argument('-o', '--output', help='results file (json)')
+    parser.add_argument('-b', '--baseline', help='baseline file (json)')
+    parser.add_argument('-t', '--threshold', type=float, default=0.2,
+                        help='relative time regression threshold')
+    parser.add_argument('-m', '--mem-threshold', type=float, default=0.5,
+                        help='relative memory regression threshold')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='repetitions of each case')
+    parser.add_argument('-k', '--pattern', help='run matching cases only')
+    parser.add_argument('--quick', action='store_true',
+                        help='reduced sweeps (smoke test)')
+    args = parser.parse_args(argv)
+
+    results = run_suite(QUICK if args.quick else SWEEPS,
+                        args.repeat, args.pattern)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+        regressions = compare(results, baseline, args.threshold,
+                              args.mem_threshold)
+
+        for case_id, key, old, new in regressions:
+            print('REGRESSION {0} {1}: {2:.5g} -> {3:.5g}'.format(
+                case_id, key, old, new))
+
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+"""
+Benchmark of the transport overhead of model ensembles to worker
+processes: plain pickling of the Model objects (as done by a
+multiprocessing pool) against shared memory-mapped arrays.
+
+Usage:
+
+    python benchmarks/transport.py [models] [layers] [frequencies]
+"""
+
+import sys
+import time
+import pickle
+import multiprocessing as mp
+import numpy as np
+
+from openquake.srtk import sitedb
+from openquake.srtk import parallel
+from openquake.srtk import randomise
+
+
+# =============================================================================
+
+def build_site(mnum, lnum, fnum):
+
+    geo = {'hl': np.append(np.full(lnum - 1, 10.), 0.),
+           'vp': np.linspace(400., 3000., lnum),
+           'vs': np.linspace(200., 1500., lnum),
+           'dn': np.linspace(1800., 2500., lnum),
+           'qp': np.full(lnum, 50.),
+           'qs': np.full(lnum, 20.)}
+
+    site = sitedb.Site1D()
+    site.frequency_axis(0.1, 20., fnum)
+    site.add_model_array(randomise.toro_randomisation(geo, mnum, seed=0))
+
+    return site
+
+
+def _identity(geo, shape):
+    return np.zeros(shape)
+
+
+def _echo(model):
+    return model
+
+
+def timeit(func, repeat=3):
+
+    best = np.inf
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        best = min(best, time.time() - start)
+
+    return best
+
+
+# =============================================================================
+
+def main(mnum=2000, lnum=20, fnum=1000):
+
+    site = build_site(mnum, lnum, fnum)
+    models = site.model.to_models()
+
+    # Models with a result of the size of a spectrum
+    for mod in models:
+        mod.amp['shtf'] = np.zeros(fnum)
+
+    results = {}
+
+    # Serialisation only
+    results['pickle models'] = timeit(lambda: pickle.loads(
+        pickle.dumps(models, pickle.HIGHEST_PROTOCOL)))
+
+    shared = parallel.share_ensemble(site.model)
+    results['pickle descriptors'] = timeit(lambda: pickle.loads(
+        pickle.dumps(shared, pickle.HIGHEST_PROTOCOL)))
+    for value in shared['geo'].values():
+        value.unlink()
+    shared['lnum'].unlink()
+
+    # Round trip to a pool of workers (pool creation included)
+    def pool_models():
+        pool = mp.Pool(4)
+        pool.map(_echo, models, max(1, mnum//16))
+        pool.close()
+        pool.join()
+
+    results['pool models'] = timeit(pool_models)
+
+    results['pool shared'] = timeit(
+        lambda: parallel.ensemble_map(site.model, _identity, (fnum,),
+                                      args=((fnum,),), processes=4))
+
+    print('models={0} layers={1} frequencies={2}'.format(mnum, lnum, fnum))
+    for key in sorted(results):
+        print('{0:20s} {1:10.4f} s'.format(key, results[key]))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
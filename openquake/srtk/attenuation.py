@@ -0,0 +1,243 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+"""
+Anelastic attenuation models of the wave solvers: complex velocities
+from the layer's velocities and quality factors, evaluated at once
+over the whole frequency axis.
+
+A model provides complex_velocity(freq, vs, qs) and its derivatives
+with respect to vs and qs (derivatives). Frequency-independent models
+(dependent = False) return arrays with the shape of the velocities,
+the others add a trailing frequency axis. Custom models can be
+defined by subclassing QModel.
+"""
+
+import numpy as _np
+
+
+# =============================================================================
+
+class QModel(object):
+    """
+    Base class of the attenuation models. Models are compared
+    by type and parameters.
+    """
+
+    # Frequency-dependent complex velocities
+    dependent = True
+
+    def complex_velocity(self, freq, vs, qs):
+        """
+        Compute the complex velocities.
+
+        :param numpy.array freq:
+            array of frequencies in Hz
+
+        :param numpy.array vs:
+            array of velocities in m/s (at the reference frequency,
+            for dispersive models)
+
+        :param numpy.array qs:
+            array of quality factors (at the reference frequency,
+            for frequency-dependent models)
+
+        :return numpy.array vel:
+            complex velocities (velocities x frequencies, if
+            frequency-dependent)
+        """
+
+        raise NotImplementedError
+
+    def derivatives(self, freq, vs, qs):
+        """
+        Compute the derivatives of the complex velocities with respect
+        to the velocities and the quality factors (same arguments and
+        shape as complex_velocity).
+
+        :return numpy.array d_vs:
+            derivatives with respect to the velocities
+
+        :return numpy.array d_qs:
+            derivatives with respect to the quality factors
+        """
+
+        raise NotImplementedError
+
+    def __eq__(self, other):
+
+        return type(self) is type(other) and vars(self) == vars(other)
+
+    def __ne__(self, other):
+
+        return not self == other
+
+    def __repr__(self):
+
+        return '{0}({1})'.format(type(self).__name__, ', '.join(
+            '{0}={1!r}'.format(*item) for item in sorted(vars(self).items())))
+
+
+class ConstantQ(QModel):
+    """
+    Frequency-independent (and non-dispersive) quality factor, the
+    default of the solvers: v*2iQ/(2iQ-1) at all frequencies.
+    """
+
+    dependent = False
+
+    def complex_velocity(self, freq, vs, qs):
+
+        vs = _np.array(vs, dtype='complex128')
+        qs = _np.array(qs, dtype='complex128')
+        vs *= ((2.*qs*1j)/(2.*qs*1j-1.))
+
+        return vs
+
+    def derivatives(self, freq, vs, qs):
+
+        qs = _np.array(qs, dtype='complex128')
+        den = 2.*qs*1j - 1.
+
+        return (2.*qs*1j)/den, _np.real(vs)*(-2j)/(den**2.)
+
+
+class PowerLawQ(QModel):
+    """
+    Frequency-dependent quality factor Q(f) = Q0*(f/fref)^alpha,
+    with Q0 the quality factor of the layer and no velocity
+    dispersion (non-causal).
+
+    :param float alpha:
+        exponent of the frequency dependence
+
+    :param float fref:
+        reference frequency in Hz (default 1 Hz)
+    """
+
+    def __init__(self, alpha=0., fref=1.):
+
+        self.alpha = float(alpha)
+        self.fref = float(fref)
+
+    def quality(self, freq, qs):
+        """
+        Compute the frequency-dependent quality factors.
+
+        :param numpy.array freq:
+            array of frequencies in Hz
+
+        :param numpy.array qs:
+            array of quality factors at the reference frequency
+
+        :return numpy.array qf:
+            quality factors (values x frequencies)
+        """
+
+        ratio = _np.array(freq, dtype='float64', ndmin=1)/self.fref
+        qs = _np.array(qs, dtype='float64')
+
+        return qs[..., None]*(ratio**self.alpha)
+
+    def dispersion(self, freq, qs):
+        """
+        Velocity dispersion, as the ratio of the velocity at the
+        reference frequency and the velocity at each frequency,
+        and its derivative with respect to the quality factor
+        (none for this model).
+
+        :return numpy.array ratio:
+            velocity ratio (values x frequencies)
+
+        :return numpy.array d_qs:
+            derivative with respect to the quality factor
+        """
+
+        shape = _np.shape(qs) + (_np.size(freq),)
+
+        return _np.ones(shape), _np.zeros(shape)
+
+    def complex_velocity(self, freq, vs, qs):
+
+        qf = self.quality(freq, qs)
+        ratio = self.dispersion(freq, qs)[0]
+        vs = _np.array(vs, dtype='float64')[..., None]/ratio
+
+        return vs*((2.*qf*1j)/(2.*qf*1j-1.))
+
+    def derivatives(self, freq, vs, qs):
+
+        qf = self.quality(freq, qs)
+        ratio, d_ratio = self.dispersion(freq, qs)
+        vs = _np.array(vs, dtype='float64')[..., None]
+        qs = _np.array(qs, dtype='float64')[..., None]
+
+        den = 2.*qf*1j - 1.
+        fac = (2.*qf*1j)/den
+
+        d_vs = fac/ratio
+        d_qs = (vs*(-2j)/(den**2.)*(qf/qs)/ratio -
+                vs*fac*d_ratio/(ratio**2.))
+
+        return d_vs, d_qs
+
+
+class CausalQ(PowerLawQ):
+    """
+    Causal attenuation: quality factor Q(f) = Q0*(f/fref)^alpha with
+    the velocity dispersion of the Kramers-Kronig relations (nearly
+    local approximation), so that the layer's velocity is the phase
+    velocity at the reference frequency:
+
+        1/v(f) = 1/v0*[1 + cot(pi*alpha/2)/2*(1/Q(f) - 1/Q0)]
+
+    which reduces to 1/v(f) = 1/v0*[1 - ln(f/fref)/(pi*Q0)] for
+    constant Q (alpha = 0).
+
+    :param float alpha:
+        exponent of the frequency dependence (-1 < alpha < 1)
+
+    :param float fref:
+        reference frequency in Hz (default 1 Hz)
+    """
+
+    def __init__(self, alpha=0., fref=1.):
+
+        if not -1. < alpha < 1.:
+            raise ValueError('Exponent must be between -1 and 1')
+
+        PowerLawQ.__init__(self, alpha, fref)
+
+    def dispersion(self, freq, qs):
+
+        ratio = _np.array(freq, dtype='float64', ndmin=1)/self.fref
+        qs = _np.array(qs, dtype='float64')[..., None]
+
+        if self.alpha == 0.:
+            term = -_np.log(ratio)/_np.pi
+        else:
+            term = ((ratio**(-self.alpha) - 1.) /
+                    (2.*_np.tan(_np.pi*self.alpha/2.)))
+
+        term = _np.broadcast_to(term, _np.broadcast(qs, term).shape)
+
+        return 1. + term/qs, -term/(qs**2.)
@@ -0,0 +1,529 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+"""
+Command-line batch runner for regional site response analyses.
+
+Sites are read from a directory of model files (one site per file,
+csv by default) or from a manifest file; for each site, a configured
+sequence of Site1D methods is executed and the results are written
+incrementally to an output directory, so that an interrupted run can
+be resumed.
+The manifest can be split across independent workers.
+
+Usage example:
+
+    python -m openquake.srtk.batch sites/ results/ -c config.json
+
+Manifest format (csv, one site per line, multiple model files of
+the same site separated by semicolon):
+
+    id,x,y,z,file
+    site01,10.5,45.2,0,data/site01.csv;data/site02.csv
+
+Configuration format (json):
+
+    {"frequency": [0.1, 50, 200],
+     "products": [["traveltime_velocity", {"depth": 30}],
+                  "compute_soil_class",
+                  "sh_transfer_function"],
+     "decimals": 6,
+     "instrument": false,
+     "memory_budget": 2048,
+     "memory_action": "chunk"}
+
+If a memory budget (MB) is given, the peak memory of each site is
+estimated before the calculation (see the memory module); sites
+above the budget are either refused (recorded as failed) or processed
+in chunked (streaming) mode.
+
+If instrumentation is enabled, the per-site timing and counters
+(see the instrument module) are stored in the site records, and
+their aggregate over the run is written in a per-worker file.
+"""
+
+import os as _os
+import re as _re
+import sys as _sys
+import glob as _glob
+import json as _json
+import time as _time
+import argparse as _ap
+import numpy as _np
+
+import openquake.srtk.sitedb as _sdb
+import openquake.srtk.utils as _ut
+import openquake.srtk.instrument as _ins
+import openquake.srtk.memory as _mem
+
+# =============================================================================
+# Constants & initialisation variables
+
+DEFAULT_CONFIG = {'frequency': [0.1, 50., 200],
+                  'products': [['traveltime_velocity', {'depth': 30.}],
+                               'compute_soil_class',
+                               'compute_site_kappa',
+                               'quarter_wavelength_average',
+                               'quarter_wavelength_amplification',
+                               'sh_transfer_function',
+                               'resonance_frequency'],
+                  'decimals': _sdb.DECIMALS}
+
+# Model files of a directory source (one site per file)
+MODEL_PATTERN = '*.csv'
+
+# Log of the completed and failed sites (one per worker)
+DONE_LOG = 'done.{0}.log'
+FAIL_LOG = 'failed.{0}.log'
+
+# Aggregated instrumentation report (one per worker)
+PROFILE_LOG = 'profile.{0}.json'
+
+
+# =============================================================================
+
+def read_manifest(source, delimiter=',', pattern=MODEL_PATTERN):
+    """
+    Read the list of sites to process, either from a directory
+    of model files (one site per file, sorted by name) or from
+    a manifest file. Site ids must be unique, also once converted
+    to result file names (see result_name).
+
+    :param string source:
+        directory of model files or manifest file
+
+    :param char delimiter:
+        character separator between manifest fields;
+        default value is comma
+
+    :param string pattern:
+        file name pattern of the model files in a directory
+        (default is csv files)
+
+    :return list sites:
+        list of dictionaries with site id, coordinates
+        and model files
+    """
+
+    sites = []
+
+    if _os.path.isdir(source):
+        for model_file in sorted(_glob.glob(_os.path.join(source, pattern))):
+            if _os.path.isfile(model_file):
+                name = _os.path.splitext(_os.path.basename(model_file))[0]
+                sites.append({'id': name, 'x': None, 'y': None, 'z': None,
+                              'file': [model_file]})
+        _check_ids(sites)
+        return sites
+
+    root = _os.path.dirname(_os.path.abspath(source))
+
+    with open(source, 'r') as f:
+        header = None
+        for line in f:
+            line = line.strip()
+            if not line or line[0] == '#':
+                continue
+
+            data = [d.strip() for d in line.split(delimiter)]
+            if header is None:
+                header = data
+                continue
+
+            site = dict(zip(header, data))
+            for key in ['x', 'y', 'z']:
+                site[key] = float(site[key]) if site.get(key) else None
+
+            # Relative paths refer to the manifest location
+            site['file'] = [_os.path.join(root, mf)
+                            for mf in site['file'].split(';')]
+            sites.append(site)
+
+    _check_ids(sites)
+
+    return sites
+
+
+def result_name(site_id):
+    """
+    File name (without extension) of the results of a site:
+    characters other than letters, digits, dot, dash and
+    underscore (e.g. path separators) are replaced by underscores.
+
+    :param string site_id:
+        the site id
+
+    :return string name:
+        the file name
+    """
+
+    return _re.sub(r'[^\w.-]', '_', str(site_id))
+
+
+def _check_ids(sites):
+    """
+    Internal: reject duplicate site ids (or result file names)
+    """
+
+    seen = {}
+    for site in sites:
+        name = result_name(site['id'])
+        if name in seen:
+            raise ValueError('Duplicate site id: {0} ({1})'.format(
+                site['id'], seen[name]))
+        seen[name] = site['id']
+
+
+def scan_models(model_files, comment='#'):
+    """
+    Size of a set of models from their files (default csv format),
+    without parsing the soil properties: number of models and
+    maximum number of layers (data lines after the header).
+
+    :param list model_files:
+        list of model files (one model per file)
+
+    :param char or string comment:
+        string to mark comments (which are not counted);
+        default value is the hash character
+
+    :return tuple (models, layers):
+        number of models and maximum number of layers
+    """
+
+    layers = 0
+
+    for model_file in model_files:
+        with open(model_file, 'r') as f:
+            lines = sum(1 for line in f
+                        if line.strip() and line.strip()[0] != comment)
+        layers = max(layers, lines - 1)
+
+    return len(model_files), layers
+
+
+# =============================================================================
+
+def run_site(site_info, config):
+    """
+    Build a site from its model files and run the
+    configured sequence of Site1D methods.
+
+    :param dict site_info:
+        dictionary with site id, coordinates and model files
+
+    :param dict config:
+        run configuration (frequency axis, products and
+        memory budget)
+
+    :return Site1D site:
+        the processed site
+    """
+
+    site = _sdb.Site1D(site_info['id'],
+                       site_info['x'],
+                       site_info['y'],
+                       site_info['z'])
+
+    if config.get('frequency'):
+        site.frequency_axis(*config['frequency'])
+
+    budget = config.get('memory_budget')
+
+    # Budget is checked on the size of the model files,
+    # before any model is loaded
+    if budget is not None:
+        budget *= 1024.**2
+        models, layers = scan_models(site_info['file'])
+        size = _mem.estimate(models, layers, len(site.freq),
+                             config['products'])
+        action = config.get('memory_action', 'refuse')
+
+        if not _mem.check_budget(size, budget, action):
+            chunk = _mem.chunk_size(budget, layers, len(site.freq),
+                                    config['products'])
+            site.stream_models(site_info['file'], config['products'],
+                               chunk=chunk)
+            return site
+
+    site.read_model(site_info['file'])
+
+    for product in config['products']:
+        name, kwargs = _sdb._product_args(product)
+        getattr(site, name)(**kwargs)
+
+    return site
+
+
+def site_record(site, decimals=None):
+    """
+    Convert the site header and the mean model (statistics
+    of all products) into a json-serialisable dictionary.
+
+    :param Site1D site:
+        the processed site
+
+    :param int decimals:
+        output precision of the products (None for full precision)
+
+    :return dict record:
+        the site record
+    """
+
+    eng = _ut.set_precision(site.mean.eng, decimals)
+    amp = _ut.set_precision(site.mean.amp, decimals)
+
+    record = {'head': _serialise(site.head),
+              'freq': _serialise(site.freq),
+              'models': len(site.model),
+              'mean': {'eng': _serialise(eng),
+                       'amp': _serialise(amp)}}
+
+    return record
+
+
+def _serialise(value):
+    """
+    Internal: recursive conversion to json-compatible types
+    (complex numbers are stored as [real, imag] pairs)
+    """
+
+    if isinstance(value, dict):
+        return {str(k): _serialise(v) for k, v in value.items()}
+
+    if isinstance(value, (list, tuple)):
+        return [_serialise(v) for v in value]
+
+    if isinstance(value, _np.ndarray):
+        return _serialise(value.tolist())
+
+    if isinstance(value, (complex, _np.complexfloating)):
+        return [float(value.real), float(value.imag)]
+
+    if isinstance(value, _np.generic):
+        return value.item()
+
+    return value
+
+
+# =============================================================================
+
+def run_batch(sites, config, output_dir, worker=0, workers=1,
+              resume=True, report=100, stream=_sys.stderr):
+    """
+    Process a list of sites and write the results incrementally
+    (one json file per site) into the output directory.
+    Completed sites are recorded in a per-worker log, which is used
+    to skip them when resuming an interrupted run. Sites that fail
+    are recorded in a separate log and skipped.
+
+    :param list sites:
+        list of site dictionaries (see read_manifest)
+
+    :param dict config:
+        run configuration (frequency axis, products,
+        output decimals and instrumentation switch)
+
+    :param string output_dir:
+        directory of the results store
+
+    :param int worker:
+        index of this worker (0 to workers-1); each worker processes
+        the sites with position modulo workers equal to its index
+
+    :param int workers:
+        total number of independent workers (default is one)
+
+    :param boolean resume:
+        skip sites already completed by any worker (default is True)
+
+    :param int report:
+        number of processed sites between throughput reports
+
+    :param file stream:
+        output stream of the progress report (default is stderr)
+
+    :return dict stats:
+        number of processed, skipped and failed sites,
+        elapsed time, throughput (sites/s) and aggregated
+        instrumentation report (if enabled)
+    """
+
+    if not _os.path.isdir(output_dir):
+        _os.makedirs(output_dir)
+
+    done = completed_sites(output_dir) if resume else set()
+    sites = [s for ns, s in enumerate(sites) if ns % workers == worker]
+
+    todo = [s for s in sites if str(s['id']) not in done]
+    stats = {'processed': 0, 'skipped': len(sites) - len(todo),
+             'failed': 0}
+
+    profiles = []
+
+    start = _time.time()
+
+    done_file = _os.path.join(output_dir, DONE_LOG.format(worker))
+    fail_file = _os.path.join(output_dir, FAIL_LOG.format(worker))
+
+    # Logs are closed (and flushed) also if the run is interrupted
+    with open(done_file, 'a') as done_log, open(fail_file, 'a') as fail_log:
+        for site_info in todo:
+            site_id = str(site_info['id'])
+            rec = _ins.recording() if config.get('instrument') else None
+
+            try:
+                if rec is None:
+                    site = run_site(site_info, config)
+                else:
+                    with rec:
+                        site = run_site(site_info, config)
+            except Exception as error:
+                fail_log.write('{0}\t{1}\n'.format(site_id, error))
+                fail_log.flush()
+                stats['failed'] += 1
+                continue
+
+            record = site_record(site, config.get('decimals'))
+            if rec is not None:
+                record['profile'] = rec.report
+                profiles.append(rec.report)
+
+            # Atomic write of the results, then mark as completed
+            result_file = _os.path.join(output_dir,
+                                        result_name(site_id) + '.json')
+            with open(result_file + '.tmp', 'w') as f:
+                _json.dump(record, f)
+            _os.rename(result_file + '.tmp', result_file)
+
+            done_log.write(site_id + '\n')
+            done_log.flush()
+            _os.fsync(done_log.fileno())
+
+            stats['processed'] += 1
+
+            if report and not stats['processed'] % report:
+                _report(stats, len(todo), start, stream)
+
+    if profiles:
+        stats['profile'] = _ins.merge(profiles)
+        profile_file = _os.path.join(output_dir, PROFILE_LOG.format(worker))
+        with open(profile_file, 'w') as f:
+            _json.dump(stats['profile'], f, indent=2, sort_keys=True)
+
+    _report(stats, len(todo), start, stream)
+
+    return stats
+
+
+def completed_sites(output_dir):
+    """
+    Collect the ids of the sites completed by all workers.
+
+    :param string output_dir:
+        directory of the results store
+
+    :return set done:
+        set of completed site ids
+    """
+
+    done = set()
+    pattern = _os.path.join(output_dir, DONE_LOG.format('*'))
+
+    for log_file in _glob.glob(pattern):
+        with open(log_file, 'r') as f:
+            done.update(line.strip() for line in f if line.strip())
+
+    return done
+
+
+def _report(stats, total, start, stream):
+    """
+    Internal: print the progress and the throughput
+    """
+
+    elapsed = _time.time() - start
+    stats['elapsed'] = elapsed
+    stats['throughput'] = stats['processed']/elapsed if elapsed else 0.
+
+    if stream is not None:
+        stream.write('{0}/{1} sites ({2} failed, {3} skipped), '
+                     '{4:.2f} sites/s\n'.format(stats['processed'], total,
+                                                stats['failed'],
+                                                stats['skipped'],
+                                                stats['throughput']))
+        stream.flush()
+
+
+# =============================================================================
+
+def main(argv=None):
+    """
+    Command-line entry point of the batch runner.
+    """
+
+    parser = _ap.ArgumentParser(
+        description='Batch site response analysis (OQ-SRTK)')
+    parser.add_argument('source',
+                        help='directory of model files or site manifest')
+    parser.add_argument('output',
+                        help='output directory of the results')
+    parser.add_argument('-c', '--config',
+                        help='json configuration file (frequency, products)')
+    parser.add_argument('-w', '--worker', type=int, default=0,
+                        help='index of this worker (default 0)')
+    parser.add_argument('-n', '--workers', type=int, default=1,
+                        help='total number of workers (default 1)')
+    parser.add_argument('--no-resume', action='store_true',
+                        help='reprocess sites already completed')
+    parser.add_argument('--report', type=int, default=100,
+                        help='sites between progress reports (default 100)')
+    parser.add_argument('--pattern', default=MODEL_PATTERN,
+                        help='model files of a directory source '
+                             '(default {0})'.format(MODEL_PATTERN))
+
+    args = parser.parse_args(argv)
+
+    if not 0 <= args.worker < args.workers:
+        parser.error('worker index must be between 0 and workers-1')
+
+    config = dict(DEFAULT_CONFIG)
+    if args.config:
+        with open(args.config, 'r') as f:
+            config.update(_json.load(f))
+
+    try:
+        sites = read_manifest(args.source, pattern=args.pattern)
+    except ValueError as error:
+        parser.error(str(error))
+
+    stats = run_batch(sites, config, args.output,
+                      worker=args.worker,
+                      workers=args.workers,
+                      resume=not args.no_resume,
+                      report=args.report)
+
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == '__main__':
+    _sys.exit(main())
@@ -0,0 +1,625 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+"""
+Forward modelling of surface waves in layered elastic media: phase
+velocity dispersion curves of Rayleigh and Love waves (fundamental and
+higher modes) and Rayleigh-wave ellipticity (H/V ratio).
+
+The secular functions are computed by propagating the motion-stress
+vectors from the free surface to the half-space (Aki & Richards, 1980)
+in real arithmetic; the layer propagators are evaluated in closed form
+(even and odd functions of the vertical wavenumbers), and the
+solutions are re-orthogonalised at each propagation step to preserve
+the precision at high frequency. Roots are bracketed on a grid of phase
+velocities and refined by the Illinois (regula falsi) method, all
+vectorised over models, frequencies and modes. Closely spaced higher
+modes at high frequency may require a finer grid.
+"""
+
+import numpy as _np
+
+import openquake.srtk.instrument as _ins
+
+# =============================================================================
+# Constants & initialisation variables
+
+# Default number of phase velocities for the root bracketing
+GRID = 100
+
+# Maximum number of grid values (models x frequencies x velocities)
+# evaluated at once
+CHUNK = 2**18
+
+# Lower bound of the Rayleigh phase velocity, relative
+# to the minimum shear-wave velocity of the profile
+RAYLEIGH_MIN = 0.8
+
+# Maximum contrast of growth (in nepers) of the Rayleigh-wave solutions
+# within a propagation step
+CONTRAST = 10.
+
+# Relative size of the Rayleigh-wave solutions below which
+# they are normalised separately (underflow)
+TINY = 1e-100
+
+# Wave types
+WAVES = ['rayleigh', 'love']
+
+
+# =============================================================================
+
+def dispersion_curve(freq, hl, vp, vs, dn, wave='rayleigh', modes=1,
+                     grid=GRID, tol=1e-10, maxiter=50):
+    """
+    Compute the phase velocity dispersion curves of a layered
+    soil profile.
+
+    :param numpy.array freq:
+        array of frequencies in Hz for the calculation
+
+    :param numpy.array hl:
+        array of layer's thicknesses in meters (half-space is 0.)
+
+    :param numpy.array vp:
+        array of layer's compressional-wave velocities in m/s
+
+    :param numpy.array vs:
+        array of layer's shear-wave velocities in m/s
+
+    :param numpy.array dn:
+        array of layer's densities in kg/m3
+
+    :param string wave:
+        'rayleigh' (default) or 'love'
+
+    :param int modes:
+        number of modes (default is the fundamental only)
+
+    :param int grid:
+        number of phase velocities for the root bracketing
+
+    :param float tol:
+        relative tolerance of the phase velocities
+
+    :param int maxiter:
+        maximum number of refinement iterations
+
+    :return numpy.array velocity:
+        phase velocities (frequencies x modes); nan where
+        a mode does not exist (below its cut-off frequency)
+    """
+
+    return dispersion_curve_array(freq, [hl], [vp], [vs], [dn], wave, modes,
+                                  grid, tol, maxiter)[0]
+
+
+@_ins.timed('dispersion.dispersion_curve')
+def dispersion_curve_array(freq, hl, vp, vs, dn, wave='rayleigh', modes=1,
+                           grid=GRID, tol=1e-10, maxiter=50):
+    """
+    Vectorised version of dispersion_curve for a set of profiles
+    stored as (models x layers) arrays. Profiles can have a different
+    number of layers, padded with nans (the last valid layer of each
+    profile is the half-space).
+
+    :param numpy.array freq:
+        array of frequencies in Hz for the calculation
+
+    :param numpy.array hl, vp, vs, dn:
+        arrays (models x layers) of layer's thicknesses,
+        velocities and densities
+
+    :param string wave:
+        'rayleigh' (default) or 'love'
+
+    :param int modes:
+        number of modes (default is the fundamental only)
+
+    :param int grid:
+        number of phase velocities for the root bracketing
+
+    :param float tol:
+        relative tolerance of the phase velocities
+
+    :param int maxiter:
+        maximum number of refinement iterations
+
+    :return numpy.array velocity:
+        phase velocities (models x frequencies x modes)
+    """
+
+    if wave not in WAVES:
+        raise ValueError('Unknown wave type: {0}'.format(wave))
+
+    omega = 2.*_np.pi*_np.array(freq, dtype='float64', ndmin=1)
+    geo = _profiles(hl, vp, vs, dn)
+
+    mnum = len(geo[0])
+    chunk = max(1, CHUNK//(len(omega)*grid))
+    velocity = _np.zeros((mnum, len(omega), modes))
+
+    # Missing modes (nan brackets) are propagated silently
+    with _np.errstate(invalid='ignore'):
+        for i0 in range(0, mnum, chunk):
+            block = [par[i0:i0+chunk] for par in geo]
+            velocity[i0:i0+chunk] = _roots(wave, omega, block, modes, grid,
+                                           tol, maxiter)
+
+    return velocity
+
+
+def ellipticity(freq, hl, vp, vs, dn, velocity=None, grid=GRID):
+    """
+    Compute the ellipticity (H/V ratio of the surface displacement)
+    of the fundamental mode of Rayleigh waves of a layered profile.
+
+    :param numpy.array freq:
+        array of frequencies in Hz for the calculation
+
+    :param numpy.array hl, vp, vs, dn:
+        arrays of layer's thicknesses, velocities and densities
+
+    :param numpy.array velocity:
+        phase velocities of the fundamental mode
+        (computed if not given)
+
+    :param int grid:
+        number of phase velocities for the root bracketing
+
+    :return numpy.array hv:
+        H/V ratio for each frequency
+    """
+
+    if velocity is not None:
+        velocity = [velocity]
+
+    return ellipticity_array(freq, [hl], [vp], [vs], [dn], velocity,
+                             grid)[0]
+
+
+@_ins.timed('dispersion.ellipticity')
+def ellipticity_array(freq, hl, vp, vs, dn, velocity=None, grid=GRID):
+    """
+    Vectorised version of ellipticity for a set of profiles stored
+    as (models x layers) arrays (see dispersion_curve_array).
+
+    :param numpy.array freq:
+        array of frequencies in Hz for the calculation
+
+    :param numpy.array hl, vp, vs, dn:
+        arrays (models x layers) of layer's thicknesses,
+        velocities and densities
+
+    :param numpy.array velocity:
+        phase velocities (models x frequencies) of the
+        fundamental mode (computed if not given)
+
+    :param int grid:
+        number of phase velocities for the root bracketing
+
+    :return numpy.array hv:
+        H/V ratio (models x frequencies)
+    """
+
+    if velocity is None:
+        velocity = dispersion_curve_array(freq, hl, vp, vs, dn, 'rayleigh',
+                                          1, grid)[..., 0]
+
+    omega = 2.*_np.pi*_np.array(freq, dtype='float64', ndmin=1)
+    geo = _profiles(hl, vp, vs, dn)
+
+    velocity = _np.array(velocity, dtype='float64', ndmin=2)
+    valid = _np.isfinite(velocity)
+
+    # Invalid velocities are replaced to keep the solver stable
+    cmin = RAYLEIGH_MIN*_np.min(geo[2], axis=1)
+    velocity = _np.where(valid, velocity, cmin[:, None])
+
+    ycol, rmat, vcol = _rayleigh(omega[None, :], velocity, geo, track=True)
+
+    # Null vector of the matrix of the surface solutions and the
+    # half-space eigenvectors, then back to surface displacements
+    mat = _np.stack([_np.stack(col, axis=-1) for col in ycol + vcol],
+                    axis=-1)
+    null = _np.linalg.svd(mat)[2][..., -1, :2]
+    disp = _np.linalg.solve(rmat, null[..., None])[..., 0]
+
+    hv = _np.abs(disp[..., 0]/disp[..., 1])
+
+    return _np.where(valid, hv, _np.nan)
+
+
+# =============================================================================
+
+def _profiles(hl, vp, vs, dn):
+    """
+    Internal: profiles as (models x layers) arrays, with padding layers
+    replaced by copies of the half-space (identity propagators)
+    """
+
+    hl = _np.atleast_2d(_np.asarray(hl, dtype='float64'))
+    geo = [_np.array(_np.atleast_2d(par), dtype='float64')
+           for par in [vp, vs, dn]]
+
+    valid = ~_np.isnan(geo[1])
+    last = _np.sum(valid, axis=1) - 1
+    index = _np.arange(len(last))
+
+    hl = _np.where(valid, _np.nan_to_num(hl), 0.)
+    hl[index, last] = 0.
+
+    for par in geo:
+        par[:] = _np.where(valid, par, par[index, last, None])
+
+    return [hl] + geo
+
+
+def _roots(wave, omega, geo, modes, grid, tol, maxiter):
+    """
+    Internal: roots of the secular function (models x frequencies
+    x modes), by bracketing on a velocity grid and refinement with
+    the Illinois method
+    """
+
+    vs = geo[2]
+    mnum = len(vs)
+
+    # Phase velocities of the trapped modes (below the half-space)
+    cmax = vs[:, -1]
+    vmin = _np.min(vs, axis=1)
+    cmin = vmin
+    if wave == 'rayleigh':
+        cmin = RAYLEIGH_MIN*vmin
+
+    func = _rayleigh if wave == 'rayleigh' else _love
+    omega = omega[None, :, None]
+
+    # Grid uniform in velocity (roots at low frequency) merged with
+    # a grid uniform in the vertical slowness of the slowest layer
+    # (modes accumulating at high frequency); the half-space velocity
+    # is included
+    step = _np.linspace(0., 1., grid//2 + 1)[1:]
+    slow = _vertical(cmin, vmin)
+    cgrid = _np.sort(_np.hstack([
+        cmin[:, None] + step*(cmax - cmin)[:, None],
+        _vertical(slow[:, None] + step[:-1]*(_vertical(cmax, vmin) -
+                                             slow)[:, None],
+                  vmin[:, None], inverse=True)]), axis=1)
+    grid = cgrid.shape[1]
+    cgrid = _np.broadcast_to(cgrid[:, None, :], (mnum, omega.shape[1], grid))
+
+    fgrid = func(omega, cgrid, geo)
+    _ins.count('evals', fgrid.size)
+
+    # Brackets of the first modes (sign changes along the grid)
+    change = fgrid[..., :-1]*fgrid[..., 1:] < 0.
+    number = _np.cumsum(change, axis=-1)
+
+    shape = (mnum, omega.shape[1], modes)
+    lower = _np.full(shape, _np.nan)
+    upper = _np.full(shape, _np.nan)
+    flow = _np.full(shape, _np.nan)
+    fupp = _np.full(shape, _np.nan)
+
+    # Model and frequency indices of the brackets
+    im, jf = _np.ix_(range(mnum), range(omega.shape[1]))
+
+    for mode in range(modes):
+        found = change & (number == mode + 1)
+        exist = _np.any(found, axis=-1)
+        pos = _np.argmax(found, axis=-1)
+
+        for out, arr, shift in [(lower, cgrid, 0), (upper, cgrid, 1),
+                                (flow, fgrid, 0), (fupp, fgrid, 1)]:
+            value = arr[im, jf, pos + shift]
+            out[..., mode] = _np.where(exist, value, _np.nan)
+
+    # Illinois refinement (vectorised over the brackets); the retained
+    # end point is down-weighted when kept twice in a row
+    root = (lower*fupp - upper*flow)/(fupp - flow)
+    last = _np.zeros(shape)
+
+    for _ in range(maxiter):
+        froot = func(omega, root, geo)
+        _ins.count('evals', froot.size)
+
+        side = froot*fupp > 0.
+        upper = _np.where(side, root, upper)
+        lower = _np.where(side, lower, root)
+        flow = _np.where(side, flow*_np.where(last > 0., 0.5, 1.), froot)
+        fupp = _np.where(side, froot, fupp*_np.where(last < 0., 0.5, 1.))
+        last = _np.where(side, 1., -1.)
+
+        prev = root
+        root = (lower*fupp - upper*flow)/(fupp - flow)
+        root = _np.where(flow == 0., lower, root)
+
+        if not _np.any(_np.abs(root - prev) > tol*root):
+            break
+
+    return root
+
+
+def _vertical(value, vmin, inverse=False):
+    """
+    Internal: signed vertical slowness of a phase velocity relative
+    to the shear-wave velocity vmin (or its inverse)
+    """
+
+    if inverse:
+        return 1./_np.sqrt(1./vmin**2. - _np.sign(value)*value**2.)
+
+    diff = 1./vmin**2. - 1./value**2.
+    return _np.sign(diff)*_np.sqrt(_np.abs(diff))
+
+
+def _layer(par, nl, ndim):
+    """
+    Internal: parameter of a layer, broadcastable with
+    arrays of (models x ...)
+    """
+
+    return par[:, nl].reshape((-1,) + (1,)*(ndim - 1))
+
+
+def _even_odd(t):
+    """
+    Internal: even functions cosh(sqrt(t)) and sinh(sqrt(t))/sqrt(t)
+    (cos and sinc for negative t), scaled by exp(-sqrt(t)) for positive t
+    """
+
+    r = _np.sqrt(_np.abs(t))
+    pos = t > 0.
+    small = r < 1e-4
+    rs = _np.where(small, 1., r)
+
+    scale = _np.exp(-_np.where(pos, r, 0.))
+    decay = scale**2.
+
+    even = _np.where(pos, (1. + decay)/2., _np.cos(r))
+    odd = _np.where(pos, (1. - decay)/(2.*rs), _np.sin(r)/rs)
+    odd = _np.where(small, (1. + t/6.)*scale, odd)
+
+    return even, odd
+
+
+def _divided(x, y):
+    """
+    Internal: even and odd functions of the (scaled) squared vertical
+    wavenumbers of P (x) and S (y) waves and their divided differences,
+    with common positive scaling
+    """
+
+    scale = _np.sqrt(_np.maximum(_np.maximum(x, y), 0.))
+
+    ex, ox = _even_odd(x)
+    ey, oy = _even_odd(y)
+
+    # Common scaling
+    sx = _np.exp(_np.sqrt(_np.maximum(x, 0.)) - scale)
+    sy = _np.exp(_np.sqrt(_np.maximum(y, 0.)) - scale)
+    ex, ox, ey, oy = ex*sx, ox*sx, ey*sy, oy*sy
+
+    diff = _np.where(x != y, x - y, 1.)
+    de = (ex - ey)/diff
+    do = (ox - oy)/diff
+
+    # Series expansion for small arguments
+    series = _np.maximum(_np.abs(x), _np.abs(y)) <= 1.
+    if _np.any(series):
+        xs, ys = x[series], y[series]
+        hom = _np.ones_like(xs)
+        yp = _np.ones_like(ys)
+        se = _np.zeros_like(xs)
+        so = _np.zeros_like(xs)
+        fact = 1.
+        for n in range(1, 11):
+            fact *= (2.*n - 1.)*(2.*n)
+            se += hom/fact
+            so += hom/(fact*(2.*n + 1.))
+            yp = yp*ys
+            hom = xs*hom + yp
+        weight = _np.exp(-scale[series])
+        de[series] = se*weight
+        do[series] = so*weight
+
+    return ey, oy, de, do
+
+
+def _love(omega, velocity, geo, track=False):
+    """
+    Internal: secular function of Love waves
+    """
+
+    hl, vp, vs, dn = geo
+    ndim = velocity.ndim
+
+    wnum = omega/velocity
+    mu_ref = _layer(dn*vs**2., -1, ndim)
+    ref = 1./(mu_ref*wnum)
+
+    dis = _np.ones(velocity.shape)
+    tau = _np.zeros(velocity.shape)
+
+    for nl in range(hl.shape[1] - 1):
+        h = _layer(hl, nl, ndim)
+        mu = _layer(dn*vs**2., nl, ndim)
+        b2 = wnum**2. - (omega/_layer(vs, nl, ndim))**2.
+
+        even, odd = _even_odd(b2*h**2.)
+        odd = odd*h
+
+        dis, tau = even*dis + odd*tau/mu, mu*b2*odd*dis + even*tau
+
+        norm = _np.maximum(_np.abs(dis), _np.abs(tau)*ref)
+        dis /= norm
+        tau /= norm
+
+    # Decaying solution in the half-space
+    b = _np.sqrt(_np.maximum(wnum**2. - (omega/_layer(vs, -1, ndim))**2., 0.))
+
+    return (tau + mu_ref*b*dis)*ref
+
+
+def _rayleigh(omega, velocity, geo, track=False):
+    """
+    Internal: secular function of Rayleigh waves; if track is True,
+    the surface solutions, their orthonormalisation (2x2 matrix)
+    and the half-space eigenvectors are returned instead
+    """
+
+    hl, vp, vs, dn = geo
+    ndim = velocity.ndim
+
+    wnum = omega/velocity
+    mu_ref = _layer(dn*vs**2., -1, ndim)
+    ref = 1./(mu_ref*wnum)
+
+    zero = _np.zeros(_np.broadcast(omega, velocity).shape)
+    cols = [[zero + 1., zero, zero, zero],
+            [zero, zero + 1., zero, zero]]
+    rmat = _np.zeros(zero.shape + (2, 2))
+    rmat[..., 0, 0] = 1.
+    rmat[..., 1, 1] = 1.
+
+    for nl in range(hl.shape[1] - 1):
+        h = _layer(hl, nl, ndim)
+        rho = _layer(dn, nl, ndim)
+        mu = rho*_layer(vs, nl, ndim)**2.
+        mod = rho*_layer(vp, nl, ndim)**2.
+        lam = mod - 2.*mu
+
+        # Coefficients of the system matrix
+        rw2 = rho*omega**2.
+        coef = (wnum, 1./mu, -wnum*lam/mod, 1./mod,
+                4.*mu*(lam + mu)/mod*wnum**2. - rw2, wnum*lam/mod, rw2)
+
+        a2 = wnum**2. - (omega/_layer(vp, nl, ndim))**2.
+        b2 = wnum**2. - (omega/_layer(vs, nl, ndim))**2.
+
+        # Sub-steps bounding the contrast of growth of the two
+        # solutions (precision of the subdominant one)
+        growth = _np.sqrt(_np.maximum(a2, 0.)) - _np.sqrt(_np.maximum(b2, 0.))
+        growth = _np.where(_np.isfinite(growth), growth, 0.)*h
+        steps = int(_np.ceil(_np.max(growth)/CONTRAST)) or 1
+        h = h/steps
+
+        # Propagator as polynomial of the system matrix
+        even, odd, de, do = _divided(a2*h**2., b2*h**2.)
+        c0 = even - b2*h**2.*de
+        c1 = h*(odd - b2*h**2.*do)
+        c2 = h**2.*de
+        c3 = h**3.*do
+
+        for _ in range(steps):
+            for nc in range(2):
+                ay = _system(coef, cols[nc])
+                a2y = _system(coef, ay)
+                a3y = _system(coef, a2y)
+                cols[nc] = [c0*y + c1*y1 + c2*y2 + c3*y3
+                            for y, y1, y2, y3 in zip(cols[nc], ay, a2y, a3y)]
+
+            # Orthonormalisation (positive determinant)
+            cols, rnew = _orthonormal(cols, ref)
+            if track:
+                rmat = _np.matmul(rnew, rmat)
+
+    # Decaying eigenvectors of the half-space
+    rho = _layer(dn, -1, ndim)
+    a = _np.sqrt(_np.maximum(wnum**2. - (omega/_layer(vp, -1, ndim))**2., 0.))
+    b = _np.sqrt(_np.maximum(wnum**2. - (omega/_layer(vs, -1, ndim))**2., 0.))
+
+    vcol = [[wnum, a, -2.*mu_ref*wnum*a, rho*omega**2. - 2.*mu_ref*wnum**2.],
+            [b, wnum, -mu_ref*(b**2. + wnum**2.), -2.*mu_ref*wnum*b]]
+
+    # Stresses are scaled to the order of the displacements
+    for col in cols + vcol:
+        col[2] = col[2]*ref
+        col[3] = col[3]*ref
+    for col in vcol:
+        norm = _np.sqrt(sum(v**2. for v in col))
+        col[:] = [v/norm for v in col]
+
+    if track:
+        return ([_np.broadcast_to(v, zero.shape) for v in cols[0]],
+                [_np.broadcast_to(v, zero.shape) for v in cols[1]]), \
+            rmat, ([_np.broadcast_to(v, zero.shape) for v in vcol[0]],
+                   [_np.broadcast_to(v, zero.shape) for v in vcol[1]])
+
+    # Determinant of the solutions and the decaying eigenvectors
+    # (Laplace expansion on the 2x2 minors)
+    y, v = cols, vcol
+
+    def minor(col, i, j):
+        return col[0][i]*col[1][j] - col[0][j]*col[1][i]
+
+    return (minor(y, 0, 1)*minor(v, 2, 3) - minor(y, 0, 2)*minor(v, 1, 3) +
+            minor(y, 0, 3)*minor(v, 1, 2) + minor(y, 1, 2)*minor(v, 0, 3) -
+            minor(y, 1, 3)*minor(v, 0, 2) + minor(y, 2, 3)*minor(v, 0, 1))
+
+
+def _system(coef, col):
+    """
+    Internal: product of the P-SV system matrix with a motion-stress
+    vector (horizontal and vertical displacement, shear and normal
+    stress)
+    """
+
+    k, imu, klm, imod, r3, klm3, rw2 = coef
+    y1, y2, y3, y4 = col
+
+    return [k*y2 + imu*y3,
+            klm*y1 + imod*y4,
+            r3*y1 + klm3*y4,
+            -rw2*y2 - k*y3]
+
+
+def _orthonormal(cols, ref):
+    """
+    Internal: Gram-Schmidt orthogonalisation of two motion-stress
+    vectors (stresses scaled by ref); both are scaled by the norm of
+    the first, to keep the secular function smooth around the roots,
+    unless the second would underflow. Returns the new vectors and
+    the triangular transformation matrix
+    """
+
+    weight = [1., 1., ref, ref]
+
+    def dot(u, v):
+        return sum(w*w*a*b for w, a, b in zip(weight, u, v))
+
+    r11 = _np.sqrt(dot(cols[0], cols[0]))
+    first = [v/r11 for v in cols[0]]
+
+    r12 = dot(first, cols[1])
+    second = [v - r12*u for u, v in zip(first, cols[1])]
+    r22 = _np.sqrt(dot(second, second))
+    r22 = _np.where(r22 < TINY*r11, r22, r11)
+    second = [v/r22 for v in second]
+
+    rmat = _np.zeros(r11.shape + (2, 2))
+    rmat[..., 0, 0] = r11
+    rmat[..., 0, 1] = r12
+    rmat[..., 1, 1] = r22
+
+    return [first, second], rmat
@@ -0,0 +1,177 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+"""
+Exporters of site parameters to external formats,
+such as the site model files of the OpenQuake engine.
+"""
+
+import numpy as _np
+
+import openquake.srtk.soil as _avg
+import openquake.srtk.sitedb as _sdb
+import openquake.srtk.utils as _ut
+
+# =============================================================================
+# Constants & initialisation variables
+
+# Fields of the OpenQuake engine site model (z1pt0 in m, z2pt5 in km)
+SITE_MODEL_FIELDS = ['lon', 'lat', 'vs30', 'vs30measured',
+                     'z1pt0', 'z2pt5', 'kappa0']
+
+SITE_MODEL_FORMAT = ['%.5f', '%.5f', '%.2f', '%d', '%.2f', '%.4f', '%.6f']
+
+
+# =============================================================================
+
+def site_parameters(sites, kappa_depth=[]):
+    """
+    Compute the site-model parameters of a set of sites in a single
+    vectorised pass over the soil profiles of all their models.
+    Site values are the log-normal mean of the model values for
+    Vs30, and the normal mean for Z1.0, Z2.5 (which are zero for
+    rock profiles) and kappa.
+
+    :param list sites:
+        list of Site1D objects (or a SiteCollection)
+
+    :param float kappa_depth:
+        averaging depth of kappa in meters; if not specified,
+        the last layer interface of each profile is used
+
+    :return dict param:
+        dictionary of arrays (one value per site) of the
+        site coordinates, vs30, z1pt0 (m), z2pt5 (km) and kappa0
+    """
+
+    sites = list(sites)
+
+    # Stacking the profiles of all models of all sites
+    geo = []
+    for site in sites:
+        model = site.model
+        if not isinstance(model, _sdb.Ensemble):
+            model = _sdb.Ensemble.from_models(model)
+        geo.append(model.geo)
+
+    mnum = [len(g['hl']) for g in geo]
+    lmax = max([g['hl'].shape[1] for g in geo] + [1])
+
+    stack = {}
+    for key in ['hl', 'vs', 'qs']:
+        stack[key] = _np.full((sum(mnum), lmax), _np.nan)
+        i0 = 0
+        for g, m in zip(geo, mnum):
+            stack[key][i0:i0 + m, :g[key].shape[1]] = g[key]
+            i0 += m
+
+    # Model parameters
+    vs30 = _avg.traveltime_velocity_array(stack['hl'], stack['vs'], 30.)
+    z1pt0 = _avg.depth_to_velocity(stack['hl'], stack['vs'], 1000.)
+    z2pt5 = _avg.depth_to_velocity(stack['hl'], stack['vs'], 2500.)
+    kappa = _avg.compute_site_kappa_array(stack['hl'], stack['vs'],
+                                          stack['qs'], kappa_depth)
+
+    # Site averages
+    group = _np.repeat(_np.arange(len(sites)), mnum)
+
+    param = {'lon': _np.array([s.head['x'] for s in sites], dtype='float64'),
+             'lat': _np.array([s.head['y'] for s in sites], dtype='float64'),
+             'vs30': _group_mean(vs30, group, len(sites), log=True),
+             'z1pt0': _group_mean(z1pt0, group, len(sites)),
+             'z2pt5': _group_mean(z2pt5, group, len(sites))/1e3,
+             'kappa0': _group_mean(kappa, group, len(sites))}
+
+    return param
+
+
+def _group_mean(data, group, gnum, log=False):
+    """
+    Internal: (log) mean of data by group, ignoring nans
+    """
+
+    if log:
+        with _np.errstate(divide='ignore'):
+            data = _np.log(data)
+
+    valid = _np.isfinite(data)
+    total = _np.bincount(group[valid], data[valid], minlength=gnum)
+    count = _np.bincount(group[valid], minlength=gnum)
+
+    with _np.errstate(invalid='ignore', divide='ignore'):
+        mean = total/count
+
+    return _np.exp(mean) if log else mean
+
+
+# =============================================================================
+
+def write_site_model(sites, csv_file, vs30measured=True, kappa_depth=[],
+                     chunk=10000, fill={}):
+    """
+    Write the site model file (csv) of the OpenQuake engine for a
+    (possibly very large) set of sites. Sites are consumed in chunks
+    from any iterable (e.g. a generator) and written incrementally.
+
+    :param iterable sites:
+        Site1D objects (e.g. a SiteCollection or a generator)
+
+    :param string csv_file:
+        output file name
+
+    :param boolean vs30measured:
+        flag for measured (True, default) or inferred Vs30
+
+    :param float kappa_depth:
+        averaging depth of kappa in meters (optional)
+
+    :param int chunk:
+        number of sites processed at once (default 10000)
+
+    :param dict fill:
+        replacement values for missing parameters, e.g. when the
+        velocity threshold of z1pt0 is never reached ({'z1pt0': 500.});
+        missing values are otherwise written as nan
+
+    :return int count:
+        number of sites written
+    """
+
+    count = 0
+
+    with open(csv_file, 'w') as f:
+        f.write(','.join(SITE_MODEL_FIELDS) + '\n')
+
+        for sites_chunk in _ut.chunk_iter(sites, chunk):
+            param = site_parameters(sites_chunk, kappa_depth)
+            param['vs30measured'] = _np.full(len(sites_chunk),
+                                             int(vs30measured))
+
+            for key, value in fill.items():
+                param[key][_np.isnan(param[key])] = value
+
+            data = _np.column_stack([param[k] for k in SITE_MODEL_FIELDS])
+            _np.savetxt(f, data, fmt=SITE_MODEL_FORMAT, delimiter=',')
+
+            count += len(sites_chunk)
+
+    return count
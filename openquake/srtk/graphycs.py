@@ -21,15 +21,31 @@
 #
 # =============================================================================
 """
-Plotting utilities for data visualisation
+Plotting utilities for data visualisation.
+
+Matplotlib is imported only when plotting is actually requested,
+with the backend in BACKEND (if set). Figures of many sites can be
+rendered to files in parallel with a non-interactive backend
+(see report_sites), e.g. on headless compute nodes.
 """
 
+import os as _os
+import sys as _sys
+import multiprocessing as _mp
 import numpy as _np
-import matplotlib.pyplot as _plt
+
+import openquake.srtk.sitedb as _sdb
+import openquake.srtk.utils as _ut
 
 # =============================================================================
 # Figure settings
 
+# Matplotlib backend (None for the default; e.g. 'Agg' for headless use)
+BACKEND = None
+
+# Non-interactive backend used for the figure files
+FILE_BACKEND = 'Agg'
+
 FIG_SIZE_MODEL = (4, 6)
 FIG_SIZE_RESPONSE = (8, 4)
 
@@ -41,72 +57,528 @@ MODEL_LABELS = {'hl': 'Thickness (m)',
                 'qs': 'S-wave quality factor'}
 
 RESPONSE_LABELS = {'shtf': 'SH-wave amplification',
+                   'psv_r': 'P-SV amplification (radial)',
+                   'psv_z': 'P-SV amplification (vertical)',
+                   'rayleigh': 'Rayleigh phase velocity (m/s)',
+                   'love': 'Love phase velocity (m/s)',
+                   'hv': 'H/V (Rayleigh ellipticity)',
                    'kappa': 'Attenuation',
                    'qwl': 'Qwl amplification'}
 
+FIG_SIZE_PANEL = (4, 4)
+
+# Pyplot module (imported on first use)
+_plt = None
+
 
 # =============================================================================
 
-def plot_models(site1d, key='vs', hold=False):
+def _pyplot(backend=None):
     """
+    Internal: import pyplot on first use, setting the backend
+    (if required); the backend is switched if already imported.
     """
 
-    if not hold:
-        _plt.figure(figsize=FIG_SIZE_MODEL)
+    global _plt
+
+    backend = backend or BACKEND
+
+    if _plt is None:
+        import matplotlib
+        if backend and 'matplotlib.pyplot' not in _sys.modules:
+            matplotlib.use(backend)
+        import matplotlib.pyplot
+        _plt = matplotlib.pyplot
 
-    for mod in site1d.model:
-        plot_profile(mod, key, hold=True, show=False)
+    if backend and _plt.get_backend().lower() != backend.lower():
+        _plt.switch_backend(backend)
 
-    _profile_decoration(key)
+    return _plt
 
 
 # =============================================================================
 
-def plot_profile(model, key='vs', color='r', hold=False, show=True):
+def plot_models(site1d, key='vs', hold=False, mode='lines', color='r',
+                perc=[16., 50., 84.], npts=200, show=True):
     """
+    Plot the soil profiles of all the models of a site.
+    Profiles are drawn as a single collection of lines, or summarised
+    as percentile bands or as a density map (for large ensembles).
+
+    :param Site1D site1d:
+        the site with the models to be plotted
+
+    :param string key:
+        soil property to plot (default is 'vs')
+
+    :param boolean hold:
+        if True, the current figure is used
+
+    :param string mode:
+        'lines' (default), 'bands' (percentiles) or 'density'
+
+    :param string color:
+        color of lines and bands
+
+    :param list perc:
+        percentiles (0-100) of the bands; the outermost pair is
+        shaded, the others are drawn as lines
+
+    :param int npts:
+        number of depth samples (bands and density modes)
+
+    :param boolean show:
+        if True, the figure is shown (interactive backends)
     """
 
-    K = model.geo[key]
-    H = _np.cumsum(model.geo['hl'][:-1])
+    plt = _pyplot()
+
+    if not hold:
+        plt.figure(figsize=FIG_SIZE_MODEL)
+
+    geo, lnum = _geo_arrays(site1d.model)
+    top, bot, val = step_layers(geo['hl'], geo[key], lnum)
+
+    if mode == 'lines':
+        lines = _lines(_step_vertices(top, bot, val), color)
+        plt.gca().add_collection(lines)
+        plt.gca().autoscale()
 
-    layer_num = len(K)
+    else:
+        depth = _np.linspace(0., _np.nanmax(bot), npts)
+        data = _sample_layers(top, val, depth)
+        weights = site1d.model_weights()
+
+        if mode == 'bands':
+            values = _ut.weighted_percentile(data, perc, weights)
+            plt.fill_betweenx(depth, values[0], values[-1],
+                               color=color, alpha=0.3, linewidth=0)
+            for value in values[1:-1]:
+                plt.plot(value, depth, color=color, linewidth=2)
+
+        elif mode == 'density':
+            _density_map(data, depth, weights, log=False, vertical=True)
 
-    X = []
-    Y = []
-    for nl in range(layer_num):
-        if nl == 0:
-            X += [K[0], K[0]]
-            Y += [0, H[0]]
-            X += [K[0], K[1]]
-            Y += [H[0], H[0]]
         else:
-            if nl != (layer_num - 1):
-                X += [K[nl], K[nl]]
-                Y += [H[nl-1], H[nl]]
-                X += [K[nl], K[nl+1]]
-                Y += [H[nl], H[nl]]
-            else:
-                X += [K[nl], K[nl]]
-                Y += [H[nl-1], H[nl-1]*1.4]
+            raise ValueError('Unknown plotting mode: ' + str(mode))
+
+    _profile_decoration(key, show)
+
+
+# =============================================================================
+
+def plot_profile(model, key='vs', color='r', hold=False, show=True):
+    """
+    Plot the stair-step soil profile of a single model.
+
+    :param Model model:
+        the model to be plotted
+
+    :param string key:
+        soil property to plot (default is 'vs')
+
+    :param string color:
+        line color
+
+    :param boolean hold:
+        if True, the current figure is used
+
+    :param boolean show:
+        if True, the figure is decorated and shown
+    """
+
+    top, bot, val = step_layers(model.geo['hl'], model.geo[key])
+    vert = _step_vertices(top, bot, val)[0]
+
+    plt = _pyplot()
 
     if not hold:
-        _plt.figure()
+        plt.figure()
 
-    _plt.plot(X, Y, color=color, linewidth=3)
+    plt.plot(vert[:, 0], vert[:, 1], color=color, linewidth=3)
 
     if show:
-        _profile_decoration(key)
+        _profile_decoration(key, show)
+
+
+# =============================================================================
+
+def plot_amplification(site1d, key='shtf', hold=False, mode='lines',
+                       color='r', perc=[16., 50., 84.], mean=True,
+                       show=True):
+    """
+    Plot the amplification spectra of all the models of a site
+    (absolute values for complex spectra), as a single collection
+    of lines, as percentile bands or as a density map. The mean
+    spectrum and its log-normal band (mean /* standard deviation)
+    are taken from the mean model of the site.
+
+    :param Site1D site1d:
+        the site with the models to be plotted
+
+    :param string key:
+        amplification product (e.g. 'shtf', 'qwl' or 'kappa')
+
+    :param boolean hold:
+        if True, the current figure is used
+
+    :param string mode:
+        'lines' (default), 'bands' (percentiles), 'density'
+        or None (mean model only)
+
+    :param string color:
+        color of lines and bands
+
+    :param list perc:
+        percentiles (0-100) of the bands; the outermost pair is
+        shaded, the others are drawn as lines
+
+    :param boolean mean:
+        if True, the mean spectrum and its band are also plotted
+
+    :param boolean show:
+        if True, the figure is shown (interactive backends)
+    """
+
+    plt = _pyplot()
+
+    if not hold:
+        plt.figure(figsize=FIG_SIZE_RESPONSE)
+
+    freq = _np.asarray(site1d.freq, dtype='float64')
+
+    if mode is not None:
+        data, weights = site1d.get_product(('amp', key), True)
+        data = _np.abs(data)
+
+        if mode == 'lines':
+            vert = _np.empty(data.shape + (2,))
+            vert[:, :, 0] = freq
+            vert[:, :, 1] = data
+            lines = _lines(vert, color)
+            plt.gca().add_collection(lines)
+            plt.gca().autoscale()
+
+        elif mode == 'bands':
+            values = _ut.weighted_percentile(data, perc, weights)
+            plt.fill_between(freq, values[0], values[-1],
+                              color=color, alpha=0.3, linewidth=0)
+            for value in values[1:-1]:
+                plt.plot(freq, value, color=color, linewidth=2)
+
+        elif mode == 'density':
+            _density_map(data, freq, weights, log=True, vertical=False)
+
+        else:
+            raise ValueError('Unknown plotting mode: ' + str(mode))
+
+    if mean and key in site1d.mean.amp and len(site1d.mean.amp[key]):
+        mn, sd = site1d.mean.amp[key]
+        if _np.iscomplexobj(mn):
+            plt.plot(freq, _np.abs(mn), color='k', linewidth=2)
+        else:
+            plt.fill_between(freq, mn/sd, mn*sd, color='k',
+                              alpha=0.2, linewidth=0)
+            plt.plot(freq, mn, color='k', linewidth=2)
+
+    _response_decoration(key, show)
+
+
+# =============================================================================
+
+def plot_site(site1d, fig_file=None, key='vs', mode='lines', dpi=100):
+    """
+    Site report: figure with one panel for the soil profiles and
+    one for each available amplification product (quarter-wavelength,
+    SH-wave transfer function and kappa decay).
+
+    :param Site1D site1d:
+        the site to be plotted
+
+    :param string fig_file:
+        output figure file (the figure is then closed);
+        if not given, the figure is shown
+
+    :param string key:
+        soil property of the profile panel (default is 'vs')
+
+    :param string mode:
+        plotting mode of the ensemble (see plot_models)
+
+    :param int dpi:
+        resolution of the figure file
+
+    :return matplotlib.figure.Figure fig:
+        the figure (None if saved to file)
+    """
+
+    plt = _pyplot()
+
+    keys = [k for k in ['qwl', 'shtf', 'kappa']
+            if len(site1d.mean.amp.get(k, []))]
+
+    panels = 1 + len(keys)
+    fig = plt.figure(figsize=(FIG_SIZE_PANEL[0]*panels, FIG_SIZE_PANEL[1]))
+
+    plt.subplot(1, panels, 1)
+    plot_models(site1d, key, hold=True, mode=mode, show=False)
+    if site1d.head.get('id') is not None:
+        plt.title(str(site1d.head['id']))
+
+    for nk, k in enumerate(keys):
+        plt.subplot(1, panels, nk + 2)
+        plot_amplification(site1d, k, hold=True, mode=mode, show=False)
+
+    plt.tight_layout()
+
+    if fig_file is None:
+        plt.draw_all()
+        plt.show(block=False)
+        return fig
+
+    fig.savefig(fig_file, dpi=dpi)
+    plt.close(fig)
+
+
+def report_sites(sites, output_dir, fmt='png', processes=1, **kwargs):
+    """
+    Render the report figures (see plot_site) of a set of sites to
+    files, with a non-interactive backend and in parallel over
+    multiple processes. Files are named after the site id
+    (or the site index, if missing).
+
+    :param list sites:
+        list of Site1D objects (or a SiteCollection)
+
+    :param string output_dir:
+        directory of the figure files
+
+    :param string fmt:
+        figure format (default is png)
+
+    :param int processes:
+        number of processes (default is one, no parallelism)
+
+    :param kwargs:
+        further arguments of plot_site (key, mode and dpi)
+
+    :return list files:
+        list of the figure files
+    """
+
+    if not _os.path.isdir(output_dir):
+        _os.makedirs(output_dir)
+
+    tasks = []
+    for ns, site in enumerate(sites):
+        name = site.head.get('id')
+        name = str(ns) if name is None else str(name)
+        fig_file = _os.path.join(output_dir, name + '.' + fmt)
+        tasks.append((site, fig_file, kwargs))
+
+    if processes > 1:
+        pool = _mp.Pool(processes, _pyplot, (FILE_BACKEND,))
+        chunk = max(1, len(tasks)//(4*processes))
+        files = pool.map(_report_worker, tasks, chunk)
+        pool.close()
+        pool.join()
+    else:
+        # Backend of the session, restored after rendering
+        if _plt is not None:
+            backend = _plt.get_backend()
+        elif 'matplotlib.pyplot' in _sys.modules:
+            backend = _sys.modules['matplotlib.pyplot'].get_backend()
+        else:
+            import matplotlib
+            backend = BACKEND or matplotlib.get_backend()
+
+        _pyplot(FILE_BACKEND)
+        try:
+            files = [_report_worker(task) for task in tasks]
+        finally:
+            _pyplot(backend)
+
+    return files
+
+
+def _report_worker(task):
+    """
+    Internal: render a single site report
+    """
+
+    site, fig_file, kwargs = task
+    plot_site(site, fig_file, **kwargs)
+
+    return fig_file
+
+
+# =============================================================================
+
+def step_layers(hl, param, lnum=None, bottom=1.4):
+    """
+    Top and bottom depth of the layers of a set of soil profiles,
+    stored as (models x layers) arrays (see Ensemble). The half-space
+    is drawn down to a given factor of its top depth. Layers beyond
+    the number of layers of each model (padding) are collapsed
+    onto the last valid point.
+
+    :param numpy.ndarray hl:
+        layer thickness (models x layers); a single profile
+        is also allowed
+
+    :param numpy.ndarray param:
+        soil property to plot (models x layers)
+
+    :param numpy.ndarray lnum:
+        number of layers of each model (default is all)
+
+    :param float bottom:
+        depth factor of the half-space bottom (default 1.4)
+
+    :return numpy.ndarray (top, bot, val):
+        top and bottom depth and value of each layer
+    """
+
+    hl = _np.atleast_2d(_np.asarray(hl, dtype='float64'))
+    val = _np.atleast_2d(_np.asarray(param, dtype='float64'))
+
+    mnum, lmax = val.shape
+    if lnum is None:
+        lnum = _np.full(mnum, lmax, dtype='int')
+
+    rows = _np.arange(mnum)[:, None]
+    last = _np.maximum(_np.asarray(lnum) - 1, 0)[:, None]
+    valid = _np.arange(lmax) < last + 1
+
+    thk = _np.where(valid, _np.nan_to_num(hl), 0.)
+    bot = _np.cumsum(thk, axis=1)
+    top = bot - thk
+
+    # Half-space
+    bot[rows, last] = bottom*top[rows, last]
+
+    # Padding
+    index = _np.minimum(_np.arange(lmax), last)
+    top = _np.where(valid, top, bot[rows, last])
+    bot = bot[rows, index]
+    val = val[rows, index]
+
+    return top, bot, val
+
+
+def _step_vertices(top, bot, val):
+    """
+    Internal: vertices (models x points x 2) of the step profiles
+    """
+
+    vert = _np.empty(val.shape + (2, 2))
+    vert[:, :, :, 0] = val[:, :, None]
+    vert[:, :, 0, 1] = top
+    vert[:, :, 1, 1] = bot
+
+    return vert.reshape(val.shape[0], -1, 2)
+
+
+def _sample_layers(top, val, depth):
+    """
+    Internal: value of the profiles (models x depths) at given depths
+    """
+
+    rows = _np.arange(val.shape[0])[:, None]
+    index = _np.zeros((val.shape[0], len(depth)), dtype='int')
+
+    for nl in range(1, val.shape[1]):
+        index += top[:, nl, None] <= depth
+
+    return val[rows, index]
+
+
+def _geo_arrays(models):
+    """
+    Internal: (models x layers) arrays of soil properties and
+    number of layers, from an ensemble or a list of models
+    """
+
+    if isinstance(models, _sdb.Ensemble):
+        return models.geo, models.lnum
+
+    lnum = _np.array([len(mod.geo['hl']) for mod in models], dtype='int')
+    lmax = _np.max(lnum) if len(lnum) else 0
+
+    geo = {}
+    for key in _sdb.GEO_KEYS:
+        geo[key] = _np.full((len(lnum), lmax), _np.nan)
+        for nm, mod in enumerate(models):
+            geo[key][nm, :lnum[nm]] = mod.geo[key]
+
+    return geo, lnum
+
+
+def _lines(vert, color):
+    """
+    Internal: single collection of lines, with transparency
+    decreasing with the number of lines
+    """
+
+    from matplotlib.collections import LineCollection
+
+    alpha = min(1., max(0.02, 10./max(len(vert), 1)))
+
+    return LineCollection(vert, colors=color, linewidths=1, alpha=alpha)
+
+
+def _density_map(data, axis, weights, log=False, vertical=False, nbin=100):
+    """
+    Internal: weighted density map of a set of curves, sampled
+    at the same points (axis), as a two-dimensional histogram
+    """
+
+    data = _np.log10(data) if log else data
+    edges = _np.linspace(_np.nanmin(data), _np.nanmax(data), nbin + 1)
+
+    dens = _np.zeros((nbin, len(axis)))
+    index = _np.clip(_np.searchsorted(edges, data) - 1, 0, nbin - 1)
+    for na in range(len(axis)):
+        dens[:, na] = _np.bincount(index[:, na], weights, nbin)
+
+    edges = 10.**edges if log else edges
+
+    plt = _pyplot()
+
+    if vertical:
+        plt.pcolormesh(edges, axis, dens.T, cmap='Greys')
+    else:
+        plt.pcolormesh(axis, edges, dens, cmap='Greys')
 
 
 # =============================================================================
 
-def _profile_decoration(key):
+def _profile_decoration(key, show=True):
+    """
+    """
+
+    plt = _pyplot()
+
+    plt.grid(True)
+    plt.gca().invert_yaxis()
+    plt.xlabel(MODEL_LABELS[key])
+    plt.ylabel(MODEL_LABELS['hl'])
+    if show:
+        plt.draw_all()
+        plt.show(block=False)
+
+
+def _response_decoration(key, show=True):
     """
     """
 
-    _plt.grid('on')
-    _plt.gca().invert_yaxis()
-    _plt.xlabel(MODEL_LABELS[key])
-    _plt.ylabel(MODEL_LABELS['hl'])
-    _plt.draw_all()
-    _plt.show(block=False)
+    plt = _pyplot()
+
+    plt.grid(True, which='both')
+    plt.gca().set_xscale('log')
+    plt.gca().set_yscale('log')
+    plt.xlabel('Frequency (Hz)')
+    plt.ylabel(RESPONSE_LABELS[key])
+    if show:
+        plt.draw_all()
+        plt.show(block=False)
@@ -0,0 +1,261 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+"""
+Opt-in instrumentation of the calculations. For each stage (e.g. a
+Site1D method) the wall time and the number of calls are recorded,
+together with event counters: linear solves ('solves'), failed
+solves ('failed'), optimizer function evaluations ('evals') and
+layer propagation steps ('updates').
+Times are inclusive of nested stages; counters are assigned to the
+innermost active stage.
+
+Instrumentation is disabled by default, and then reduces to a single
+flag check per call. Usage example:
+
+    with instrument.recording() as rec:
+        site.quarter_wavelength_average()
+    print(rec.report)
+"""
+
+import time as _time
+import functools as _ft
+
+# =============================================================================
+# Constants & initialisation variables
+
+# Event counters
+COUNTERS = ['solves', 'failed', 'evals', 'updates']
+
+# Stage assigned to the counters outside of any timed stage
+NO_STAGE = 'other'
+
+_enabled = False
+_records = {}
+_stack = []
+
+
+# =============================================================================
+
+def enable(reset=False):
+    """
+    Enable the instrumentation.
+
+    :param boolean reset:
+        if True, previous records are removed
+    """
+
+    global _enabled
+
+    if reset:
+        _records.clear()
+    _enabled = True
+
+
+def disable():
+    """
+    Disable the instrumentation (records are kept).
+    """
+
+    global _enabled
+
+    _enabled = False
+
+
+def is_enabled():
+    """
+    Return True if the instrumentation is enabled.
+    """
+
+    return _enabled
+
+
+def reset():
+    """
+    Remove all the records.
+    """
+
+    _records.clear()
+
+
+# =============================================================================
+
+def _record(stage):
+    """
+    Internal: record of a stage (created if missing)
+    """
+
+    if stage not in _records:
+        _records[stage] = {'time': 0., 'calls': 0}
+        for key in COUNTERS:
+            _records[stage][key] = 0
+
+    return _records[stage]
+
+
+class timer(object):
+    """
+    Context manager recording the wall time and the number
+    of calls of a stage (no-op if instrumentation is disabled).
+
+    :param string stage:
+        name of the stage
+    """
+
+    def __init__(self, stage):
+
+        self.stage = stage
+        self._start = None
+
+    def __enter__(self):
+
+        if _enabled:
+            _stack.append(self.stage)
+            self._start = _time.time()
+
+        return self
+
+    def __exit__(self, *exc):
+
+        if self._start is not None:
+            record = _record(self.stage)
+            record['time'] += _time.time() - self._start
+            record['calls'] += 1
+            _stack.pop()
+            self._start = None
+
+        return False
+
+
+def timed(stage):
+    """
+    Decorator recording the wall time and the number of calls
+    of a function as a stage (see timer).
+
+    :param string stage:
+        name of the stage
+    """
+
+    def decorator(func):
+
+        @_ft.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with timer(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(key, number=1):
+    """
+    Increment an event counter of the innermost active stage
+    (no-op if instrumentation is disabled).
+
+    :param string key:
+        name of the counter (e.g. 'solves', 'failed', 'evals')
+
+    :param int number:
+        increment (default is one)
+    """
+
+    if _enabled:
+        record = _record(_stack[-1] if _stack else NO_STAGE)
+        record[key] = record.get(key, 0) + number
+
+
+# =============================================================================
+
+def report(clear=False):
+    """
+    Structured report of the records, as a dictionary of
+    {stage: {'time': ..., 'calls': ..., counters...}}.
+
+    :param boolean clear:
+        if True, records are removed after the report
+
+    :return dict report:
+        the report (json-serialisable)
+    """
+
+    result = {stage: dict(record) for stage, record in _records.items()}
+
+    if clear:
+        _records.clear()
+
+    return result
+
+
+def merge(reports):
+    """
+    Aggregate a set of reports (e.g. of the sites of a batch).
+
+    :param list reports:
+        list of reports (see report)
+
+    :return dict report:
+        the aggregated report
+    """
+
+    result = {}
+
+    for rep in reports:
+        for stage, record in rep.items():
+            total = result.setdefault(stage, {})
+            for key, value in record.items():
+                total[key] = total.get(key, 0) + value
+
+    return result
+
+
+class recording(object):
+    """
+    Context manager enabling the instrumentation for a block of code,
+    with separate records; the report of the block is then available
+    as the report attribute. Previous records and state are restored.
+    """
+
+    def __init__(self):
+
+        self.report = {}
+
+    def __enter__(self):
+
+        global _records
+
+        self._state = (_enabled, _records)
+        _records = {}
+        enable()
+
+        return self
+
+    def __exit__(self, *exc):
+
+        global _enabled, _records
+
+        self.report = report()
+        _enabled, _records = self._state
+
+        return False
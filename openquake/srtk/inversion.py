@@ -0,0 +1,703 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+"""
+Inversion of one-dimensional soil profiles (shear-wave velocity,
+layer thickness and site kappa) from a target site amplification,
+e.g. from empirical spectral ratios.
+
+The forward model is either the SH-wave transfer function at the
+surface (outcropping rock reference, with a selectable attenuation
+model) or the quarter-wavelength amplification relative to the
+half-space, optionally multiplied by the attenuation decay of the
+site kappa; the misfit is the RMS of the residuals of the log
+amplification. Two methods are available: a local search
+(bounded quasi-Newton, with analytic gradients) and a global search
+(differential evolution, with the population evaluated in vectorised
+batches and optionally across processes). Results are returned as a
+Site1D with the best models, so that the site statistics apply.
+"""
+
+import multiprocessing as _mp
+import numpy as _np
+import scipy.optimize as _spo
+
+import openquake.srtk.response as _amp
+import openquake.srtk.soil as _sl
+import openquake.srtk.randomise as _rnd
+import openquake.srtk.sitedb as _sdb
+import openquake.srtk.instrument as _ins
+
+# =============================================================================
+# Constants & initialisation variables
+
+# Default settings of the differential evolution
+# (population size per parameter, dithering of the mutation
+#  factor and crossover probability)
+POPSIZE = 15
+MUTATION = (0.5, 1.)
+CROSSOVER = 0.7
+
+# Available forward models (SH-wave transfer function
+# and quarter-wavelength amplification)
+FORWARD = ['sh', 'qwl']
+
+
+# =============================================================================
+
+class ProfileSpace(object):
+    """
+    Parameter space of the inversion: the velocities (and optionally
+    thicknesses) of the layers of a reference profile are searched
+    within bounds, together with the site kappa (optional). Other soil
+    properties are coupled to the velocity as in the randomisation
+    module (power law of the velocity ratio).
+
+    Parameters are ordered as layer velocities, layer thicknesses
+    (half-space excluded) and kappa.
+
+    :param dict geo:
+        reference profile (e.g. Model.geo); 'hl', 'vs' and 'dn'
+        are required
+
+    :param tuple vs_bounds:
+        minimum and maximum velocity in m/s (scalars or
+        arrays with one value per layer); parameters with
+        equal bounds are fixed
+
+    :param tuple hl_bounds:
+        minimum and maximum thickness in meters (scalars or
+        arrays with one value per layer, half-space excluded);
+        if not given, thicknesses are fixed
+
+    :param tuple kappa_bounds:
+        minimum and maximum site kappa in seconds;
+        if not given, kappa is not included
+
+    :param dict coupling:
+        exponents of the power-law coupling between velocity
+        and other soil properties (see randomise.COUPLING)
+    """
+
+    def __init__(self, geo, vs_bounds, hl_bounds=None, kappa_bounds=None,
+                 coupling=_rnd.COUPLING):
+
+        self.ref = {}
+        for key, value in geo.items():
+            self.ref[key] = _np.array(value, dtype='float64')
+        self.ref['hl'] = _np.nan_to_num(self.ref['hl'])
+        self.ref['hl'][-1] = 0.
+
+        self.lnum = len(self.ref['vs'])
+        self.coupling = coupling
+        self.with_hl = hl_bounds is not None
+        self.with_kappa = kappa_bounds is not None
+
+        lower = [_np.broadcast_to(vs_bounds[0], (self.lnum,))]
+        upper = [_np.broadcast_to(vs_bounds[1], (self.lnum,))]
+        if self.with_hl:
+            lower.append(_np.broadcast_to(hl_bounds[0], (self.lnum - 1,)))
+            upper.append(_np.broadcast_to(hl_bounds[1], (self.lnum - 1,)))
+        if self.with_kappa:
+            lower.append([kappa_bounds[0]])
+            upper.append([kappa_bounds[1]])
+
+        self.lower = _np.concatenate(lower).astype('float64')
+        self.upper = _np.concatenate(upper).astype('float64')
+
+    def __len__(self):
+
+        return len(self.lower)
+
+    # -------------------------------------------------------------------------
+
+    def geo(self, x):
+        """
+        Soil profiles of a set of parameter vectors.
+
+        :param numpy.array x:
+            parameters (models x parameters)
+
+        :return dict geo:
+            dictionary of arrays (models x layers) of soil properties
+        """
+
+        x = _np.atleast_2d(x)
+        vs = x[:, :self.lnum]
+        ratio = vs/self.ref['vs']
+
+        geo = {}
+        for key, value in self.ref.items():
+            geo[key] = _np.tile(value, (len(x), 1))
+            if key in self.coupling:
+                geo[key] *= ratio**self.coupling[key]
+
+        geo['vs'] = vs.copy()
+        if self.with_hl:
+            geo['hl'][:, :-1] = x[:, self.lnum:2*self.lnum-1]
+
+        return geo
+
+    def kappa(self, x):
+        """
+        Site kappa of a set of parameter vectors (None if
+        kappa is not included).
+
+        :param numpy.array x:
+            parameters (models x parameters)
+
+        :return numpy.array kappa:
+            site kappa of each model
+        """
+
+        if not self.with_kappa:
+            return None
+
+        return _np.atleast_2d(x)[:, -1]
+
+    def vector(self, geo=None, kappa=None):
+        """
+        Parameter vector of a profile (within the bounds).
+
+        :param dict geo:
+            soil profile (default is the reference profile)
+
+        :param float kappa:
+            site kappa (default is the centre of the bounds)
+
+        :return numpy.array x:
+            parameters
+        """
+
+        geo = self.ref if geo is None else geo
+
+        x = [_np.asarray(geo['vs'], dtype='float64')]
+        if self.with_hl:
+            x.append(_np.asarray(geo['hl'], dtype='float64')[:-1])
+        if self.with_kappa:
+            if kappa is None:
+                kappa = (self.lower[-1] + self.upper[-1])/2.
+            x.append([kappa])
+
+        return _np.clip(_np.concatenate(x), self.lower, self.upper)
+
+    # -------------------------------------------------------------------------
+
+    def _to_unit(self, x):
+        """
+        Internal: parameters normalised to the unit hypercube
+        """
+
+        width = self.upper - self.lower
+
+        # Fixed parameters (equal bounds) map to zero
+        return (x - self.lower)/_np.where(width > 0., width, 1.)
+
+    def _from_unit(self, u):
+        """
+        Internal: parameters from the unit hypercube
+        """
+
+        return self.lower + u*(self.upper - self.lower)
+
+
+# =============================================================================
+
+class Inversion(object):
+    """
+    Inversion of a target amplification function.
+
+    :param numpy.array freq:
+        array of frequencies in Hz of the target
+
+    :param numpy.array target:
+        target amplification (e.g. from spectral ratios)
+
+    :param ProfileSpace space:
+        parameter space of the inversion
+
+    :param numpy.array sigma:
+        standard deviation of the log target amplification
+        (scalar or one per frequency, default is 1)
+
+    :param float inc_ang:
+        angle of incidence (see response.sh_transfer_function)
+
+    :param int processes:
+        number of worker processes for the population search
+        (default is 1, serial)
+
+    :param string forward:
+        forward model, 'sh' (SH-wave transfer function, default)
+        or 'qwl' (quarter-wavelength amplification)
+
+    :param attenuation.QModel attenuation:
+        attenuation model of the SH-wave forward model
+        (default is constant Q)
+    """
+
+    def __init__(self, freq, target, space, sigma=1., inc_ang=0.,
+                 processes=1, forward='sh', attenuation=None):
+
+        if forward not in FORWARD:
+            raise ValueError('Unknown forward model: {0}'.format(forward))
+
+        if forward == 'qwl' and attenuation is not None:
+            raise ValueError('Attenuation model not used by the '
+                             'quarter-wavelength forward model')
+
+        self.freq = _np.asarray(freq, dtype='float64')
+        self.target = _np.asarray(target, dtype='float64')
+        self.space = space
+        self.sigma = _np.broadcast_to(sigma, self.freq.shape)
+        self.inc_ang = inc_ang
+        self.processes = processes
+        self.forward_model = forward
+        self.attenuation = attenuation
+
+        self._log_target = _np.log(self.target)
+
+    # -------------------------------------------------------------------------
+
+    def forward(self, x):
+        """
+        Amplification of a set of parameter vectors (vectorised).
+
+        :param numpy.array x:
+            parameters (models x parameters)
+
+        :return numpy.array amp:
+            amplification (models x frequencies)
+        """
+
+        geo = self.space.geo(x)
+
+        if self.forward_model == 'qwl':
+            amp = self._qwl_amplification(geo)
+        else:
+            amp = _np.abs(_amp.sh_transfer_function_array(
+                self.freq, geo['hl'], geo['vs'], geo['dn'], geo.get('qs'),
+                self.inc_ang, self.attenuation))
+
+        kappa = self.space.kappa(x)
+        if kappa is not None:
+            amp *= _amp.attenuation_decay(self.freq, kappa[:, None])
+
+        return amp
+
+    def misfit(self, x):
+        """
+        Misfit of a set of parameter vectors (vectorised).
+
+        :param numpy.array x:
+            parameters (models x parameters)
+
+        :return numpy.array misfit:
+            RMS of the normalised log residuals of each model
+        """
+
+        res = (_np.log(self.forward(x)) - self._log_target)/self.sigma
+
+        return _np.sqrt(_np.mean(res**2., axis=1))
+
+    def gradient(self, x):
+        """
+        Misfit of a single parameter vector and its gradient
+        (analytic, see response.SHPropagator.jacobian and
+        soil.quarter_wavelength_jacobian).
+
+        :param numpy.array x:
+            parameters
+
+        :return float misfit:
+            RMS of the normalised log residuals
+
+        :return numpy.array grad:
+            derivatives of the misfit with respect to the parameters
+        """
+
+        space = self.space
+        geo = space.geo(x)
+        geo = dict((key, value[0]) for key, value in geo.items())
+
+        if self.forward_model == 'qwl':
+            amp, jac = self._qwl_jacobian(geo)
+        else:
+            prop = self._propagator()
+            amp, jac = prop.jacobian(geo['hl'], geo['vs'], geo['dn'],
+                                     geo.get('qs'), complex=False)
+
+        # Velocity, including the coupled properties
+        d_vs = jac['vs']
+        for key in ['dn', 'qs']:
+            if key in jac and space.coupling.get(key):
+                d_vs = d_vs + jac[key]*space.coupling[key]*geo[key]/geo['vs']
+
+        d_log = [d_vs/amp[:, None]]
+        if space.with_hl:
+            d_log.append(jac['hl'][:, :-1]/amp[:, None])
+
+        kappa = space.kappa(x)
+        if kappa is not None:
+            amp = amp*_amp.attenuation_decay(self.freq, kappa[0])
+            d_log.append(-_np.pi*self.freq[:, None])
+
+        d_log = _np.hstack(d_log)
+
+        res = (_np.log(amp) - self._log_target)/self.sigma
+        misfit = _np.sqrt(_np.mean(res**2.))
+
+        grad = _np.dot(res/self.sigma, d_log)/(len(res)*max(misfit, 1e-300))
+
+        return misfit, grad
+
+    # -------------------------------------------------------------------------
+
+    @_ins.timed('Inversion.local_search')
+    def local_search(self, x0=None, maxiter=200, tol=1e-10):
+        """
+        Local (gradient-based) search from a starting model, by
+        bounded quasi-Newton optimisation (L-BFGS-B) in normalised
+        parameter space.
+
+        :param numpy.array x0:
+            starting parameters (default is the reference profile)
+
+        :param int maxiter:
+            maximum number of iterations
+
+        :param float tol:
+            tolerance on the relative misfit reduction
+
+        :return numpy.array x:
+            best parameters
+
+        :return float misfit:
+            misfit of the best parameters
+        """
+
+        space = self.space
+        if x0 is None:
+            x0 = space.vector()
+
+        scale = space.upper - space.lower
+
+        def func(u):
+            misfit, grad = self.gradient(space._from_unit(u))
+            _ins.count('evals')
+            return misfit, grad*scale
+
+        result = _spo.minimize(func, space._to_unit(x0), jac=True,
+                               method='L-BFGS-B',
+                               bounds=[(0., 1.)]*len(space),
+                               options={'maxiter': maxiter, 'ftol': tol})
+
+        return space._from_unit(result.x), result.fun
+
+    @_ins.timed('Inversion.global_search')
+    def global_search(self, popsize=POPSIZE, generations=100,
+                      mutation=MUTATION, crossover=CROSSOVER, tol=1e-6,
+                      seed=None):
+        """
+        Global (population-based) search by differential evolution
+        (rand/1/bin with dithering). Each generation is evaluated as
+        a single vectorised batch, split across processes if required.
+
+        :param int popsize:
+            population size, as multiple of the number of parameters
+
+        :param int generations:
+            maximum number of generations
+
+        :param tuple mutation:
+            range of the (dithered) mutation factor
+
+        :param float crossover:
+            crossover probability
+
+        :param float tol:
+            convergence tolerance on the relative spread
+            of the population misfit
+
+        :param int seed:
+            seed of the random generator (optional)
+
+        :return numpy.array population:
+            final population (models x parameters), sorted
+            by increasing misfit
+
+        :return numpy.array misfit:
+            misfit of the population
+        """
+
+        rnd = _np.random.RandomState(seed)
+
+        space = self.space
+        pnum = len(space)
+        mnum = max(popsize*pnum, 5)
+
+        pool = None
+        if self.processes is not None and self.processes > 1:
+            pool = _mp.Pool(self.processes)
+
+        try:
+            # Initial population (latin hypercube), reference included
+            pop = (rnd.uniform(size=(mnum, pnum)) +
+                   _np.argsort(rnd.uniform(size=(mnum, pnum)), axis=0))/mnum
+            pop[0] = space._to_unit(space.vector())
+            cost = self._evaluate(pop, pool)
+
+            for _ in range(generations):
+                # Mutation (three distinct members other than the target)
+                idx = _np.argsort(rnd.uniform(size=(mnum, mnum - 1)), axis=1)
+                idx = idx[:, :3]
+                idx += idx >= _np.arange(mnum)[:, None]
+                factor = rnd.uniform(mutation[0], mutation[1])
+                trial = pop[idx[:, 0]] + factor*(pop[idx[:, 1]] -
+                                                 pop[idx[:, 2]])
+
+                # Binomial crossover (at least one parameter)
+                cross = rnd.uniform(size=(mnum, pnum)) < crossover
+                cross[_np.arange(mnum), rnd.randint(0, pnum, mnum)] = True
+                trial = _np.where(cross, trial, pop)
+
+                # Out of bounds parameters are reinitialised
+                out = (trial < 0.) | (trial > 1.)
+                trial[out] = rnd.uniform(size=_np.sum(out))
+
+                # Selection
+                trial_cost = self._evaluate(trial, pool)
+                better = trial_cost <= cost
+                pop[better] = trial[better]
+                cost[better] = trial_cost[better]
+
+                if _np.std(cost) <= tol*_np.abs(_np.mean(cost)):
+                    break
+
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        order = _np.argsort(cost)
+
+        return space._from_unit(pop[order]), cost[order]
+
+    def _evaluate(self, u, pool=None):
+        """
+        Internal: misfit of a population in normalised space
+        """
+
+        x = self.space._from_unit(u)
+        _ins.count('evals', len(x))
+
+        if pool is None:
+            return self.misfit(x)
+
+        chunks = _np.array_split(x, self.processes)
+        result = pool.map(_misfit_worker, [(self, c) for c in chunks])
+
+        return _np.concatenate(result)
+
+    def _propagator(self):
+        """
+        Internal: SH-wave propagator (kept between calls)
+        """
+
+        prop = getattr(self, '_prop', None)
+        if prop is None:
+            prop = _amp.SHPropagator(self.freq, self.inc_ang,
+                                     attenuation=self.attenuation)
+            self._prop = prop
+
+        return prop
+
+    def _qwl_amplification(self, geo):
+        """
+        Internal: quarter-wavelength amplification of a set of
+        profiles, relative to the half-space of each profile
+        """
+
+        qwl = _sl.quarter_wavelength_average_array(geo['hl'], geo['vs'],
+                                                   geo['dn'], self.freq)
+
+        # Impedance contrast angles are in degrees
+        return _amp.impedance_amplification_array(
+            qwl[1], qwl[2], geo['vs'][:, -1:].T, geo['dn'][:, -1:].T,
+            _np.degrees(self.inc_ang))[0]
+
+    def _qwl_jacobian(self, geo):
+        """
+        Internal: quarter-wavelength amplification of a single
+        profile and its derivatives with respect to the layer
+        thickness, velocity and density (frequencies x layers)
+        """
+
+        hl, vs, dn = geo['hl'], geo['vs'], geo['dn']
+        _, qwl_vs, qwl_dn, qjac = _sl.quarter_wavelength_jacobian(
+            hl, vs, dn, self.freq)
+
+        amp = _np.sqrt((dn[-1]*vs[-1])/(qwl_dn*qwl_vs))
+
+        # Snell's law (oblique incidence), as in impedance_amplification
+        sin_eff = (qwl_vs/vs[-1])*_np.sin(self.inc_ang)
+        amp *= _np.sqrt(_np.cos(self.inc_ang)/_np.sqrt(1. - sin_eff**2.))
+        fac = 0.5*(1. - sin_eff**2./(1. - sin_eff**2.))
+
+        jac = {}
+        for key in ['hl', 'vs', 'dn']:
+            d_log = (-0.5*qjac['dn'][key]/qwl_dn[:, None] -
+                     fac[:, None]*qjac['vs'][key]/qwl_vs[:, None])
+            jac[key] = amp[:, None]*d_log
+
+        # Reference (half-space) parameters
+        jac['vs'][:, -1] += amp*fac/vs[-1]
+        jac['dn'][:, -1] += amp*0.5/dn[-1]
+
+        return amp, jac
+
+    def __getstate__(self):
+
+        state = dict(self.__dict__)
+        state.pop('_prop', None)
+
+        return state
+
+    # -------------------------------------------------------------------------
+
+    def to_site(self, x, misfit=None):
+        """
+        Site database of a set of inverted models.
+
+        :param numpy.array x:
+            parameters (models x parameters)
+
+        :param numpy.array misfit:
+            misfit of the models (computed if not given)
+
+        :return Site1D site:
+            site with frequency axis of the target and the models;
+            kappa and misfit of each model are stored as products
+            ('kappa' and 'misfit')
+        """
+
+        x = _np.atleast_2d(x)
+        if misfit is None:
+            misfit = self.misfit(x)
+
+        site = _sdb.Site1D()
+        site.freq = self.freq.copy()
+        site.add_model_array(self.space.geo(x))
+
+        kappa = self.space.kappa(x)
+        for nm, mod in enumerate(site.model):
+            mod.eng['misfit'] = misfit[nm]
+            if kappa is not None:
+                mod.eng['kappa'] = kappa[nm]
+
+        return site
+
+
+def _misfit_worker(task):
+    """
+    Internal: misfit of a batch of models (worker process)
+    """
+
+    inversion, x = task
+
+    return inversion.misfit(x)
+
+
+# =============================================================================
+
+def invert(freq, target, space, method='global', best=10, sigma=1.,
+           inc_ang=0., processes=1, seed=None, forward='sh',
+           attenuation=None, **kwargs):
+    """
+    Invert a target amplification function and return the best models.
+
+    :param numpy.array freq:
+        array of frequencies in Hz of the target
+
+    :param numpy.array target:
+        target amplification
+
+    :param ProfileSpace space:
+        parameter space of the inversion
+
+    :param string method:
+        'local' (gradient-based search from the reference profile),
+        'global' (population search) or 'hybrid' (population search
+        with local refinement of the best models)
+
+    :param int best:
+        number of best models to return (global and hybrid methods)
+
+    :param float sigma:
+        standard deviation of the log target (see Inversion)
+
+    :param float inc_ang:
+        angle of incidence (see response.sh_transfer_function)
+
+    :param int processes:
+        number of worker processes for the population search
+
+    :param int seed:
+        seed of the random generator (optional)
+
+    :param string forward:
+        forward model, 'sh' or 'qwl' (see Inversion)
+
+    :param attenuation.QModel attenuation:
+        attenuation model of the SH-wave forward model (optional)
+
+    :param kwargs:
+        further arguments of the search methods
+        (e.g. generations, popsize, maxiter)
+
+    :return Site1D site:
+        site with the best models (sorted by misfit)
+    """
+
+    inv = Inversion(freq, target, space, sigma, inc_ang, processes,
+                    forward, attenuation)
+
+    if method == 'local':
+        x, misfit = inv.local_search(**kwargs)
+        return inv.to_site(x, [misfit])
+
+    if method not in ['global', 'hybrid']:
+        raise ValueError('Unknown inversion method: {0}'.format(method))
+
+    local = dict((k, kwargs.pop(k)) for k in ['maxiter'] if k in kwargs)
+    pop, misfit = inv.global_search(seed=seed, **kwargs)
+    pop = pop[:best]
+    misfit = misfit[:best]
+
+    if method == 'hybrid':
+        for nm in range(len(pop)):
+            pop[nm], misfit[nm] = inv.local_search(pop[nm], **local)
+        order = _np.argsort(misfit)
+        pop = pop[order]
+        misfit = misfit[order]
+
+    return inv.to_site(pop, misfit)
@@ -0,0 +1,358 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+"""
+Precomputed amplification lookup tables. Amplification is computed
+on a regular grid of site proxies (e.g. Vs30, kappa, f0, reference
+velocity) and then served by vectorised multilinear interpolation.
+Tables are stored as plain numpy files, which can be memory-mapped.
+"""
+
+import os as _os
+import json as _json
+import itertools as _it
+import functools as _ft
+import multiprocessing as _mp
+import numpy as _np
+
+import openquake.srtk.soil as _avg
+import openquake.srtk.response as _amp
+
+# =============================================================================
+# Constants & initialisation variables
+
+# Default parameters of the proxy profiles
+PROXY_DEFAULTS = {'vs30': 400., 'f0': 5., 'kappa': 0.,
+                  'vs_ref': 2000., 'dn': 1900., 'dn_ref': 2500.}
+
+# Table file names
+TABLE_FILES = {'meta': 'table.json', 'freq': 'freq.npy',
+               'values': 'values.npy', 'axis': 'axis{0}.npy'}
+
+
+# =============================================================================
+
+def proxy_profile(params):
+    """
+    Build a simplified profile (single soil layer over the reference
+    half-space) matching the given Vs30 and fundamental frequency
+    (f0 = Vs/4H). Velocity is bounded to the reference velocity,
+    so proxy combinations with no exact solution are approximated.
+
+    :param dict params:
+        site proxies; missing values are taken from PROXY_DEFAULTS
+
+    :return numpy.array (hl, vs, dn):
+        thickness, velocity and density of the profile
+    """
+
+    par = dict(PROXY_DEFAULTS)
+    par.update(params)
+
+    vs30, f0, vs_ref = par['vs30'], par['f0'], par['vs_ref']
+
+    # Travel-time constraint for a layer thinner than 30m
+    vs = 120.*f0 - vs_ref*(120.*f0/vs30 - 1.)
+    if vs30/(4.*f0) >= 30.:
+        vs = vs30
+    vs = min(max(vs, 1.), vs_ref)
+
+    hl = _np.array([vs/(4.*f0), 0.])
+    vs = _np.array([vs, vs_ref])
+    dn = _np.array([par['dn'], par['dn_ref']])
+
+    return hl, vs, dn
+
+
+def proxy_amplification(params, freq, method='qwl'):
+    """
+    Compute the amplification of a proxy profile (see proxy_profile),
+    including the attenuation decay for the given kappa.
+
+    :param dict params:
+        site proxies; missing values are taken from PROXY_DEFAULTS
+
+    :param numpy.array freq:
+        array of frequencies in Hz for the calculation
+
+    :param string method:
+        'qwl' for quarter-wavelength amplification (default)
+        or 'shtf' for the elastic SH-wave transfer function
+
+    :return numpy.array amp:
+        the amplification function
+    """
+
+    hl, vs, dn = proxy_profile(params)
+    kappa = params.get('kappa', PROXY_DEFAULTS['kappa'])
+
+    if method == 'shtf':
+        amp = _np.abs(_amp.sh_transfer_function(freq, hl, vs, dn)[0])/2.
+    else:
+        qwl = _avg.quarter_wavelength_average(hl, vs, dn, freq)
+        amp = _amp.impedance_amplification(qwl[1], qwl[2], vs[-1], dn[-1])
+
+    return amp*_amp.attenuation_decay(freq, kappa)
+
+
+# =============================================================================
+
+class AmplificationTable(object):
+    """
+    Amplification lookup table on a regular grid of site proxies.
+
+    :param list axes:
+        list of (name, grid) tuples of the site proxies;
+        grids must be strictly increasing
+
+    :param numpy.array freq:
+        the frequency axis of the table
+
+    :param numpy.array values:
+        amplification array of shape (n1, ..., nD, frequencies)
+
+    :param list log:
+        names of the axes interpolated in logarithmic scale
+        (frequency is always logarithmic)
+    """
+
+    def __init__(self, axes, freq, values, log=[]):
+
+        self.names = [name for name, _ in axes]
+        self.grids = [_np.asarray(grid, dtype='float64') for _, grid in axes]
+        self.freq = _np.asarray(freq, dtype='float64')
+        self.values = values
+        self.log = list(log)
+
+    # -------------------------------------------------------------------------
+
+    @classmethod
+    def build(cls, axes, freq, func=proxy_amplification, log=[],
+              processes=1, dtype='float32'):
+        """
+        Compute the table on all the grid nodes, optionally
+        in parallel over multiple processes.
+
+        :param list axes:
+            list of (name, grid) tuples of the site proxies
+
+        :param numpy.array freq:
+            the frequency axis of the table
+
+        :param function func:
+            amplification function, called as func(params, freq) with
+            params a dictionary of proxies; it must be a module-level
+            function (or partial) to be used with multiple processes
+
+        :param list log:
+            names of the axes interpolated in logarithmic scale
+
+        :param int processes:
+            number of processes (default is one, no parallelism)
+
+        :param string dtype:
+            storage type of the table (default is single precision)
+
+        :return AmplificationTable table:
+            the computed table
+        """
+
+        names = [name for name, _ in axes]
+        shape = tuple(len(grid) for _, grid in axes)
+
+        nodes = [dict(zip(names, node))
+                 for node in _it.product(*[grid for _, grid in axes])]
+        task = _ft.partial(_evaluate, func=func, freq=freq)
+
+        if processes > 1:
+            # Workers are stopped also if a node fails
+            pool = _mp.Pool(processes)
+            chunk = max(1, len(nodes)//(4*processes))
+            try:
+                result = pool.map(task, nodes, chunk)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            result = [task(node) for node in nodes]
+
+        values = _np.array(result, dtype=dtype).reshape(shape + (len(freq),))
+
+        return cls(axes, freq, values, log)
+
+    # -------------------------------------------------------------------------
+
+    def save(self, table_dir):
+        """
+        Store the table as numpy files into a directory.
+
+        :param string table_dir:
+            output directory (created if missing)
+        """
+
+        if not _os.path.isdir(table_dir):
+            _os.makedirs(table_dir)
+
+        meta = {'names': self.names, 'log': self.log}
+        with open(_os.path.join(table_dir, TABLE_FILES['meta']), 'w') as f:
+            _json.dump(meta, f)
+
+        _np.save(_os.path.join(table_dir, TABLE_FILES['freq']), self.freq)
+        _np.save(_os.path.join(table_dir, TABLE_FILES['values']),
+                 self.values)
+
+        for na, grid in enumerate(self.grids):
+            axis_file = TABLE_FILES['axis'].format(na)
+            _np.save(_os.path.join(table_dir, axis_file), grid)
+
+    @classmethod
+    def load(cls, table_dir, mmap=True):
+        """
+        Load a table from a directory.
+
+        :param string table_dir:
+            input directory
+
+        :param boolean mmap:
+            memory-map the amplification values instead of
+            reading them into memory (default is True)
+
+        :return AmplificationTable table:
+            the loaded table
+        """
+
+        with open(_os.path.join(table_dir, TABLE_FILES['meta']), 'r') as f:
+            meta = _json.load(f)
+
+        freq = _np.load(_os.path.join(table_dir, TABLE_FILES['freq']))
+        values = _np.load(_os.path.join(table_dir, TABLE_FILES['values']),
+                          mmap_mode='r' if mmap else None)
+
+        axes = []
+        for na, name in enumerate(meta['names']):
+            axis_file = TABLE_FILES['axis'].format(na)
+            axes.append((name, _np.load(_os.path.join(table_dir, axis_file))))
+
+        return cls(axes, freq, values, meta['log'])
+
+    # -------------------------------------------------------------------------
+
+    def interpolate(self, points, freq=None, chunk=100000):
+        """
+        Multilinear interpolation of the amplification at arbitrary
+        points. Interpolation is done on the logarithm of the
+        amplification; points outside the grid are clamped
+        to the grid boundaries.
+
+        :param dict points:
+            dictionary of arrays of proxy values, one per table axis
+
+        :param numpy.array freq:
+            frequencies of the output; if not given, the table
+            frequencies are used (no interpolation)
+
+        :param int chunk:
+            number of points processed at once, to limit memory usage
+
+        :return numpy.array amp:
+            amplification array of shape (points, frequencies)
+        """
+
+        coords = [_np.atleast_1d(_np.asarray(points[name], dtype='float64'))
+                  for name in self.names]
+        coords = _np.broadcast_arrays(*coords)
+        pnum = len(coords[0])
+
+        # Frequency weights (log-linear)
+        if freq is None:
+            fidx = _np.arange(len(self.freq))
+            fwgt = None
+            fnum = len(self.freq)
+        else:
+            freq = _np.atleast_1d(_np.asarray(freq, dtype='float64'))
+            fidx, fwgt = _weights(_np.log(self.freq), _np.log(freq))
+            fnxt = _np.minimum(fidx + 1, len(self.freq) - 1)
+            fnum = len(freq)
+
+        amp = _np.zeros((pnum, fnum))
+
+        for i0 in range(0, pnum, chunk):
+            i1 = min(i0 + chunk, pnum)
+
+            idx = []
+            wgt = []
+            for name, grid, coord in zip(self.names, self.grids, coords):
+                if name in self.log:
+                    ii, ww = _weights(_np.log(grid), _np.log(coord[i0:i1]))
+                else:
+                    ii, ww = _weights(grid, coord[i0:i1])
+                idx.append(ii)
+                wgt.append(ww)
+
+            log_amp = _np.zeros((i1 - i0, fnum))
+
+            # Loop over the corners of the grid cells
+            for corner in _it.product([0, 1], repeat=len(self.names)):
+                w = _np.ones(i1 - i0)
+                node = []
+                for c, ii, ww, grid in zip(corner, idx, wgt, self.grids):
+                    w = w*(ww if c else 1. - ww)
+                    node.append(_np.minimum(ii + c, len(grid) - 1))
+
+                values = self.values[tuple(node)]
+
+                if fwgt is None:
+                    value = _np.log(values)
+                else:
+                    value = ((1. - fwgt)*_np.log(values[:, fidx]) +
+                             fwgt*_np.log(values[:, fnxt]))
+
+                log_amp += w[:, None]*value
+
+            amp[i0:i1] = _np.exp(log_amp)
+
+        return amp
+
+
+# =============================================================================
+
+def _weights(grid, x):
+    """
+    Internal: lower cell index and linear weight of the points
+    on a monotonic grid (clamped at the boundaries)
+    """
+
+    if len(grid) < 2:
+        return _np.zeros(len(x), dtype='int64'), _np.zeros(len(x))
+
+    idx = _np.clip(_np.searchsorted(grid, x) - 1, 0, len(grid) - 2)
+    wgt = (x - grid[idx])/(grid[idx + 1] - grid[idx])
+
+    return idx, _np.clip(wgt, 0., 1.)
+
+
+def _evaluate(params, func, freq):
+    """
+    Internal: evaluate the amplification function on a grid node
+    """
+
+    return func(params, freq)
@@ -0,0 +1,366 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+"""
+Memory accounting of site calculations: a priori estimate of the
+footprint of a planned run (from the number of models, layers,
+frequencies and depths), actual memory held by a site (per product)
+and a memory budget check, to refuse a run or to switch it to
+chunked (streaming) mode.
+
+Sizes are in bytes. Products are given as sequences of Site1D
+methods, as names or tuples (name, dictionary of arguments).
+"""
+
+import sys as _sys
+import numpy as _np
+
+import openquake.srtk.sitedb as _sdb
+import openquake.srtk.dispersion as _dsp
+
+# =============================================================================
+# Constants & initialisation variables
+
+# Size of double and complex values
+FLOAT = 8
+COMPLEX = 16
+
+# Approximate size of a python object held per model
+OBJECT = 64
+
+# Products stored for each model by the Site1D methods:
+# (product, values per model as function of frequencies, depths
+#  or modes, numerical or object storage); the product name may
+# depend on the wave type
+PRODUCTS = {'traveltime_velocity': [('eng.vsz', 'depth', True)],
+            'compute_soil_class': [('eng.class', 'one', False)],
+            'quarter_wavelength_average': [('eng.qwl', 'freq3', True)],
+            'quarter_wavelength_amplification': [('amp.qwl', 'freq', True)],
+            'compute_site_kappa': [('eng.kappa', 'one', True)],
+            'attenuation_decay': [('amp.kappa', 'freq', True)],
+            'sh_transfer_function': [('amp.shtf', 'freq', True)],
+            'psv_transfer_function': [('amp.psv_r', 'freq', True),
+                                      ('amp.psv_z', 'freq', True)],
+            'resonance_frequency': [('amp.fn', 'freq', False)],
+            'dispersion_curve': [('amp.{wave}', 'mode', True)],
+            'hv_ratio': [('amp.hv', 'freq', True)]}
+
+# Products stored at once for all the models of an ensemble (their
+# arrays hold the models only, while the masks have the capacity)
+BULK = ['traveltime_velocity', 'compute_site_kappa',
+        'quarter_wavelength_average', 'quarter_wavelength_amplification',
+        'attenuation_decay', 'psv_transfer_function', 'dispersion_curve',
+        'hv_ratio']
+
+
+# =============================================================================
+
+def capacity(models):
+    """
+    Array capacity of an ensemble of models appended one at the time
+    (amortised growth, see Ensemble).
+
+    :param int models:
+        number of models
+
+    :return int capacity:
+        number of allocated rows
+    """
+
+    cap = 16
+    while cap < models:
+        cap *= 2
+
+    return cap
+
+
+def estimate(models, layers, freqs, products, depths=None, grow=True):
+    """
+    Estimate the memory footprint of a planned site calculation.
+
+    :param int models:
+        number of models
+
+    :param int layers:
+        maximum number of layers
+
+    :param int freqs:
+        number of frequencies
+
+    :param list products:
+        sequence of Site1D methods, e.g.
+        [('traveltime_velocity', {'depth': [10, 30]}),
+         'sh_transfer_function']
+
+    :param int depths:
+        number of calculation depths of the travel-time velocity
+        (default is taken from the product arguments)
+
+    :param boolean grow:
+        if True (default), arrays are assumed to be grown by
+        appending models one at the time (worst case capacity)
+
+    :return dict size:
+        size of the model data ('geo'), of each product
+        (e.g. 'amp.shtf'), of the statistics, of the transient
+        working arrays, the total held and the peak
+    """
+
+    rows = capacity(models) if grow else models
+
+    size = {'geo': rows*(len(_sdb.GEO_KEYS)*layers + 1)*FLOAT +
+            models*OBJECT}
+    stat = 0
+    transient = 0
+
+    for product in products:
+        name, kwargs = _sdb._product_args(product)
+
+        for key, kind, numeric in PRODUCTS.get(name, []):
+            key = key.format(wave=kwargs.get('wave', 'rayleigh'))
+
+            # Number of values and of separate arrays (columns)
+            if kind == 'depth':
+                columns = depths or len(_np.atleast_1d(
+                    kwargs.get('depth', 30.)))
+                number = columns
+            elif kind == 'freq3':
+                columns = 3
+                number = 3*freqs
+            elif kind == 'freq':
+                columns = 1
+                number = freqs
+            elif kind == 'mode':
+                columns = 1
+                number = kwargs.get('modes', 1)*freqs
+            else:
+                columns = 1
+                number = 1
+
+            value = FLOAT
+            if name.endswith('transfer_function') and kwargs.get('complex'):
+                value = COMPLEX
+
+            if numeric:
+                data = models if name in BULK else rows
+                size[key] = data*number*value + rows*columns
+                # Mean and deviation, running accumulators
+                stat += 4*number*value
+                # Statistics are computed in chunks of models
+                transient = max(transient, 2*min(models, _sdb.STAT_CHUNK) *
+                                number*value)
+            else:
+                size[key] = models*(OBJECT + number*FLOAT)
+
+        if name == 'sh_transfer_function':
+            # Propagator state of each model: partial products (two
+            # per interface) and half-space; layer terms (three per
+            # layer) of the model states and of the cache
+            states = max(1, min(models, _sdb.SH_STATES))
+            terms = max(states*layers, min(256, models*layers))
+            transient = max(transient, (states*(2*layers + 1) +
+                                        3*terms)*freqs*COMPLEX)
+
+        if name == 'psv_transfer_function':
+            # Motion-stress vectors and layer matrices (block of models)
+            block = min(models, _sdb.PSV_CHUNK)
+            transient = max(transient, (16*block*freqs +
+                                        32*block*layers)*COMPLEX)
+
+        if name in ['dispersion_curve', 'hv_ratio']:
+            # Secular function on the velocity grid (blocks of models)
+            # and bracketing arrays
+            grid = kwargs.get('grid', _dsp.GRID)
+            block = min(models, max(1, _dsp.CHUNK//(freqs*grid)))
+            transient = max(transient, 4*block*freqs*grid*FLOAT)
+
+        if name == 'hv_ratio':
+            # Surface solutions and eigenvectors (all the models)
+            transient = max(transient, 32*models*freqs*COMPLEX)
+
+        if name == 'quarter_wavelength_average':
+            # Interface arrays and layer indices (all the models)
+            transient = max(transient, (3*layers + 6*freqs)*models*FLOAT)
+
+        if name == 'quarter_wavelength_amplification':
+            # Stacked parameters and amplification (all the models)
+            transient = max(transient, 4*models*freqs*FLOAT)
+
+    size['statistics'] = stat
+    size['transient'] = transient
+    size['total'] = sum(v for k, v in size.items() if k != 'transient')
+    size['peak'] = size['total'] + transient
+
+    return size
+
+
+def chunk_size(budget, layers, freqs, products, depths=None):
+    """
+    Largest number of models which can be processed at once
+    within a memory budget (e.g. for the streaming mode).
+
+    :param int budget:
+        memory budget in bytes
+
+    :param int layers:
+        maximum number of layers
+
+    :param int freqs:
+        number of frequencies
+
+    :param list products:
+        sequence of Site1D methods (see estimate)
+
+    :param int depths:
+        number of calculation depths (see estimate)
+
+    :return int chunk:
+        number of models per chunk (at least one)
+    """
+
+    def fits(models):
+        size = estimate(models, layers, freqs, products, depths, grow=False)
+        return size['peak'] <= budget
+
+    # Bracketing and bisection (the peak grows with the models)
+    upper = 1
+    while fits(upper):
+        upper *= 2
+    lower = upper//2
+
+    while upper - lower > 1:
+        middle = (lower + upper)//2
+        if fits(middle):
+            lower = middle
+        else:
+            upper = middle
+
+    return max(1, lower)
+
+
+def check_budget(size, budget, action='refuse'):
+    """
+    Compare an estimate with a memory budget.
+
+    :param dict size:
+        the estimate (see estimate)
+
+    :param int budget:
+        memory budget in bytes (None for no limit)
+
+    :param string action:
+        'refuse' to raise an error if the budget is exceeded,
+        otherwise the outcome is only returned
+
+    :return boolean within:
+        True if the peak estimate is within the budget
+    """
+
+    if budget is None or size['peak'] <= budget:
+        return True
+
+    if action == 'refuse':
+        raise MemoryError('Estimated peak memory ({0:.1f} MB) exceeds '
+                          'the budget ({1:.1f} MB)'.format(
+                              size['peak']/1024.**2, budget/1024.**2))
+
+    return False
+
+
+# =============================================================================
+
+def footprint(site):
+    """
+    Actual memory held by a site, per product.
+
+    :param Site1D site:
+        the site
+
+    :return dict size:
+        size of the model data ('geo'), of each product
+        (e.g. 'amp.shtf'), of the statistics (including mean
+        and percentile models) and the total
+    """
+
+    size = {}
+    models = site.model
+
+    if isinstance(models, _sdb.Ensemble):
+        size['geo'] = (sum(_nbytes(v) for v in models._geo.values()) +
+                       _nbytes(models._lnum) + _sys.getsizeof(models._obj))
+
+        for group in ['eng', 'amp']:
+            for key, node in models._prod.get(group, {}).items():
+                _add(size, group + '.' + str(key), _nbytes(node))
+
+        for obj in models._obj:
+            for path, value in (obj or {}).items():
+                _add(size, '.'.join(str(k) for k in path[:2]),
+                     _nbytes(value))
+
+    else:
+        size['geo'] = 0
+        for mod in models:
+            size['geo'] += _nbytes(mod.geo)
+            for group in ['eng', 'amp']:
+                for key, value in getattr(mod, group).items():
+                    _add(size, group + '.' + str(key), _nbytes(value))
+
+    stat = 0
+    for value in list(site._stat.values()) + list(site._sketch.values()):
+        stat += _nbytes(vars(value))
+    for mod in [site.mean, site.percentiles]:
+        stat += _nbytes(mod.eng) + _nbytes(mod.amp)
+
+    size['statistics'] = stat
+    size['total'] = sum(size.values())
+
+    return size
+
+
+def _add(size, key, value):
+    """
+    Internal: accumulate a size
+    """
+
+    size[key] = size.get(key, 0) + value
+
+
+def _nbytes(value):
+    """
+    Internal: size of arrays (also nested in containers and
+    ensemble columns); other objects count as their python size
+    """
+
+    if isinstance(value, _np.ndarray):
+        return value.nbytes
+
+    if isinstance(value, _sdb._Column):
+        return value.data.nbytes + value.mask.nbytes
+
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+
+    return _sys.getsizeof(value)
@@ -0,0 +1,407 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+"""
+Tools for the parallel processing of model ensembles. Input arrays
+(soil profiles, frequency axis) and result buffers are placed in
+shared memory-mapped files (on tmpfs, if available) and only small
+descriptors are sent to the worker processes, which read the inputs
+and write the results in place, without pickling or copies.
+"""
+
+import os as _os
+import uuid as _uuid
+import tempfile as _tmp
+import multiprocessing as _mp
+import numpy as _np
+
+import openquake.srtk.response as _amp
+import openquake.srtk.attenuation as _att
+import openquake.srtk.sitedb as _sdb
+
+# =============================================================================
+# Constants & initialisation variables
+
+# Default location of the shared files (memory-backed if available)
+SHARED_DIR = '/dev/shm' if _os.path.isdir('/dev/shm') else _tmp.gettempdir()
+
+# SH-wave propagator of the worker process (see _sh_model)
+_shprop = None
+
+
+# =============================================================================
+
+class SharedArray(object):
+    """
+    Descriptor of an array stored in a memory-mapped file, which can
+    be attached by any process. Only the descriptor (file path, shape
+    and type) is pickled when sent to other processes.
+
+    :param string path:
+        path of the backing file
+
+    :param tuple shape:
+        shape of the array
+
+    :param string dtype:
+        data type of the array
+    """
+
+    def __init__(self, path, shape, dtype='float64'):
+
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = _np.dtype(dtype).str
+
+    @classmethod
+    def create(cls, shape, dtype='float64', work_dir=None, data=None):
+        """
+        Allocate a new (zero-filled) shared array.
+
+        :param tuple shape:
+            shape of the array
+
+        :param string dtype:
+            data type of the array
+
+        :param string work_dir:
+            directory of the backing file (default is SHARED_DIR)
+
+        :param numpy.array data:
+            initial content of the array (optional)
+
+        :return SharedArray shared:
+            the array descriptor
+        """
+
+        if work_dir is None:
+            work_dir = SHARED_DIR
+
+        path = _os.path.join(work_dir, 'srtk-{0}.bin'.format(_uuid.uuid4()))
+        shared = cls(path, shape, dtype)
+
+        # Allocation by file truncation (sparse, zero-filled)
+        with open(path, 'wb') as f:
+            f.truncate(max(shared.nbytes, 1))
+
+        if data is not None:
+            shared.attach()[...] = data
+
+        return shared
+
+    @property
+    def nbytes(self):
+        """
+        Size of the array in bytes
+        """
+
+        return int(_np.prod(self.shape))*_np.dtype(self.dtype).itemsize
+
+    def attach(self, mode='r+'):
+        """
+        Map the shared array in the current process.
+
+        :param string mode:
+            'r+' for read-write (default) or 'r' for read-only
+
+        :return numpy.memmap array:
+            the mapped array
+        """
+
+        if not self.nbytes:
+            return _np.zeros(self.shape, dtype=self.dtype)
+
+        return _np.memmap(self.path, dtype=self.dtype,
+                          mode=mode, shape=self.shape)
+
+    def unlink(self):
+        """
+        Remove the backing file. Arrays already mapped remain
+        valid on POSIX systems until they are released.
+        """
+
+        if _os.path.exists(self.path):
+            _os.remove(self.path)
+
+
+# =============================================================================
+
+def share_ensemble(ensemble, work_dir=None):
+    """
+    Copy the soil profiles of an ensemble into shared arrays.
+
+    :param Ensemble ensemble:
+        the array-backed model ensemble
+
+    :param string work_dir:
+        directory of the backing files (default is SHARED_DIR)
+
+    :return dict shared:
+        descriptors of the geo arrays and of the layer numbers
+    """
+
+    geo = ensemble.geo
+
+    shared = {'geo': {}}
+    for key, value in geo.items():
+        shared['geo'][key] = SharedArray.create(value.shape, value.dtype,
+                                                work_dir, value)
+    shared['lnum'] = SharedArray.create(ensemble.lnum.shape, 'int64',
+                                        work_dir, ensemble.lnum)
+
+    return shared
+
+
+def ensemble_map(ensemble, func, shape, dtype='float64', args=(),
+                 processes=None, chunk=None, work_dir=None):
+    """
+    Apply a function to all the models of an ensemble in parallel.
+    Soil profiles are passed to the workers through shared memory,
+    and results are written directly into a shared output buffer.
+
+    :param Ensemble ensemble:
+        the array-backed model ensemble
+
+    :param function func:
+        module-level function called as func(geo, *args) for each model,
+        with geo the dictionary of soil properties of the model;
+        it must return an array of the given shape
+
+    :param tuple shape:
+        shape of the result of each model
+
+    :param string dtype:
+        data type of the results
+
+    :param tuple args:
+        additional (picklable) arguments of the function
+
+    :param int processes:
+        number of worker processes (default is the number of cpus)
+
+    :param int chunk:
+        number of models per task (default splits the ensemble
+        in four tasks per process)
+
+    :param string work_dir:
+        directory of the shared files (default is SHARED_DIR)
+
+    :return numpy.array result:
+        array (models x shape) of the results (memory-mapped)
+    """
+
+    if processes is None:
+        processes = _mp.cpu_count()
+
+    mnum = len(ensemble)
+    if chunk is None:
+        chunk = max(1, -(-mnum//(4*processes)))
+
+    shared = share_ensemble(ensemble, work_dir)
+    shared['out'] = SharedArray.create((mnum,) + tuple(shape), dtype,
+                                       work_dir)
+
+    tasks = [(func, shared, i0, min(i0 + chunk, mnum), args)
+             for i0 in range(0, mnum, chunk)]
+
+    try:
+        if processes > 1:
+            # Workers are stopped also if a task fails
+            pool = _mp.Pool(processes)
+            try:
+                pool.map(_map_worker, tasks, 1)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for task in tasks:
+                _map_worker(task)
+
+        result = shared['out'].attach()
+
+    finally:
+        for value in shared['geo'].values():
+            value.unlink()
+        shared['lnum'].unlink()
+        shared['out'].unlink()
+
+    return result
+
+
+def _map_worker(task):
+    """
+    Internal: process a block of models in a worker
+    """
+
+    func, shared, i0, i1, args = task
+
+    geo = {key: value.attach('r') for key, value in shared['geo'].items()}
+    lnum = shared['lnum'].attach('r')
+    out = shared['out'].attach()
+
+    for nm in range(i0, i1):
+        model_geo = {key: _np.array(value[nm, :lnum[nm]])
+                     for key, value in geo.items()}
+        out[nm] = func(model_geo, *args)
+
+    del out
+
+
+# =============================================================================
+
+def sh_transfer_function(site, inc_ang=0., elastic=False, complex=False,
+                         processes=None, work_dir=None, attenuation=None):
+    """
+    Parallel version of Site1D.sh_transfer_function. Results are
+    stored into the site ensemble (without copy) and statistics
+    are updated as for the serial method.
+
+    :param Site1D site:
+        the site, with frequency axis already instantiated
+
+    :param float inc_ang:
+        angle of incidence in degrees, relative to the
+        vertical (default is vertical incidence)
+
+    :param boolean elastic:
+        switch between elastic and anelastic calculation
+        (default is anelastic)
+
+    :param boolean complex:
+        switch to output real (abs) or complex spectra
+
+    :param int processes:
+        number of worker processes (default is the number of cpus)
+
+    :param string work_dir:
+        directory of the shared files (default is SHARED_DIR)
+
+    :param attenuation.QModel attenuation:
+        attenuation model (default is constant Q)
+    """
+
+    site._check_frequency()
+
+    if not isinstance(site.model, _sdb.Ensemble):
+        site.model = _sdb.Ensemble.from_models(site.model)
+
+    if attenuation is None:
+        attenuation = _att.ConstantQ()
+
+    dtype = 'complex128' if complex else 'float64'
+    freq = _np.asarray(site.freq, dtype='float64')
+
+    result = ensemble_map(site.model, _sh_model, (len(freq),), dtype,
+                          (freq, inc_ang, elastic, complex, attenuation),
+                          processes, work_dir=work_dir)
+
+    site.model.set_array(('amp', 'shtf'), result)
+    site._update_stat(('amp', 'shtf'), log=not complex)
+
+
+def _sh_model(geo, freq, inc_ang, elastic, complex, attenuation):
+    """
+    Internal: SH-wave transfer function of a single model
+    (same convention of Site1D.sh_transfer_function); the
+    propagator is kept by each worker between consecutive
+    models, so that only shared layers are reused (no state
+    is kept per model, as workers change between calls)
+    """
+
+    global _shprop
+
+    if (_shprop is None or _shprop.inc_ang != inc_ang or
+            _shprop.attenuation != attenuation or
+            not _np.array_equal(_shprop.freq, freq)):
+        _shprop = _amp.SHPropagator(freq, inc_ang, attenuation=attenuation)
+
+    qs = geo['qs'] if not elastic else None
+
+    shtf = _shprop.transfer_function(geo['hl'], geo['vs'], geo['dn'], qs)
+
+    return shtf if complex else _np.abs(shtf)
+
+
+# =============================================================================
+
+def psv_transfer_function(site, inc_ang=0., wave='p', elastic=False,
+                          complex=False, processes=None, work_dir=None):
+    """
+    Parallel version of Site1D.psv_transfer_function. Results are
+    stored into the site ensemble (without copy) and statistics
+    are updated as for the serial method.
+
+    :param Site1D site:
+        the site, with frequency axis already instantiated
+
+    :param float inc_ang:
+        angle of incidence (as for sh_transfer_function)
+
+    :param string wave:
+        type of incident wave, 'p' (default) or 'sv'
+
+    :param boolean elastic:
+        switch between elastic and anelastic calculation
+        (default is anelastic)
+
+    :param boolean complex:
+        switch to output real (abs) or complex spectra
+
+    :param int processes:
+        number of worker processes (default is the number of cpus)
+
+    :param string work_dir:
+        directory of the shared files (default is SHARED_DIR)
+    """
+
+    site._check_frequency()
+
+    if not isinstance(site.model, _sdb.Ensemble):
+        site.model = _sdb.Ensemble.from_models(site.model)
+
+    dtype = 'complex128' if complex else 'float64'
+    freq = _np.asarray(site.freq, dtype='float64')
+
+    result = ensemble_map(site.model, _psv_model, (2, len(freq)), dtype,
+                          (freq, inc_ang, wave, elastic, complex),
+                          processes, work_dir=work_dir)
+
+    site.model.set_array(('amp', 'psv_r'), result[:, 0])
+    site.model.set_array(('amp', 'psv_z'), result[:, 1])
+    site._update_stat(('amp', 'psv_r'), log=not complex)
+    site._update_stat(('amp', 'psv_z'), log=not complex)
+
+
+def _psv_model(geo, freq, inc_ang, wave, elastic, complex):
+    """
+    Internal: P-SV transfer function of a single model
+    (same convention of Site1D.psv_transfer_function)
+    """
+
+    qp = geo['qp'] if not elastic else None
+    qs = geo['qs'] if not elastic else None
+
+    spec = _np.array(_amp.psv_transfer_function(freq, geo['hl'], geo['vp'],
+                                                geo['vs'], geo['dn'], qp, qs,
+                                                inc_ang, wave))
+
+    return spec if complex else _np.abs(spec)
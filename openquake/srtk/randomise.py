@@ -0,0 +1,187 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+"""
+Methods for the stochastic randomisation of one-dimensional soil
+profiles, following the approach of Toro (1995). Profiles are
+generated all together as stacked arrays (models x layers).
+"""
+
+import numpy as _np
+
+# =============================================================================
+# Constants & initialisation variables
+
+# Parameters of the Toro (1995) model for the inter-layer correlation
+# of the (log) shear-wave velocity, as (sigma, rho_0, delta,
+# rho_200, z_0, b) for different generic site conditions
+TORO_MODELS = {'USGS A': (0.36, 0.95, 3.4, 0.42, 0.0, 0.063),
+               'USGS B': (0.27, 0.97, 3.8, 1.00, 0.0, 0.293),
+               'USGS C': (0.31, 0.99, 3.9, 0.98, 0.0, 0.344),
+               'USGS D': (0.37, 0.00, 5.0, 0.50, 0.0, 0.744),
+               'USGS AB': (0.35, 0.95, 4.2, 1.00, 0.0, 0.138),
+               'USGS CD': (0.36, 0.99, 3.9, 0.98, 0.0, 0.344),
+               'Geomatrix AB': (0.46, 0.96, 13.1, 0.96, 0.0, 0.095),
+               'Geomatrix CD': (0.38, 0.99, 8.0, 1.00, 0.0, 0.160)}
+
+# Default exponents of the coupling between the velocity perturbation
+# and the other soil properties (1 means constant Vp/Vs ratio)
+COUPLING = {'vp': 1., 'dn': 0., 'qp': 0., 'qs': 0.}
+
+
+# =============================================================================
+
+def toro_correlation(depth, thickness, rho_0, delta, rho_200, z_0, b):
+    """
+    Compute the correlation coefficient of the (log) shear-wave
+    velocity between adjacent layers, according to Toro (1995).
+
+    :param float or numpy.array depth:
+        mid-depth between the centres of the adjacent layers in meters
+
+    :param float or numpy.array thickness:
+        distance between the centres of the adjacent layers in meters
+
+    :param float rho_0, delta:
+        parameters of the thickness-dependent correlation
+
+    :param float rho_200, z_0, b:
+        parameters of the depth-dependent correlation
+
+    :return float or numpy.array rho:
+        the inter-layer correlation coefficient
+    """
+
+    depth = _np.minimum(depth, 200.)
+
+    rho_d = rho_200*((depth + z_0)/(200. + z_0))**b
+    rho_t = rho_0*_np.exp(-thickness/delta)
+
+    rho = (1. - rho_d)*rho_t + rho_d
+
+    return rho
+
+
+# =============================================================================
+
+def toro_randomisation(geo, number, site='USGS C', vs_sigma=None,
+                       hl_sigma=0., trunc=2., vs_bounds=None,
+                       coupling=COUPLING, seed=None):
+    """
+    Generate a set of randomised soil profiles from a base model.
+    Layer thicknesses are perturbed independently (log-normal) while
+    shear-wave velocities are perturbed with inter-layer correlated
+    log-normal residuals (Toro, 1995). Other soil properties can be
+    coupled to the velocity perturbation through a power law.
+    The half-space thickness (0, or nan as in Model.geo) is preserved.
+
+    :param dict geo:
+        dictionary of the base model soil properties
+        (e.g. Model.geo); 'hl' and 'vs' are required
+
+    :param int number:
+        number of profiles to generate
+
+    :param string site:
+        key of the Toro (1995) generic site model in TORO_MODELS
+        (default is 'USGS C')
+
+    :param float vs_sigma:
+        standard deviation of the log velocity; if not given,
+        the value of the generic site model is used
+
+    :param float hl_sigma:
+        standard deviation of the log thickness
+        (default is 0, no thickness randomisation)
+
+    :param float trunc:
+        truncation of the residuals in number of standard deviations
+        (default is 2)
+
+    :param tuple vs_bounds:
+        minimum and maximum allowed velocity in m/s (optional)
+
+    :param dict coupling:
+        exponents of the power-law coupling between velocity
+        perturbation and other soil properties
+        (e.g. {'vp': 1., 'dn': 0.25})
+
+    :param int seed:
+        seed of the random generator (optional)
+
+    :return dict rnd_geo:
+        dictionary of stacked arrays (profiles x layers)
+        of the randomised soil properties
+    """
+
+    sigma, rho_0, delta, rho_200, z_0, b = TORO_MODELS[site]
+    if vs_sigma is not None:
+        sigma = vs_sigma
+
+    rnd = _np.random.RandomState(seed)
+
+    hl = _np.asarray(geo['hl'], dtype='float64')
+    vs = _np.asarray(geo['vs'], dtype='float64')
+    lnum = len(hl)
+
+    # Thickness randomisation (half-space excluded)
+    half = ~_np.isfinite(hl) | (hl == 0.)
+    eps = _np.clip(rnd.standard_normal((number, lnum)), -trunc, trunc)
+    rnd_hl = hl*_np.exp(hl_sigma*eps)
+    rnd_hl[:, half] = 0.
+
+    # Layer centres (top of the half-space for the last layer)
+    top = _np.cumsum(rnd_hl, axis=1) - rnd_hl
+    mid = top + rnd_hl/2.
+
+    # Inter-layer correlation
+    rho = toro_correlation((mid[:, 1:] + mid[:, :-1])/2.,
+                           mid[:, 1:] - mid[:, :-1],
+                           rho_0, delta, rho_200, z_0, b)
+
+    # Correlated standard normal residuals (vectorised over profiles)
+    eps = rnd.standard_normal((number, lnum))
+    for nl in range(1, lnum):
+        eps[:, nl] = (rho[:, nl-1]*eps[:, nl-1] +
+                      _np.sqrt(1. - rho[:, nl-1]**2)*eps[:, nl])
+    eps = _np.clip(eps, -trunc, trunc)
+
+    rnd_vs = vs*_np.exp(sigma*eps)
+    if vs_bounds is not None:
+        rnd_vs = _np.clip(rnd_vs, vs_bounds[0], vs_bounds[1])
+
+    # Coupling of the other soil properties
+    ratio = rnd_vs/vs
+
+    rnd_geo = {}
+    for key, value in geo.items():
+        value = _np.asarray(value, dtype='float64')
+        rnd_geo[key] = _np.tile(value, (number, 1))
+        if key in coupling:
+            rnd_geo[key] *= ratio**coupling[key]
+
+    rnd_hl[:, half] = hl[half]
+
+    rnd_geo['hl'] = rnd_hl
+    rnd_geo['vs'] = rnd_vs
+
+    return rnd_geo
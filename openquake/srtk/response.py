@@ -27,6 +27,9 @@ one-dimensional soil column.
 
 import numpy as _np
 
+import openquake.srtk.instrument as _ins
+import openquake.srtk.attenuation as _att
+
 
 # =============================================================================
 
@@ -115,6 +118,66 @@ def impedance_amplification(top_vs, top_dn, ref_vs=[], ref_dn=[], inc_ang=0.):
     return imp_amp
 
 
+def impedance_amplification_array(top_vs, top_dn, ref_vs, ref_dn, inc_ang=0.):
+    """
+    Vectorised impedance amplification (see impedance_amplification)
+    for a set of reference conditions and a set of models at once,
+    as for quarter-wavelength parameters of an ensemble.
+
+    Reference parameters and angles are given for each reference
+    condition, either as (references) arrays, the same for all the
+    models, or as (references x models) arrays, with a specific
+    value for each model. Scalars are a single reference condition.
+
+    :param numpy.array top_vs:
+        array (models x frequencies) of topmost shear-wave
+        velocities in m/s
+
+    :param numpy.array top_dn:
+        array (models x frequencies) of topmost densities in kg/m3
+
+    :param float or numpy.array ref_vs:
+        reference shear-wave velocities in m/s
+
+    :param float or numpy.array ref_dn:
+        reference densities in kg/m3
+
+    :param float or numpy.array inc_ang:
+        angles of incidence in degrees, relative to the vertical
+        (default is vertical incidence)
+
+    :return numpy.array imp_amp:
+        amplification (references x models x frequencies)
+    """
+
+    def reference(value):
+        value = _np.asarray(value, dtype='float64')
+        if value.ndim < 2:
+            value = value.reshape(-1, 1)
+        return value[:, :, None]
+
+    top_vs = _np.atleast_2d(_np.asarray(top_vs, dtype='float64'))
+    top_dn = _np.atleast_2d(_np.asarray(top_dn, dtype='float64'))
+    ref_vs = reference(ref_vs)
+    ref_dn = reference(ref_dn)
+    inc_ang = reference(inc_ang)*(_np.pi/180.)
+
+    # Computing square-root impedance amplification
+    imp_amp = _np.sqrt((ref_dn*ref_vs)/(top_dn*top_vs))
+
+    # Correcting for non-vertical incidence (Snell's law)
+    if _np.any(inc_ang > 0.):
+        eff_ang = _np.arcsin((top_vs/ref_vs)*_np.sin(inc_ang))
+        imp_amp = imp_amp*_np.sqrt(_np.cos(inc_ang)/_np.cos(eff_ang))
+
+    # Same angle for all reference conditions
+    shape = _np.broadcast(imp_amp, inc_ang).shape
+    if imp_amp.shape != shape:
+        imp_amp = _np.broadcast_to(imp_amp, shape).copy()
+
+    return imp_amp
+
+
 # =============================================================================
 
 def attenuation_decay(freq, kappa):
@@ -140,12 +203,15 @@ def attenuation_decay(freq, kappa):
 
 # =============================================================================
 
-def sh_transfer_function(freq, hl, vs, dn, qs=None, inc_ang=0., depth=0.):
+@_ins.timed('response.sh_transfer_function')
+def sh_transfer_function(freq, hl, vs, dn, qs=None, inc_ang=0., depth=0.,
+                         attenuation=None):
     """
     Compute the SH-wave transfer function using Knopoff formalism
     (implicit layer matrix scheme). Calculation can be done for an
     arbitrary angle of incidence (0-90), with or without anelastic
-    attenuation (qs is optional).
+    attenuation (qs is optional, with constant or frequency-dependent
+    quality factors, see the attenuation module).
 
     It return the displacements computed at arbitrary depth.
     If depth = -1, calculation is done at each layer interface
@@ -178,6 +244,9 @@ def sh_transfer_function(freq, hl, vs, dn, qs=None, inc_ang=0., depth=0.):
         dephts in meters at which displacements are calculated
         (default is the free surface)
 
+    :param attenuation.QModel attenuation:
+        attenuation model (default is constant Q)
+
     :return numpy.array dis_mat:
         matrix of displacements computed at each depth (complex)
     """
@@ -199,9 +268,16 @@ def sh_transfer_function(freq, hl, vs, dn, qs=None, inc_ang=0., depth=0.):
     dn = _np.array(dn, dtype=CTP)
 
     # Attenuation using complex velocities
+    # (layers x frequencies, if frequency-dependent)
     if qs is not None:
+        if attenuation is None:
+            attenuation = _att.ConstantQ()
         qs = _np.array(qs, dtype=CTP)
-        vs *= ((2.*qs*1j)/(2.*qs*1j-1.))
+        if attenuation.dependent:
+            vs = attenuation.complex_velocity(freq, vs.real, qs.real)
+            dn = dn[:, None]
+        else:
+            vs *= ((2.*qs*1j)/(2.*qs*1j-1.))
 
     # Conversion to angular frequency
     angf = 2.*_np.pi*freq
@@ -220,17 +296,22 @@ def sh_transfer_function(freq, hl, vs, dn, qs=None, inc_ang=0., depth=0.):
     # -------------------------------------------------------------------------
     # Computing angle of propagation within layers
 
-    iD = _np.zeros(lnum, dtype=CTP)
-    iM = _np.zeros((lnum, lnum), dtype=CTP)
+    if vs.ndim == 1:
+        iD = _np.zeros(lnum, dtype=CTP)
+        iM = _np.zeros((lnum, lnum), dtype=CTP)
 
-    iD[0] = _np.sin(inc_ang)
-    iM[0, -1] = 1.
+        iD[0] = _np.sin(inc_ang)
+        iM[0, -1] = 1.
 
-    for nl in range(lnum-1):
-        iM[nl+1, nl] = 1./vs[nl]
-        iM[nl+1, nl+1] = -1./vs[nl+1]
+        for nl in range(lnum-1):
+            iM[nl+1, nl] = 1./vs[nl]
+            iM[nl+1, nl+1] = -1./vs[nl+1]
+
+        iA = _np.linalg.solve(iM, iD)
+    else:
+        # Snell's law at each frequency
+        iA = _np.sin(inc_ang)*vs/vs[-1]
 
-    iA = _np.linalg.solve(iM, iD)
     iS = _np.arcsin(iA)
 
     # -------------------------------------------------------------------------
@@ -242,6 +323,10 @@ def sh_transfer_function(freq, hl, vs, dn, qs=None, inc_ang=0., depth=0.):
     # Horizontal slowness
     ns = _np.cos(iS)/vs
 
+    # Parameters at each frequency (layers x frequencies)
+    mu = _np.broadcast_to(mu.reshape(lnum, -1), (lnum, fnum))
+    ns = _np.broadcast_to(ns.reshape(lnum, -1), (lnum, fnum))
+
     # -------------------------------------------------------------------------
     # Data vector initialisation
 
@@ -258,6 +343,9 @@ def sh_transfer_function(freq, hl, vs, dn, qs=None, inc_ang=0., depth=0.):
     # Output layer's displacement matrix
     dis_mat = _np.zeros((znum, fnum), dtype=CTP)
 
+    # Number of failed linear solves
+    failed = 0
+
     # -------------------------------------------------------------------------
     # Loop over frequencies
 
@@ -275,8 +363,8 @@ def sh_transfer_function(freq, hl, vs, dn, qs=None, inc_ang=0., depth=0.):
             row = (nl*2)+1
             col = nl*2
 
-            exp_dsa = _np.exp(1j*angf[nf]*ns[nl]*hl[nl])
-            exp_usa = _np.exp(-1j*angf[nf]*ns[nl]*hl[nl])
+            exp_dsa = _np.exp(1j*angf[nf]*ns[nl, nf]*hl[nl])
+            exp_usa = _np.exp(-1j*angf[nf]*ns[nl, nf]*hl[nl])
 
             # Displacement continuity conditions
             lay_mat[row, col+0] = exp_dsa
@@ -285,10 +373,10 @@ def sh_transfer_function(freq, hl, vs, dn, qs=None, inc_ang=0., depth=0.):
             lay_mat[row, col+3] = -1.
 
             # Stress continuity conditions
-            lay_mat[row+1, col+0] = mu[nl]*ns[nl]*exp_dsa
-            lay_mat[row+1, col+1] = -mu[nl]*ns[nl]*exp_usa
-            lay_mat[row+1, col+2] = -mu[nl+1]*ns[nl+1]
-            lay_mat[row+1, col+3] = mu[nl+1]*ns[nl+1]
+            lay_mat[row+1, col+0] = mu[nl, nf]*ns[nl, nf]*exp_dsa
+            lay_mat[row+1, col+1] = -mu[nl, nf]*ns[nl, nf]*exp_usa
+            lay_mat[row+1, col+2] = -mu[nl+1, nf]*ns[nl+1, nf]
+            lay_mat[row+1, col+3] = mu[nl+1, nf]*ns[nl+1, nf]
 
         # Input motion constraints
         lay_mat[-1, -1] = 1.
@@ -298,6 +386,7 @@ def sh_transfer_function(freq, hl, vs, dn, qs=None, inc_ang=0., depth=0.):
             amp_vec = _np.linalg.solve(lay_mat, inp_vec)
         except:
             amp_vec[:] = _np.nan
+            failed += 1
 
         # ---------------------------------------------------------------------
         # Solving displacements at depth
@@ -317,17 +406,742 @@ def sh_transfer_function(freq, hl, vs, dn, qs=None, inc_ang=0., depth=0.):
                 dh = depth[nz] - bounds[nl]
 
             # Displacement of the up-going and down-going waves
-            exp_dsa = _np.exp(1j*angf[nf]*ns[nl]*dh)
-            exp_usa = _np.exp(-1j*angf[nf]*ns[nl]*dh)
+            exp_dsa = _np.exp(1j*angf[nf]*ns[nl, nf]*dh)
+            exp_usa = _np.exp(-1j*angf[nf]*ns[nl, nf]*dh)
 
             dis_dsa = amp_vec[nl*2]*exp_dsa
             dis_usa = amp_vec[nl*2+1]*exp_usa
 
             dis_mat[nz, nf] = dis_dsa + dis_usa
 
+    _ins.count('solves', fnum + 1)
+    _ins.count('failed', failed)
+
     return dis_mat
 
 
+# =============================================================================
+
+class SHPropagator(object):
+    """
+    SH-wave transfer function at the surface, for outcropping rock
+    reference conditions, by the Thomson-Haskell propagator method
+    (vectorised over frequency). It is equivalent to the surface
+    displacement of sh_transfer_function (halved).
+
+    Propagator terms are cached, so that recomputing the response
+    after editing some layers only involves the changed layers:
+    the terms of each layer and the partial products of the propagator
+    from the free surface down to each interface are kept, and the
+    half-space term is kept separately. Changes are tracked by comparing
+    the layer parameters with those of the previous call for the same
+    model (this includes in-place edits of the model arrays). Models
+    are identified by a key (e.g. the index in the ensemble), and the
+    state of up to state_size models is kept; other models are compared
+    with the previous call. The propagator terms of each distinct layer
+    are also cached (up to cache_size layers), so that when models share
+    some layers (e.g. the half-space) their terms are computed once.
+
+    With frequency-dependent attenuation models, complex velocities
+    are evaluated over the whole frequency axis when computing the
+    terms of each distinct layer.
+
+    :param numpy.array freq:
+        array of frequencies in Hz for the calculation
+
+    :param float inc_ang:
+        angle of incidence (see sh_transfer_function)
+
+    :param int cache_size:
+        maximum number of cached layer terms (default 256)
+
+    :param attenuation.QModel attenuation:
+        attenuation model (default is constant Q)
+
+    :param int state_size:
+        maximum number of models whose state is kept
+        (default 0, previous call only)
+    """
+
+    def __init__(self, freq, inc_ang=0., cache_size=256, attenuation=None,
+                 state_size=0):
+
+        self.freq = _np.array(freq, dtype='float64', ndmin=1)
+        self.inc_ang = inc_ang
+        self.cache_size = cache_size
+        self.state_size = state_size
+
+        if attenuation is None:
+            attenuation = _att.ConstantQ()
+        self.attenuation = attenuation
+
+        self._angf = 2.*_np.pi*self.freq
+        self._terms = {}
+
+        # Number of layer terms applied in the last calculation
+        self.updated = 0
+
+        self.reset()
+
+    def reset(self):
+        """
+        Clear the cached partial products and model states.
+        """
+
+        self._layers = []
+        self._prefix = []
+        self._bottom = None
+        self._lterms = []
+        self._states = {}
+
+    # -------------------------------------------------------------------------
+
+    @_ins.timed('response.SHPropagator')
+    def transfer_function(self, hl, vs, dn, qs=None, key=None):
+        """
+        Compute the (complex) transfer function of a soil profile.
+
+        :param numpy.array hl:
+            array of layer's thicknesses in meters (half-space is 0.)
+
+        :param numpy.array vs:
+            array of layer's shear-wave velocities in m/s
+
+        :param numpy.array dn:
+            array of layer's densities in kg/m3
+
+        :param numpy.array qs:
+            array of layer's shear-wave quality factors
+            (optional, elastic if not given)
+
+        :param key:
+            hashable identifier of the model, whose state is kept
+            (optional, the profile is compared with the previous call)
+
+        :return numpy.array shtf:
+            complex transfer function
+        """
+
+        layers = self._profile(hl, vs, dn, qs)
+        lnum = len(layers)
+
+        # State of the model (or of the previous call)
+        if key is not None and key in self._states:
+            old, prefix, bottom, terms = self._states[key]
+        else:
+            old, prefix, bottom, terms = (self._layers, self._prefix,
+                                          self._bottom, self._lterms)
+
+        # Unchanged layers from the free surface
+        top = 0
+        while (top < min(lnum, len(old)) - 1 and layers[top] == old[top]):
+            top += 1
+
+        if not old or layers[-1] != old[-1]:
+            bottom = self._halfspace(layers[-1])
+
+        # Terms of the unchanged layers are reused
+        terms = [terms[nl] if nl < len(terms) and layers[nl] == old[nl]
+                 else self._term(layers[nl]) for nl in range(lnum - 1)]
+
+        # Propagation (from the last valid interface)
+        prefix = prefix[:min(top, len(prefix) - 1) + 1]
+        if not prefix:
+            prefix = [(_np.ones_like(self._angf, dtype='complex128'),
+                       _np.zeros_like(self._angf, dtype='complex128'))]
+
+        self.updated = 0
+        for nl in range(len(prefix) - 1, lnum - 1):
+            prefix.append(self._apply(terms[nl], prefix[-1]))
+            self.updated += 1
+
+        _ins.count('updates', self.updated)
+
+        self._layers = layers
+        self._prefix = prefix
+        self._bottom = bottom
+        self._lterms = terms
+
+        if key is not None and (key in self._states or
+                                len(self._states) < self.state_size):
+            self._states[key] = (layers, prefix, bottom, terms)
+
+        dis, tau = prefix[-1]
+
+        return 1./(dis + bottom*tau)
+
+    # -------------------------------------------------------------------------
+
+    @_ins.timed('response.SHPropagator.jacobian')
+    def jacobian(self, hl, vs, dn, qs=None, complex=True, key=None):
+        """
+        Compute the transfer function of a soil profile together
+        with its derivatives with respect to the layer parameters.
+        Derivatives are analytic (adjoint method): a single backward
+        sweep over the propagator terms of the forward solution.
+
+        :param numpy.array hl:
+            array of layer's thicknesses in meters (half-space is 0.)
+
+        :param numpy.array vs:
+            array of layer's shear-wave velocities in m/s
+
+        :param numpy.array dn:
+            array of layer's densities in kg/m3
+
+        :param numpy.array qs:
+            array of layer's shear-wave quality factors
+            (optional, elastic if not given)
+
+        :param boolean complex:
+            switch between derivatives of the complex transfer
+            function (default) or of its modulus
+
+        :param key:
+            identifier of the model (see transfer_function)
+
+        :return numpy.array shtf:
+            transfer function (complex or modulus)
+
+        :return dict jac:
+            derivatives as (frequencies x layers) arrays for each
+            parameter ('hl', 'vs', 'dn' and, if given, 'qs');
+            derivatives with respect to the half-space thickness
+            are zero
+        """
+
+        shtf = self.transfer_function(hl, vs, dn, qs, key)
+
+        layers = self._layers
+        lnum = len(layers)
+        angf = self._angf[:, None]
+
+        # Velocity and slowness as (frequencies x layers) arrays
+        # with frequency-dependent attenuation
+        h, v, rho, n = [_np.array(p).T
+                        for p in zip(*map(self._values, layers))]
+        imp = rho*(v**2.)*n
+
+        # Derivatives of the denominator of the transfer function
+        # with respect to the complex velocity (at fixed slowness),
+        # vertical slowness, density and thickness
+        shape = (len(self.freq), lnum)
+        d_v = _np.zeros(shape, dtype='complex128')
+        d_n = _np.zeros(shape, dtype='complex128')
+        d_dn = _np.zeros(shape, dtype='complex128')
+        d_hl = _np.zeros(shape, dtype='complex128')
+
+        # Half-space (radiation condition)
+        dis, tau = self._prefix[-1]
+        d_imp = -tau*self._bottom/imp[..., -1]
+        d_v[:, -1] = d_imp*2.*rho[-1]*v[..., -1]*n[..., -1]
+        d_n[:, -1] = d_imp*rho[-1]*(v[..., -1]**2.)
+        d_dn[:, -1] = d_imp*(v[..., -1]**2.)*n[..., -1]
+
+        # Adjoint sweep from the half-space to the free surface
+        adj0 = _np.ones_like(self._angf, dtype='complex128')
+        adj1 = self._bottom
+
+        for nl in range(lnum - 2, -1, -1):
+            cs, sz, zs = self._lterms[nl]
+            dis, tau = self._prefix[nl]
+            wz = self._angf*imp[..., nl]
+            sn = sz*wz
+
+            # Phase (kh) and impedance terms
+            d_kh = adj0*(cs*tau/wz - sn*dis) - adj1*(wz*cs*dis + sn*tau)
+            d_imp = -sn*(adj0*tau/(wz*imp[..., nl]) + adj1*self._angf*dis)
+
+            d_hl[:, nl] = d_kh*self._angf*n[..., nl]
+            d_n[:, nl] = (d_kh*self._angf*h[nl] +
+                          d_imp*rho[nl]*(v[..., nl]**2.))
+            d_v[:, nl] = d_imp*2.*rho[nl]*v[..., nl]*n[..., nl]
+            d_dn[:, nl] = d_imp*(v[..., nl]**2.)*n[..., nl]
+
+            adj0, adj1 = adj0*cs + adj1*zs, adj0*sz + adj1*cs
+
+        # Horizontal slowness depends on the half-space velocity
+        ps = _np.reshape(_np.sin(self.inc_ang)/v[..., -1], (-1, 1))
+        if _np.any(ps != 0.):
+            d_v[:, -1] -= _np.sum(d_n*(-ps/n), axis=1)*ps[:, 0]/v[..., -1]
+
+        # Vertical slowness depends on the velocity
+        d_v += d_n*(-1./((v**3.)*n))
+
+        # From complex to (real) velocity and quality factor
+        jac = {'hl': d_hl, 'dn': d_dn}
+        if qs is not None and self.attenuation.dependent:
+            d_vs, d_qs = self.attenuation.derivatives(
+                self.freq, _np.real(vs), _np.real(qs))
+            jac['vs'] = d_v*d_vs.T
+            jac['qs'] = d_v*d_qs.T
+        elif qs is not None:
+            qs = _np.array(qs, dtype='complex128')
+            den = 2.*qs*1j - 1.
+            jac['vs'] = d_v*(2.*qs*1j)/den
+            jac['qs'] = d_v*_np.real(vs)*(-2j)/(den**2.)
+        else:
+            jac['vs'] = d_v
+
+        # From the denominator to the transfer function
+        for key in jac:
+            jac[key] *= -(shtf[:, None]**2.)
+            if not complex:
+                jac[key] = (_np.real(_np.conj(shtf)[:, None]*jac[key]) /
+                            _np.abs(shtf)[:, None])
+
+        return (shtf if complex else _np.abs(shtf)), jac
+
+    # -------------------------------------------------------------------------
+
+    def _profile(self, hl, vs, dn, qs):
+        """
+        Internal: per-layer parameters (thickness, complex velocity,
+        density, horizontal slowness) as hashable tuples; with
+        frequency-dependent attenuation, thickness, velocity, density
+        and quality factor of the layer and, for oblique incidence,
+        velocity and quality factor of the half-space
+        """
+
+        hl = _np.nan_to_num(_np.array(hl, dtype='float64'))
+        vs = _np.array(vs, dtype='complex128')
+        dn = _np.array(dn, dtype='float64')
+
+        if qs is not None and self.attenuation.dependent:
+            vs = _np.real(vs).tolist()
+            qs = _np.real(_np.array(qs, dtype='complex128')).tolist()
+            half = (None, None)
+            if _np.sin(self.inc_ang) != 0.:
+                half = (vs[-1], qs[-1])
+
+            hl[-1] = 0.
+
+            return [(h, v, d, q) + half
+                    for h, v, d, q in zip(hl.tolist(), vs, dn.tolist(), qs)]
+
+        # Attenuation using complex velocities
+        if qs is not None:
+            qs = _np.array(qs, dtype='complex128')
+            vs *= ((2.*qs*1j)/(2.*qs*1j-1.))
+
+        # Snell's law (horizontal slowness of the half-space)
+        ps = _np.sin(self.inc_ang)/vs[-1]
+        ns = _np.cos(_np.arcsin(ps*vs))/vs
+
+        hl[-1] = 0.
+
+        return list(zip(hl.tolist(), vs.tolist(), dn.tolist(), ns.tolist()))
+
+    def _values(self, layer):
+        """
+        Internal: thickness, complex velocity, density and horizontal
+        slowness of a layer (arrays over frequency with frequency-
+        dependent attenuation)
+        """
+
+        if len(layer) == 4:
+            return layer
+
+        hl, vs, dn, qs, vh, qh = layer
+
+        if vh is None:
+            vs = self.attenuation.complex_velocity(self.freq, vs, qs)
+            ps = 0.
+        else:
+            vs, vh = self.attenuation.complex_velocity(self.freq, [vs, vh],
+                                                       [qs, qh])
+            ps = _np.sin(self.inc_ang)/vh
+
+        ns = _np.cos(_np.arcsin(ps*vs))/vs
+
+        return hl, vs, dn, ns
+
+    def _term(self, layer):
+        """
+        Internal: propagator terms of a layer (cached)
+        """
+
+        term = self._terms.get(layer)
+
+        if term is None:
+            hl, vs, dn, ns = self._values(layer)
+            wz = self._angf*dn*(vs**2.)*ns
+            kh = self._angf*ns*hl
+            term = (_np.cos(kh), _np.sin(kh)/wz, -wz*_np.sin(kh))
+
+            if len(self._terms) >= self.cache_size:
+                self._terms.clear()
+            self._terms[layer] = term
+
+        return term
+
+    def _halfspace(self, layer):
+        """
+        Internal: coefficient of the stress (normalised by the
+        angular frequency) in the up-going wave of the half-space
+        """
+
+        hl, vs, dn, ns = self._values(layer)
+
+        return 1j/(self._angf*dn*(vs**2.)*ns)
+
+    @staticmethod
+    def _apply(term, state):
+        """
+        Internal: propagate displacement and stress across a layer
+        """
+
+        cs, sz, zs = term
+        dis, tau = state
+
+        return (cs*dis + sz*tau, zs*dis + cs*tau)
+
+
+def sh_transfer_jacobian(freq, hl, vs, dn, qs=None, inc_ang=0.,
+                         complex=True, attenuation=None):
+    """
+    SH-wave transfer function at the surface (outcropping rock
+    reference) and its analytic derivatives with respect to the
+    layer parameters (see SHPropagator.jacobian).
+
+    :param numpy.array freq:
+        array of frequencies in Hz for the calculation
+
+    :param numpy.array hl:
+        array of layer's thicknesses in meters (half-space is 0.)
+
+    :param numpy.array vs:
+        array of layer's shear-wave velocities in m/s
+
+    :param numpy.array dn:
+        array of layer's densities in kg/m3
+
+    :param numpy.array qs:
+        array of layer's shear-wave quality factors
+        (optional, elastic if not given)
+
+    :param float inc_ang:
+        angle of incidence (see sh_transfer_function)
+
+    :param boolean complex:
+        switch between complex transfer function (default)
+        or modulus
+
+    :param attenuation.QModel attenuation:
+        attenuation model (default is constant Q)
+
+    :return numpy.array shtf:
+        transfer function
+
+    :return dict jac:
+        derivatives as (frequencies x layers) arrays for
+        each parameter ('hl', 'vs', 'dn' and 'qs')
+    """
+
+    prop = SHPropagator(freq, inc_ang, attenuation=attenuation)
+
+    return prop.jacobian(hl, vs, dn, qs, complex)
+
+
+def sh_transfer_function_array(freq, hl, vs, dn, qs=None, inc_ang=0.,
+                               attenuation=None):
+    """
+    Vectorised SH-wave transfer function at the surface (outcropping
+    rock reference) for a set of profiles stored as (models x layers)
+    arrays, by the propagator method (see SHPropagator). Profiles can
+    have a different number of layers, padded with nans (the last valid
+    layer of each profile is the half-space).
+
+    :param numpy.array freq:
+        array of frequencies in Hz for the calculation
+
+    :param numpy.array hl:
+        array (models x layers) of layer's thicknesses in meters
+
+    :param numpy.array vs:
+        array (models x layers) of layer's shear-wave velocities in m/s
+
+    :param numpy.array dn:
+        array (models x layers) of layer's densities in kg/m3
+
+    :param numpy.array qs:
+        array (models x layers) of layer's shear-wave quality factors
+        (optional, elastic if not given)
+
+    :param float inc_ang:
+        angle of incidence (see sh_transfer_function)
+
+    :param attenuation.QModel attenuation:
+        attenuation model (default is constant Q)
+
+    :return numpy.array shtf:
+        complex transfer function (models x frequencies)
+    """
+
+    freq = _np.array(freq, dtype='float64', ndmin=1)
+    angf = 2.*_np.pi*freq
+
+    hl = _np.atleast_2d(_np.asarray(hl, dtype='float64'))
+    vs = _np.atleast_2d(_np.array(vs, dtype='complex128'))
+    dn = _np.atleast_2d(_np.asarray(dn, dtype='float64'))
+
+    valid = ~_np.isnan(vs.real)
+    last = _np.sum(valid, axis=1) - 1
+    index = _np.arange(len(last))
+
+    # Attenuation using complex velocities
+    if attenuation is None:
+        attenuation = _att.ConstantQ()
+    if qs is not None:
+        qs = _np.atleast_2d(_np.array(qs, dtype='complex128'))
+        if attenuation.dependent:
+            vs = attenuation.complex_velocity(freq, vs.real, qs.real)
+        else:
+            vs *= ((2.*qs*1j)/(2.*qs*1j-1.))
+
+    # Parameters as (models x layers x frequencies) arrays
+    # (single frequency for frequency-independent velocities)
+    if vs.ndim == 2:
+        vs = vs[:, :, None]
+    valid = valid[:, :, None]
+    hl = hl[:, :, None]
+    dn = dn[:, :, None]
+
+    # Padding (and half-space) layers have identity propagators
+    hl = _np.where(valid, _np.nan_to_num(hl), 0.)
+    hl[index, last] = 0.
+    vs = _np.where(valid, vs, 1.)
+    dn = _np.where(valid, dn, 1.)
+
+    # Snell's law (horizontal slowness of the half-space)
+    ps = _np.sin(inc_ang)/vs[index, last]
+    ns = _np.cos(_np.arcsin(ps[:, None]*vs))/vs
+    imp = dn*(vs**2.)*ns
+
+    dis = _np.ones((len(last), len(angf)), dtype='complex128')
+    tau = _np.zeros((len(last), len(angf)), dtype='complex128')
+
+    for nl in range(vs.shape[1] - 1):
+        wz = angf*imp[:, nl]
+        kh = angf*(ns*hl)[:, nl]
+        cs = _np.cos(kh)
+        sn = _np.sin(kh)
+        dis, tau = cs*dis + sn*tau/wz, cs*tau - wz*sn*dis
+
+    bottom = 1j/(angf*imp[index, last])
+
+    return 1./(dis + bottom*tau)
+
+
+# =============================================================================
+
+def psv_transfer_function(freq, hl, vp, vs, dn, qp=None, qs=None, inc_ang=0.,
+                          wave='p'):
+    """
+    Compute the P-SV transfer function (radial and vertical components)
+    at the surface for outcropping rock reference conditions, for an
+    incident P or SV plane wave of arbitrary angle of incidence.
+    The Thomson-Haskell propagator is used, vectorised over frequency.
+
+    Both components are normalised by the modulus of the surface
+    displacement of the outcropping half-space for the same incident
+    wave (2 for vertical incidence), with the phase of its component
+    along the incident motion (vertical for P, radial for SV).
+    At vertical incidence, the radial (SV) and vertical (P) components
+    reduce to the SH-wave transfer function of the shear and
+    compressional properties.
+
+    :param numpy.array freq:
+        array of frequencies in Hz for the calculation
+
+    :param numpy.array hl:
+        array of layer's thicknesses in meters (half-space is 0.)
+
+    :param numpy.array vp:
+        array of layer's compressional-wave velocities in m/s
+
+    :param numpy.array vs:
+        array of layer's shear-wave velocities in m/s
+
+    :param numpy.array dn:
+        array of layer's densities in kg/m3
+
+    :param numpy.array qp:
+        array of layer's compressional-wave quality factors
+        (optional, elastic if not given)
+
+    :param numpy.array qs:
+        array of layer's shear-wave quality factors
+        (optional, elastic if not given)
+
+    :param float inc_ang:
+        angle of incidence (see sh_transfer_function)
+
+    :param string wave:
+        type of incident wave, 'p' (default) or 'sv'
+
+    :return numpy.array radial:
+        complex transfer function of the radial component
+
+    :return numpy.array vertical:
+        complex transfer function of the vertical component
+    """
+
+    qp = None if qp is None else [qp]
+    qs = None if qs is None else [qs]
+
+    radial, vertical = psv_transfer_function_array(freq, [hl], [vp], [vs],
+                                                   [dn], qp, qs, inc_ang,
+                                                   wave)
+
+    return radial[0], vertical[0]
+
+
+@_ins.timed('response.psv_transfer_function')
+def psv_transfer_function_array(freq, hl, vp, vs, dn, qp=None, qs=None,
+                                inc_ang=0., wave='p'):
+    """
+    Vectorised P-SV transfer function at the surface (see
+    psv_transfer_function) for a set of profiles stored as
+    (models x layers) arrays. Profiles can have a different number
+    of layers, padded with nans (the last valid layer of each profile
+    is the half-space).
+
+    :param numpy.array freq:
+        array of frequencies in Hz for the calculation
+
+    :param numpy.array hl, vp, vs, dn:
+        arrays (models x layers) of layer's thicknesses,
+        velocities and densities
+
+    :param numpy.array qp, qs:
+        arrays (models x layers) of layer's quality factors
+        (optional, elastic if not given)
+
+    :param float inc_ang:
+        angle of incidence (see sh_transfer_function)
+
+    :param string wave:
+        type of incident wave, 'p' (default) or 'sv'
+
+    :return numpy.array radial:
+        complex transfer function of the radial component
+        (models x frequencies)
+
+    :return numpy.array vertical:
+        complex transfer function of the vertical component
+        (models x frequencies)
+    """
+
+    if wave not in ['p', 'sv']:
+        raise ValueError('Unknown wave type: {0}'.format(wave))
+
+    angf = 2.*_np.pi*_np.array(freq, dtype='float64', ndmin=1)
+
+    hl = _np.atleast_2d(_np.asarray(hl, dtype='float64'))
+    vp = _np.atleast_2d(_np.array(vp, dtype='complex128'))
+    vs = _np.atleast_2d(_np.array(vs, dtype='complex128'))
+    dn = _np.atleast_2d(_np.array(dn, dtype='float64'))
+
+    valid = ~_np.isnan(vs.real)
+    last = _np.sum(valid, axis=1) - 1
+    index = _np.arange(len(last))
+
+    # Attenuation using complex velocities
+    for vel, qual in [(vp, qp), (vs, qs)]:
+        if qual is not None:
+            qual = _np.atleast_2d(_np.array(qual, dtype='complex128'))
+            vel *= ((2.*qual*1j)/(2.*qual*1j-1.))
+
+    # Padding layers are copies of the half-space (identity propagators)
+    hl = _np.where(valid, _np.nan_to_num(hl), 0.)
+    hl[index, last] = 0.
+    for par in [vp, vs, dn]:
+        par[:] = _np.where(valid, par, par[index, last, None])
+
+    # Snell's law (horizontal slowness of the incident wave)
+    vel = vp if wave == 'p' else vs
+    ps = _np.sin(inc_ang)/vel[index, last]
+
+    # Surface displacement (radial and vertical) for unit incident
+    # wave, with layers and for the outcropping half-space
+    disp = _psv_surface(angf, hl, vp, vs, dn, ps, wave)
+    rock = _psv_surface(angf[:1], hl[:, -1:], vp[:, -1:], vs[:, -1:],
+                        dn[:, -1:], ps, wave)
+
+    # Modulus of the half-space displacement, with the phase of the
+    # component of the incident motion (vertical for P, radial for SV)
+    main = rock[1] if wave == 'p' else rock[0]
+    norm = _np.sqrt(_np.abs(rock[0])**2. + _np.abs(rock[1])**2.)
+    norm = norm*main/_np.abs(main)
+
+    return disp[0]/norm, disp[1]/norm
+
+
+def _psv_matrix(ps, vp, vs, dn):
+    """
+    Internal: layer matrix of the P-SV motion-stress vector
+    (radial and vertical displacement, shear and normal stress
+    over the angular frequency) for the down-going P and SV and the
+    up-going P and SV waves, and the vertical slowness of the waves
+    """
+
+    eta_p = _np.sqrt(1./vp**2. - ps**2.)
+    eta_s = _np.sqrt(1./vs**2. - ps**2.)
+    mu = dn*vs**2.
+
+    mat = _np.zeros(ps.shape + (4, 4), dtype='complex128')
+
+    for col, sign in [(0, 1.), (2, -1.)]:
+        eta = sign*eta_p
+        mat[..., 0, col] = ps*vp
+        mat[..., 1, col] = eta*vp
+        mat[..., 2, col] = 2.*mu*ps*eta*vp
+        mat[..., 3, col] = dn*vp*(1. - 2.*(vs*ps)**2.)
+
+    for col, sign in [(1, 1.), (3, -1.)]:
+        eta = sign*eta_s
+        mat[..., 0, col] = eta*vs
+        mat[..., 1, col] = -ps*vs
+        mat[..., 2, col] = mu*vs*(eta**2. - ps**2.)
+        mat[..., 3, col] = -2.*mu*ps*eta*vs
+
+    eta = _np.stack((eta_p, eta_s, -eta_p, -eta_s), axis=-1)
+
+    return mat, eta
+
+
+def _psv_surface(angf, hl, vp, vs, dn, ps, wave):
+    """
+    Internal: surface displacement (radial and vertical)
+    for a unit-amplitude incident wave
+    """
+
+    # Motion-stress vectors of unit surface displacements
+    # (stress-free surface), propagated to the half-space
+    state = _np.zeros((len(ps), len(angf), 4, 2), dtype='complex128')
+    state[..., 0, 0] = 1.
+    state[..., 1, 1] = 1.
+
+    for nl in range(hl.shape[1] - 1):
+        mat, eta = _psv_matrix(ps, vp[:, nl], vs[:, nl], dn[:, nl])
+        phase = _np.exp(1j*angf[:, None]*eta[:, None, :]*hl[:, nl, None, None])
+
+        amp = _np.matmul(_np.linalg.inv(mat)[:, None], state)
+        state = _np.matmul(mat[:, None], phase[..., None]*amp)
+
+    # Up-going waves in the half-space (incident wave only)
+    mat, eta = _psv_matrix(ps, vp[:, -1], vs[:, -1], dn[:, -1])
+    up = _np.matmul(_np.linalg.inv(mat)[:, None, 2:], state)
+
+    det = up[..., 0, 0]*up[..., 1, 1] - up[..., 0, 1]*up[..., 1, 0]
+
+    if wave == 'p':
+        return up[..., 1, 1]/det, -up[..., 1, 0]/det
+    else:
+        return -up[..., 0, 1]/det, up[..., 0, 0]/det
+
+
 # =============================================================================
 
 def interface_depth(hl, dtype='float64'):
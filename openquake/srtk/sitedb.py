@@ -24,22 +24,46 @@
 Module containing the database classes to handle site information.
 """
 
+try:
+    from collections.abc import Mapping as _Mapping
+    from collections.abc import MutableMapping as _MutableMapping
+except ImportError:
+    from collections import Mapping as _Mapping
+    from collections import MutableMapping as _MutableMapping
+
+import os as _os
+import tempfile as _tmp
 import numpy as _np
+import scipy.spatial as _sps
 import openquake.srtk.soil as _avg
 import openquake.srtk.response as _amp
+import openquake.srtk.attenuation as _att
+import openquake.srtk.dispersion as _dsp
 import openquake.srtk.utils as _ut
+import openquake.srtk.instrument as _ins
 
 # =============================================================================
 # Constants & initialisation variables
 
-# Precision for decimal rounding
+# Output precision (decimals), applied at export only
 DECIMALS = 6
 
+# Number of models processed at once when computing statistics
+STAT_CHUNK = 4096
+
+# Number of models processed at once by the vectorised P-SV solver
+PSV_CHUNK = 256
+
+# Number of models whose SH propagator state is kept between calls
+SH_STATES = 256
+
 # Parameters keys
 GEO_KEYS = ['hl', 'vp', 'vs', 'dn', 'qp', 'qs']
 ENG_KEYS = ['vsz', 'qwl', 'kappa', 'class', 'weight']
 AMP_KEYS = ['shtf', 'qwl', 'kappa']
 
+_DEFAULT_KEYS = {'geo': GEO_KEYS, 'eng': ENG_KEYS, 'amp': AMP_KEYS}
+
 
 # =============================================================================
 
@@ -135,6 +159,7 @@ class Model(object):
 
     # -------------------------------------------------------------------------
 
+    @_ins.timed('Model.from_file')
     def from_file(self, ascii_file, header=[], skip=0,
                   comment='#', delimiter=','):
         """
@@ -217,407 +242,2293 @@ class Model(object):
 
 # =============================================================================
 
-class Site1D(object):
+class Ensemble(object):
     """
-    Base class for a single one-dimensional site.
-    It contains the collection of soil models and the
-    corresponding derived parameters.
+    Array-backed collection of soil models. Soil properties are stored
+    as contiguous (models x layers) arrays, padded with nans and with
+    a per-model layer count, while numerical products (eng and amp)
+    are stored as (models x ...) arrays. Non-numerical products
+    (e.g. lists of resonances) are kept as objects.
+
+    The collection behaves as a list of models: indexing returns a
+    per-model view, with the same interface of the Model class, whose
+    data are read from and written to the ensemble arrays.
+    Note that views are positional, and they should not be kept
+    across insertion or removal of models.
+
+    Soil property and product arrays can be backed by memory-mapped
+    files in a working directory, for ensembles larger than the
+    available memory (only the layer counts are kept in memory).
+    Files are removed as soon as they are mapped (on POSIX systems),
+    so no data is left on disk when the ensemble is released.
+
+    :param string work_dir:
+        directory of the memory-mapped arrays
+        (default is None, arrays are kept in memory)
     """
 
-    def __init__(self, id=None, x=None, y=None, z=None):
+    def __init__(self, work_dir=None):
 
-        self.head = {}
-        self.head['id'] = id
-        self.head['x'] = x
-        self.head['y'] = y
-        self.head['z'] = x
+        self.work_dir = work_dir
 
-        self.freq = []
-        self.model = []
-        self.mean = Model()
+        self._size = 0
+        self._lnum = _np.zeros(0, dtype='int64')
+        self._geo = {K: _np.zeros((0, 0)) for K in GEO_KEYS}
+        self._prod = {'eng': {}, 'amp': {}}
+        self._obj = []
 
     # -------------------------------------------------------------------------
 
-    def add_model(self, model=[], index=-1):
+    @classmethod
+    def from_models(cls, models, work_dir=None):
         """
-        Add a single soil model to the site database
+        Build the ensemble from a sequence of models.
 
-        :param Model model:
-            the model the be added; if not specificed,
-            an empty model is added
+        :param list models:
+            the list of Model objects
 
-        :param int index:
-            index of where to include the model in the database;
-            use -1 to append (default)
-        """
+        :param string work_dir:
+            directory of the memory-mapped arrays (optional)
 
-        index = int(index)
-        if index < 0:
-            index = len(self.model)
+        :return Ensemble ensemble:
+            the array-backed ensemble
+        """
 
-        if model:
-            self.model.insert(index, model)
-        else:
-            self.model.insert(index, Model())
+        ensemble = cls(work_dir)
+        ensemble.extend(models)
 
-    # -------------------------------------------------------------------------
+        return ensemble
 
-    def del_model(self, index=-1):
+    @classmethod
+    def from_arrays(cls, geo, lnum=None, work_dir=None):
         """
-        Remove a model from the site database
+        Build the ensemble from stacked arrays of soil properties.
+        Arrays of double precision are used without copy.
 
-        :param int index:
-            Index of the model to be removed from the database;
-            use -1 for the last position (default)
-        """
+        :param dict geo:
+            dictionary of arrays (models x layers) of soil properties;
+            missing keys are filled with nans
 
-        del self.model[int(index)]
+        :param numpy.array lnum:
+            number of layers of each model (optional, default
+            is the full array size)
 
-    # -------------------------------------------------------------------------
+        :param string work_dir:
+            directory of the memory-mapped arrays (optional)
 
-    def read_model(self, ascii_file, header=[], skip=0, comment='#',
-                   delimiter=',', index=-1, owrite=False):
+        :return Ensemble ensemble:
+            the array-backed ensemble
         """
-        Method to parse soil properties from a single tabular
-        ascii file or a list of files; arbitrary formatting is allowed
-
-        The method is essentially a wrapper of the read_model
-        method of the Model() class, from whom it inherits the
-        input paramters (header, skip, ...)
 
-        :param string or list ascii_file:
-            single input model file or list of files
+        ensemble = cls(work_dir)
+        ensemble._size, lmax = _np.shape(geo['hl'])
 
-        :param list header:
-            list of header keys, to be used when not
-            available within the input file
+        for K in GEO_KEYS:
+            if K in geo:
+                ensemble._geo[K] = _np.asarray(geo[K], dtype='float64')
+            else:
+                ensemble._geo[K] = _alloc((ensemble._size, lmax), 'float64',
+                                          work_dir)
+                ensemble._geo[K][:] = _np.nan
 
-        :param int skip:
-            number of intitial lines to skip;
-            default value is 0
+        if lnum is None:
+            lnum = _np.full(ensemble._size, lmax)
 
-        :param char or string comment:
-            string to mark comments (which are not parsed);
-            default value is the hash character
+        ensemble._lnum = _np.array(lnum, dtype='int64')
+        ensemble._obj = [None]*ensemble._size
 
-        :param char delimiter:
-            character separator between data fields;
-            default value is comma
+        return ensemble
 
-        :param int index:
-            index of where to include the model in the database;
-            use -1 to append (default)
+    # -------------------------------------------------------------------------
 
-        :param boolean owrite:
-            flag to enable model overwriting; in this case,
-            the index is that of the model to be overwritten
+    @property
+    def geo(self):
+        """
+        Dictionary of (models x layers) arrays of soil properties
         """
 
-        if not isinstance(ascii_file, list):
-            ascii_file = [ascii_file]
+        lmax = _np.max(self.lnum) if self._size else 0
 
-        for af in ascii_file:
-            model = Model()
-            model.from_file(af, header, skip, comment, delimiter)
+        return {K: self._geo[K][:self._size, :lmax] for K in GEO_KEYS}
 
-            if owrite:
-                self.model[index] = model
-            else:
-                self.add_model(model, index)
+    @property
+    def lnum(self):
+        """
+        Array with the number of layers of each model
+        """
 
-    # -------------------------------------------------------------------------
+        return self._lnum[:self._size]
 
-    def model_average(self):
+    @property
+    def mask(self):
         """
-        Compute the mean soil profile and its uncertainty.
-        Note: values of 0. in the model are replaced with
-        numpy nans, to compute log-normal statistic
+        Boolean (models x layers) array of the valid layers
         """
 
-        for key in GEO_KEYS:
-            data = [mod.geo[key] for mod in self.model]
-            self.mean.geo[key] = _ut.log_stat(data)
+        lmax = _np.max(self.lnum) if self._size else 0
 
-    # -------------------------------------------------------------------------
+        return _np.arange(lmax) < self.lnum[:, None]
 
-    def traveltime_velocity(self, depth=30.):
+    def get_array(self, path):
         """
-        Compute and store travel-time average velocity at a given depth.
-        Multiple depths are also allowed (as list). Default is Vs30.
+        Return a product of all the models as a single array.
+        Models without the product are excluded: their rows are
+        then selected on demand (see _Rows), so that large arrays
+        (e.g. on disk) are not copied at once.
 
-        :param float or list depth:
-            calculation depth
+        :param tuple path:
+            location of the product (e.g. ('amp', 'shtf'))
+
+        :return numpy.array data:
+            the stacked product, or None if not stored as array
         """
 
-        if not isinstance(depth, list):
-            depth = [depth]
+        column = self._node(path)
 
-        for mod in self.model:
-            mod.eng['vsz'] = {}
-            for z in depth:
-                vz = _avg.traveltime_velocity(mod.geo['hl'],
-                                              mod.geo['vs'],
-                                              depth=z)
-                mod.eng['vsz'][z] = _ut.a_round(vz, DECIMALS)
+        if not isinstance(column, _Column):
+            return None
 
-        # Perform statistics (log-normal)
-        self.mean.eng['vsz'] = {}
-        for z in depth:
-            data = [mod.eng['vsz'][z] for mod in self.model]
-            mn, sd = _ut.log_stat(data)
-            self.mean.eng['vsz'][z] = (_ut.a_round(mn, DECIMALS),
-                                       _ut.a_round(sd, DECIMALS))
+        data = column.data[:self._size]
+        mask = column.mask[:self._size]
 
-    # -------------------------------------------------------------------------
+        return data if _np.all(mask) else _Rows(data, mask)
 
-    def compute_soil_class(self, code='EC8'):
+    def set_array(self, path, data):
         """
-        Compute geotechnical classification according to specified
-        building code. Default is EC8 (missing special classes).
+        Store a product of all the models from a single array.
+        The array is used without copy (as for arrays in shared memory
+        or on disk), unless the ensemble is on disk and the array is
+        in memory; it is replaced by a larger copy only when models
+        are added beyond its length.
 
-        :param string code:
-            the reference building code for the classification
-            (default EC8)
-        """
+        :param tuple path:
+            location of the product (e.g. ('amp', 'shtf'))
 
-        try:
-            # Class from the mean Vs30 model
-            vs30 = self.mean.eng['vsz'][30.][0]
-            self.mean.eng['class'] = _avg.gt_soil_class(vs30, code)
+        :param numpy.array data:
+            array (models x ...) of the product
+        """
 
-            # Class of each profile
-            for mod in self.model:
-                vs30 = mod.eng['vsz'][30.]
-                mod.eng['class'] = _avg.gt_soil_class(vs30, code)
+        if len(data) != self._size:
+            raise ValueError('Array size does not match the ensemble')
 
-        except:
-            print 'Error: Vs30 must be calculated first'
-            return
+        for index in range(self._size):
+            if self._obj[index] is not None:
+                self._del_prod(index, path)
 
-    # -------------------------------------------------------------------------
+        parent = self._prod
+        for key in path[:-1]:
+            if not isinstance(parent.get(key), dict):
+                parent[key] = {}
+            parent = parent[key]
 
-    def frequency_axis(self, fmin, fmax, fnum, log=True):
-        """
-        Compute a linear or logarithmic frequency axis.
+        capacity = len(self._lnum)
 
-        :param float fmin:
-            minimum frequency
+        column = _Column(_np.zeros(0), 0)
+        column.mask = _np.zeros(capacity, dtype='bool')
+        column.mask[:self._size] = True
 
-        :param float fmax:
-            maximum frequency
+        if self.work_dir is None or isinstance(data, _np.memmap):
+            column.data = data
+        else:
+            column.data = _alloc((capacity,) + data.shape[1:],
+                                 data.dtype, self.work_dir)
+            column.data[:self._size] = data
 
-        :param int fnum:
-            number of frequencies
+        parent[path[-1]] = column
 
-        :param boolean log:
-            switch between linear or logarithmic spacing
-            (default is logarithmic)
+    def del_array(self, path):
         """
+        Remove a product (and its sub-products) from all the models.
 
-        self.freq = _amp.frequency_axis(fmin, fmax, fnum, log)
-
-    def _check_frequency(self):
-        """
-        Internal: check if the frequency axis has been instantiated
+        :param tuple path:
+            location of the product (e.g. ('eng', 'vsz'))
         """
 
-        if not _np.sum(self.freq):
-            raise ValueError('Frequency axis must be first instantiated')
+        for obj in self._obj:
+            if obj is not None:
+                for key in list(obj):
+                    if key[:len(path)] == path:
+                        del obj[key]
+
+        parent = self._node(path[:-1])
+        if isinstance(parent, dict):
+            parent.pop(path[-1], None)
 
     # -------------------------------------------------------------------------
 
-    def quarter_wavelength_average(self):
-        """
-        Compute quarter-wavelength parameters (velocity and density)
-        and store them into the site database.
-        """
+    def __len__(self):
 
-        self._check_frequency()
+        return self._size
 
-        for mod in self.model:
+    def __iter__(self):
 
-            # Compute average velocity
-            qwl_par = _avg.quarter_wavelength_average(mod.geo['hl'],
-                                                      mod.geo['vs'],
-                                                      mod.geo['dn'],
-                                                      self.freq)
+        for index in range(self._size):
+            yield ModelView(self, index)
 
-            mod.eng['qwl'] = {}
-            mod.eng['qwl']['z'] = _ut.a_round(qwl_par[0], DECIMALS)
-            mod.eng['qwl']['vs'] = _ut.a_round(qwl_par[1], DECIMALS)
-            mod.eng['qwl']['dn'] = _ut.a_round(qwl_par[2], DECIMALS)
+    def __getitem__(self, index):
 
-        # Perform statistics (log-normal)
-        self.mean.eng['qwl'] = {}
-        for key in ['z', 'vs', 'dn']:
-            data = [mod.eng['qwl'][key] for mod in self.model]
-            mn, sd = _ut.log_stat(data)
-            self.mean.eng['qwl'][key] = (_ut.a_round(mn, DECIMALS),
-                                         _ut.a_round(sd, DECIMALS))
+        if isinstance(index, slice):
+            return [ModelView(self, i)
+                    for i in range(*index.indices(self._size))]
 
-    # -------------------------------------------------------------------------
+        return ModelView(self, self._index(index))
 
-    def quarter_wavelength_amplification(self, vs_ref=[],
-                                         dn_ref=[], inc_ang=0.):
-        """
-        Compute the amplification as impedance contrast of
-        quarter-wavelength parameters. Aribitrary reference
-        can be provided, otherwise the last layer of the model
-        is used. Angle of incidence is optional.
+    def __setitem__(self, index, model):
 
-        :param float or numpy.array ref_vs:
-            lowermost (reference) shear-wave velocity in m/s
+        index = self._index(index)
+        self._clear(index)
+        self._write(index, model)
 
-        :param float or numpy.array ref_dn:
-            lowermost (reference) density in kg/m3
+    def __delitem__(self, index):
 
-        :param float inc_ang:
-            angle of incidence in degrees, relative to the vertical
-            (default is vertical incidence)
+        index = self._index(index)
+        self._move(index + 1, index, self._size - index - 1)
+        self._size -= 1
+        self._clear(self._size)
+        del self._obj[index]
+
+    def insert(self, index, model):
         """
+        Insert a model at a given position (as for lists).
 
-        for mod in self.model:
+        :param int index:
+            position of the model in the ensemble
 
-            if _ut.is_empty(vs_ref):
-                vs_ref = mod.geo['vs'][-1]
+        :param Model model:
+            the model to be inserted
+        """
 
-            if _ut.is_empty(dn_ref):
-                dn_ref = mod.geo['dn'][-1]
+        index = min(max(index + self._size if index < 0 else index, 0),
+                    self._size)
 
-            qwl_amp = _amp.impedance_amplification(mod.eng['qwl']['vs'],
-                                                   mod.eng['qwl']['dn'],
-                                                   vs_ref,
-                                                   dn_ref,
-                                                   inc_ang)
+        self._reserve(self._size + 1)
+        self._move(index, index + 1, self._size - index)
+        self._size += 1
+        self._obj.insert(index, None)
 
-            mod.amp['qwl'] = _ut.a_round(qwl_amp, DECIMALS)
+        self._clear(index)
+        self._write(index, model)
 
-        # Perform statistics (log-normal)
-        data = [mod.amp['qwl'] for mod in self.model]
-        mn, sd = _ut.log_stat(data)
-        self.mean.amp['qwl'] = (_ut.a_round(mn, DECIMALS),
-                                _ut.a_round(sd, DECIMALS))
+    def append(self, model):
+        """
+        Append a model at the end of the ensemble.
 
-    # -------------------------------------------------------------------------
+        :param Model model:
+            the model to be appended
+        """
 
-    def compute_site_kappa(self, depth=[]):
+        self.insert(self._size, model)
+
+    def extend(self, models):
         """
-        Compute the Kappa parameter directly from the site model
-        using harmonic averaging. Caculation depth can be speficied,
-        otherwise the depth of the last layer interface is used.
+        Append a sequence of models at the end of the ensemble.
 
-        :param float depth:
-            averaging depth in meters (optional)
+        :param list models:
+            the models to be appended
         """
 
-        for mod in self.model:
+        models = list(models)
+        self._reserve(self._size + len(models))
 
-            # Compute kappa attenuation
-            kappa = _avg.compute_site_kappa(mod.geo['hl'],
-                                            mod.geo['vs'],
-                                            mod.geo['qs'],
-                                            depth)
+        for model in models:
+            self.append(model)
 
-            mod.eng['kappa'] = _ut.a_round(kappa, DECIMALS)
+    def insert_arrays(self, index, geo):
+        """
+        Insert a set of models from stacked arrays of soil properties.
 
-        # Perform statistics (normal)
-        data = [mod.eng['kappa'] for mod in self.model]
-        mn, sd = _ut.lin_stat(data)
-        self.mean.eng['kappa'] = (_ut.a_round(mn, DECIMALS),
-                                  _ut.a_round(sd, DECIMALS))
+        :param int index:
+            position of the first model in the ensemble
 
-    # -------------------------------------------------------------------------
+        :param dict geo:
+            dictionary of arrays (models x layers) of soil properties;
+            missing keys are filled with nans
+        """
 
-    def attenuation_decay(self):
+        mnum, lnum = _np.shape(geo['hl'])
+        index = min(max(index, 0), self._size)
+
+        self._reserve(self._size + mnum)
+        self._reserve_layers(lnum)
+        self._move(index, index + mnum, self._size - index)
+        self._size += mnum
+        self._obj[index:index] = [None]*mnum
+
+        for I in range(index, index + mnum):
+            self._clear(I)
+
+        for K in GEO_KEYS:
+            if K in geo:
+                self._geo[K][index:index + mnum, :lnum] = geo[K]
+        self._lnum[index:index + mnum] = lnum
+
+    def pop(self, index=-1):
         """
-        Compute the frequency-dependent attenuation function
-        for a given site Kappa (0).
+        Remove a model from the ensemble.
+
+        :param int index:
+            position of the model in the ensemble
+            (default is the last)
+
+        :return Model model:
+            a (detached) copy of the removed model
         """
 
-        self._check_frequency()
+        model = self.to_model(index)
+        del self[index]
 
-        for mod in self.model:
+        return model
+
+    def to_model(self, index):
+        """
+        Return a detached copy of a model of the ensemble.
 
-            # Compute attenuation decay
-            att_fun = _amp.attenuation_decay(self.freq, mod.eng['kappa'])
+        :param int index:
+            position of the model in the ensemble
+
+        :return Model model:
+            the copy of the model
+        """
 
-            mod.amp['kappa'] = _ut.a_round(att_fun, DECIMALS)
+        view = self[index]
 
-        # Perform statistics (log-normal)
-        data = [mod.amp['kappa'] for mod in self.model]
-        mn, sd = _ut.log_stat(data)
-        self.mean.amp['kappa'] = (_ut.a_round(mn, DECIMALS),
-                                  _ut.a_round(sd, DECIMALS))
+        model = Model()
+        model.geo = _detach(view.geo)
+        model.eng = _detach(view.eng)
+        model.amp = _detach(view.amp)
+
+        return model
+
+    def to_models(self):
+        """
+        Return a list of detached copies of all the models.
+
+        :return list models:
+            the list of Model objects
+        """
+
+        return [self.to_model(index) for index in range(self._size)]
 
     # -------------------------------------------------------------------------
 
-    def sh_transfer_function(self, inc_ang=0., elastic=False, complex=False):
+    def _index(self, index):
+        """
+        Internal: check and normalise a model index
         """
-        Compute the complex SH-wave transfer function at the
-        surface for outcropping rock reference conditions.
-        Calculation can be done for an arbitrary angle of
-        incidence (0-90), elastic or anelastic.
 
-        For more options (e.g. calculation at arbitrary depth)
-        see the generic sh_transfer_function method in the
-        amplification module
+        index = int(index)
+        if index < 0:
+            index += self._size
+        if index < 0 or index >= self._size:
+            raise IndexError('Model index out of range')
 
-        Statistic is performed linearly on complex spectra
-        (to check!)
+        return index
 
-        :param float inc_ang:
-            angle of incidence in degrees, relative to the
-            vertical (default is vertical incidence)
+    def _columns(self, node=None):
+        """
+        Internal: iterate over all the product columns
+        """
 
-        :param boolean elastic:
-            switch between elastic and anelastic calculation
-            (default is anelastic)
+        if node is None:
+            node = self._prod
 
-        :param boolean complex:
-            switch to output real (abs) or complex spectra
-            (note that type of statistic is affected)
+        for value in node.values():
+            if isinstance(value, _Column):
+                yield value
+            else:
+                for column in self._columns(value):
+                    yield column
+
+    def _node(self, path):
+        """
+        Internal: return the storage node at a given path
+        (None if missing)
         """
 
-        self._check_frequency()
+        node = self._prod
 
-        for mod in self.model:
+        for key in path:
+            if not isinstance(node, dict) or key not in node:
+                return None
+            node = node[key]
 
-            qs = mod.geo['qs'] if not elastic else None
+        return node
 
-            # Compute transfer function
-            dis_mat = _amp.sh_transfer_function(self.freq,
-                                                mod.geo['hl'],
-                                                mod.geo['vs'],
-                                                mod.geo['dn'],
-                                                qs,
-                                                inc_ang,
-                                                0)
+    def _reserve(self, size):
+        """
+        Internal: grow the array capacity (amortised)
+        """
 
-            if complex:
-                mod.amp['shtf'] = dis_mat[0]/2
-            else:
-                mod.amp['shtf'] = _np.abs(dis_mat[0])/2
+        capacity = len(self._lnum)
 
-        # Perform statistics (normal on complex)
-        data = [mod.amp['shtf'] for mod in self.model]
-        if complex:
-            self.mean.amp['shtf'] = _ut.lin_stat(data)
-        else:
-            self.mean.amp['shtf'] = _ut.log_stat(data)
+        if size > capacity:
+            capacity = max(size, 2*capacity, 16)
 
-    # -------------------------------------------------------------------------
+            self._lnum = _grow(self._lnum, capacity, 0)
+            for K in GEO_KEYS:
+                self._geo[K] = _grow(self._geo[K], capacity, _np.nan,
+                                     self.work_dir)
 
-    def resonance_frequency(self):
+        # Columns shared by set_array only hold the stored models
+        for column in self._columns():
+            if len(column.data) < size:
+                column.data = _grow(column.data, capacity, 0, self.work_dir)
+            if len(column.mask) < capacity:
+                column.mask = _grow(column.mask, capacity, False)
+
+    def _reserve_layers(self, lnum):
         """
-        Identify resonance frequencies on an amplification spectrum.
-        Note that frequency on the average spectrum are identified
-        directly without performing statistic on the single models.
+        Internal: grow the number of layers of the geo arrays
         """
 
-        for mod in self.model:
-            mod.amp['fn'] = _amp.resonance_frequency(self.freq,
-                                                     mod.amp['shtf'])
+        for K in GEO_KEYS:
+            shape = self._geo[K].shape
+            if lnum > shape[1]:
+                wide = _alloc((shape[0], lnum), 'float64', self.work_dir)
+                wide[:, :shape[1]] = self._geo[K]
+                wide[:, shape[1]:] = _np.nan
+                self._geo[K] = wide
+
+    def _move(self, source, target, count):
+        """
+        Internal: move a block of models within the arrays
+        """
+
+        if count <= 0:
+            return
+
+        arrays = [self._lnum] + [self._geo[K] for K in GEO_KEYS]
+        for column in self._columns():
+            arrays += [column.data, column.mask]
+
+        for array in arrays:
+            array[target:target + count] = array[source:source + count]
+
+    def _clear(self, index):
+        """
+        Internal: remove all data of a model
+        """
+
+        self._lnum[index] = 0
+        for K in GEO_KEYS:
+            self._geo[K][index] = _np.nan
+        for column in self._columns():
+            column.mask[index] = False
+        if index < len(self._obj):
+            self._obj[index] = None
+
+    def _write(self, index, model):
+        """
+        Internal: write the content of a model into the arrays
+        """
+
+        self._set_geo(index, model.geo)
+
+        for group in ['eng', 'amp']:
+            for key, value in getattr(model, group).items():
+                self._set_prod(index, (group, key), value)
+
+    # -------------------------------------------------------------------------
+
+    def _set_geo(self, index, geo):
+        """
+        Internal: write soil properties of a model. If the number of
+        layers changes, the properties not given are truncated or
+        padded with nans.
+        """
+
+        geo = {K: _np.asarray(geo[K], dtype='float64').ravel()
+               for K in geo if K in GEO_KEYS}
+        lnum = max(len(value) for value in geo.values()) if geo else 0
+
+        self._reserve_layers(lnum)
+        self._lnum[index] = lnum
+
+        for K in GEO_KEYS:
+            row = self._geo[K][index]
+            row[lnum:] = _np.nan
+            if K in geo:
+                row[:len(geo[K])] = geo[K]
+                row[len(geo[K]):] = _np.nan
+
+    def _get_prod(self, index, path):
+        """
+        Internal: read a product of a model
+        """
+
+        obj = self._obj[index]
+        if obj is not None and path in obj:
+            return obj[path]
+
+        node = self._node(path)
+
+        if isinstance(node, dict):
+            return _ProductView(self, index, path)
+
+        if isinstance(node, _Column) and node.mask[index]:
+            return node.data[index]
+
+        if len(path) == 2 and path[1] in _DEFAULT_KEYS[path[0]]:
+            return _np.array([])
+
+        raise KeyError(path[-1])
+
+    def _set_prod(self, index, path, value):
+        """
+        Internal: write a product of a model
+        """
+
+        self._del_prod(index, path)
+
+        parent = self._node(path[:-1])
+        node = parent.get(path[-1]) if isinstance(parent, dict) else None
+
+        if isinstance(parent, dict) and not isinstance(node, _Column):
+
+            # Dictionaries are stored as nested products
+            if isinstance(value, _Mapping):
+                if node is None:
+                    parent[path[-1]] = {}
+                for key, item in value.items():
+                    self._set_prod(index, path + (key,), item)
+                return
+
+            # Empty arrays mark missing products
+            if _is_numeric(value) and not _np.size(value):
+                return
+
+        if _is_numeric(value) and not isinstance(node, dict):
+            value = _np.asarray(value)
+
+            if node is None and isinstance(parent, dict):
+                node = _Column(value, len(self._lnum), self.work_dir)
+                parent[path[-1]] = node
+
+            if isinstance(node, _Column) and node.accept(value):
+                node.data[index] = value
+                node.mask[index] = True
+                return
+
+        # Any other data is stored as object
+        if self._obj[index] is None:
+            self._obj[index] = {}
+        self._obj[index][path] = _detach(value)
+
+    def _del_prod(self, index, path):
+        """
+        Internal: remove a product (and its sub-products) of a model
+        """
+
+        obj = self._obj[index]
+        if obj is not None:
+            for key in list(obj):
+                if key[:len(path)] == path:
+                    del obj[key]
+
+        node = self._node(path)
+
+        if isinstance(node, _Column):
+            node.mask[index] = False
+
+        if isinstance(node, dict):
+            for column in self._columns(node):
+                column.mask[index] = False
+
+    def _keys(self, index, path):
+        """
+        Internal: list the products of a model at a given path
+        """
+
+        keys = list(_DEFAULT_KEYS[path[0]]) if len(path) == 1 else []
+
+        node = self._node(path)
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if isinstance(value, dict) or value.mask[index]:
+                    keys.append(key)
+
+        obj = self._obj[index]
+        if obj is not None:
+            for key in obj:
+                if len(key) == len(path) + 1 and key[:len(path)] == path:
+                    keys.append(key[-1])
+
+        return list(_unique(keys))
+
+
+# =============================================================================
+
+class ModelView(Model):
+    """
+    View of a single model of an array-backed ensemble, with the same
+    interface of the Model class. Data are read from (and written to)
+    the ensemble arrays without copies.
+    """
+
+    def __init__(self, ensemble, index):
+
+        self._ensemble = ensemble
+        self._index = index
+
+        self.geo = _GeoView(ensemble, index)
+        self.eng = _ProductView(ensemble, index, ('eng',))
+        self.amp = _ProductView(ensemble, index, ('amp',))
+
+    def _edit(self, method, *args):
+        """
+        Internal: apply a Model method to a detached copy of the
+        soil properties, then write them back to the ensemble
+        """
+
+        model = Model()
+        model.geo = _detach(self.geo)
+        getattr(model, method)(*args)
+
+        self._ensemble._set_geo(self._index, model.geo)
+
+    def add_layer(self, data, index=-1):
+        self._edit('add_layer', data, index)
+    add_layer.__doc__ = Model.add_layer.__doc__
+
+    def del_layer(self, index=-1):
+        self._edit('del_layer', index)
+    del_layer.__doc__ = Model.del_layer.__doc__
+
+    def from_file(self, ascii_file, header=[], skip=0,
+                  comment='#', delimiter=','):
+        self._edit('from_file', ascii_file, header, skip, comment, delimiter)
+    from_file.__doc__ = Model.from_file.__doc__
+
+
+# =============================================================================
+
+class _GeoView(_MutableMapping):
+    """
+    Internal: dictionary-like view of the soil properties of a model
+    """
+
+    def __init__(self, ensemble, index):
+        self._ensemble = ensemble
+        self._index = index
+
+    def __getitem__(self, key):
+        if key not in GEO_KEYS:
+            raise KeyError(key)
+        lnum = self._ensemble._lnum[self._index]
+        return self._ensemble._geo[key][self._index, :lnum]
+
+    def __setitem__(self, key, value):
+        self._ensemble._set_geo(self._index, {key: value})
+
+    def __delitem__(self, key):
+        raise TypeError('Soil properties cannot be removed')
+
+    def __iter__(self):
+        return iter(GEO_KEYS)
+
+    def __len__(self):
+        return len(GEO_KEYS)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class _ProductView(_MutableMapping):
+    """
+    Internal: dictionary-like view of the (nested) products of a model
+    """
+
+    def __init__(self, ensemble, index, path):
+        self._ensemble = ensemble
+        self._index = index
+        self._path = path
+
+    def __getitem__(self, key):
+        return self._ensemble._get_prod(self._index, self._path + (key,))
+
+    def __setitem__(self, key, value):
+        self._ensemble._set_prod(self._index, self._path + (key,), value)
+
+    def __delitem__(self, key):
+        self._ensemble._del_prod(self._index, self._path + (key,))
+
+    def __iter__(self):
+        return iter(self._ensemble._keys(self._index, self._path))
+
+    def __len__(self):
+        return len(self._ensemble._keys(self._index, self._path))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class _Column(object):
+    """
+    Internal: array storage of a numerical product, with a mask
+    of the models for which the product is available
+    """
+
+    def __init__(self, value, capacity, work_dir=None):
+        dtype = 'complex128' if _np.iscomplexobj(value) else 'float64'
+        self.data = _alloc((capacity,) + value.shape, dtype, work_dir)
+        self.mask = _np.zeros(capacity, dtype='bool')
+        self.work_dir = work_dir
+
+    def accept(self, value):
+        if value.shape != self.data.shape[1:]:
+            return False
+        if _np.iscomplexobj(value) and not _np.iscomplexobj(self.data):
+            data = _alloc(self.data.shape, 'complex128', self.work_dir)
+            data[:] = self.data
+            self.data = data
+        return True
+
+
+class _Rows(object):
+    """
+    Internal: rows of an array selected by a mask, read on demand;
+    indexing (e.g. by blocks of models) only copies the selected
+    rows, while conversion to array copies all of them
+    """
+
+    def __init__(self, data, mask):
+        self.data = data
+        self.index = _np.flatnonzero(mask)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, key):
+        return self.data[self.index[key]]
+
+    def __array__(self, dtype=None):
+        return _np.asarray(self.data[self.index], dtype)
+
+    @property
+    def shape(self):
+        return (len(self.index),) + self.data.shape[1:]
+
+
+# =============================================================================
+
+def _grow(array, capacity, fill, work_dir=None):
+    """
+    Internal: enlarge an array along the first axis
+    """
+
+    if work_dir is not None:
+        grown = _alloc((capacity,) + array.shape[1:], array.dtype, work_dir)
+        grown[:len(array)] = array
+        grown[len(array):] = fill
+        return grown
+
+    shape = (capacity - len(array),) + array.shape[1:]
+    pad = _np.full(shape, fill, dtype=array.dtype)
+
+    return _np.concatenate((array, pad))
+
+
+def _alloc(shape, dtype, work_dir=None):
+    """
+    Internal: allocate a zero-filled array, in memory or
+    memory-mapped on a (temporary) file of the working directory
+    """
+
+    if work_dir is None or not _np.prod(shape):
+        return _np.zeros(shape, dtype=dtype)
+
+    fd, path = _tmp.mkstemp(suffix='.bin', prefix='srtk-', dir=work_dir)
+    _os.close(fd)
+
+    array = _np.memmap(path, dtype=dtype, mode='w+', shape=shape)
+
+    # The mapping remains valid after the file is removed (POSIX)
+    if _os.name == 'posix':
+        _os.remove(path)
+
+    return array
+
+
+def _detach(value):
+    """
+    Internal: recursive copy of a (possibly nested) view
+    """
+
+    if isinstance(value, _Mapping):
+        return {key: _detach(item) for key, item in value.items()}
+
+    if isinstance(value, _np.ndarray):
+        return value.copy()
+
+    return value
+
+
+def _is_numeric(value):
+    """
+    Internal: check if a value can be stored as array
+    """
+
+    if isinstance(value, _np.ndarray):
+        return value.dtype.kind in 'biufc'
+
+    return isinstance(value, (int, float, complex, _np.number))
+
+
+def _unique(keys):
+    """
+    Internal: remove duplicates preserving the order
+    """
+
+    seen = set()
+    for key in keys:
+        if key not in seen:
+            seen.add(key)
+            yield key
+
+
+def _collect(models, path, weights=False):
+    """
+    Internal: collect a product from a set of models; ensembles
+    return the stacked array directly (without copy if possible).
+    If requested, the weights of the corresponding models are
+    also returned.
+    """
+
+    if isinstance(models, Ensemble):
+        data = models.get_array(path)
+        if data is not None:
+            if not weights:
+                return data
+            wgt = _model_weights(models)
+            if len(wgt) != len(data):
+                wgt = wgt[models._node(path).mask[:len(models)]]
+            return data, wgt
+
+    data = [(_get_path(mod, path), mod) for mod in models]
+    data = [(d, mod) for d, mod in data if d is not None]
+
+    if not weights:
+        return [d for d, mod in data]
+
+    return ([d for d, mod in data],
+            _np.array([_model_weight(mod) for d, mod in data]))
+
+
+def _model_weight(model):
+    """
+    Internal: logic-tree weight of a model (1 if not assigned)
+    """
+
+    weight = _get_path(model, ('eng', 'weight'))
+
+    return 1. if weight is None else float(weight)
+
+
+def _model_weights(models):
+    """
+    Internal: logic-tree weights of a set of models
+    """
+
+    if isinstance(models, Ensemble):
+        column = models._node(('eng', 'weight'))
+        if isinstance(column, _Column) and column.data.ndim == 1:
+            size = len(models)
+            return _np.where(column.mask[:size], column.data[:size], 1.)
+
+    return _np.array([_model_weight(mod) for mod in models])
+
+
+def _halfspace(models, key):
+    """
+    Internal: parameter of the half-space (last layer) of each model
+    """
+
+    if isinstance(models, Ensemble):
+        return models.geo[key][_np.arange(len(models)), models.lnum - 1]
+
+    return _np.array([mod.geo[key][-1] for mod in models], dtype='float64')
+
+
+def _reference(value, default):
+    """
+    Internal: reference parameters as a (references x models) array;
+    missing values (nan or not given) are replaced by the default
+    of each model
+    """
+
+    if value is None or not _np.size(value):
+        value = _np.nan
+
+    value = _np.asarray(value, dtype='float64')
+    if value.ndim < 2:
+        value = value.reshape(-1, 1)
+
+    value = _np.broadcast_to(value, (len(value), len(default)))
+
+    return _np.where(_np.isnan(value), default, value)
+
+
+def _reference_row(value):
+    """
+    Internal: single reference condition, the same for all the
+    models (scalar) or one value for each model (array)
+    """
+
+    if value is None or not _np.size(value):
+        return value
+
+    return _np.reshape(value, (1, -1))
+
+
+# =============================================================================
+
+class Site1D(object):
+    """
+    Base class for a single one-dimensional site.
+    It contains the collection of soil models and the
+    corresponding derived parameters.
+
+    Soil models and per-model products can be backed by memory-mapped
+    files in a working directory (work_dir), for ensembles larger
+    than the available memory (see Ensemble).
+
+    If a relative accuracy is given (sketch), the percentiles of
+    the real-valued products are also accumulated in mergeable
+    quantile sketches (see utils.QuantileSketch), which do not
+    require to keep the models (e.g. in streaming mode).
+    """
+
+    def __init__(self, id=None, x=None, y=None, z=None, work_dir=None,
+                 sketch=None):
+
+        self.head = {}
+        self.head['id'] = id
+        self.head['x'] = x
+        self.head['y'] = y
+        self.head['z'] = z
+
+        self.freq = []
+        self.model = Ensemble(work_dir)
+        self.mean = Model()
+        self.percentiles = Model()
+
+        # Running statistics of the computed products
+        self._stat = {}
+
+        # Quantile sketches of the computed products (optional)
+        self.sketch = sketch
+        self._sketch = {}
+
+        # SH-wave propagator (cached terms of the last calculation)
+        self._shprop = None
+
+    def __getstate__(self):
+        """
+        The cached SH-wave propagator is not pickled (e.g. when
+        the site is sent to a worker process), as it can be rebuilt.
+        """
+
+        state = self.__dict__.copy()
+        state['_shprop'] = None
+
+        return state
+
+    # -------------------------------------------------------------------------
+
+    def add_model(self, model=[], index=-1):
+        """
+        Add a single soil model to the site database.
+        Statistics of the products already computed are
+        updated incrementally (if available in the model).
+
+        :param Model model:
+            the model the be added; if not specificed,
+            an empty model is added
+
+        :param int index:
+            index of where to include the model in the database;
+            use -1 to append (default)
+        """
+
+        index = int(index)
+        if index < 0:
+            index = len(self.model)
+
+        if not model:
+            model = Model()
+
+        self.model.insert(index, model)
+
+        # Update statistics incrementally
+        weight = _model_weight(model)
+        for path in self._stat:
+            value = _get_path(model, path)
+            if value is not None:
+                self._stat[path].add(value, weight)
+                self._set_mean(path)
+                if path in self._sketch:
+                    self._sketch[path].add(value, weight)
+
+    # -------------------------------------------------------------------------
+
+    def del_model(self, index=-1):
+        """
+        Remove a model from the site database.
+        Statistics of the computed products are updated incrementally.
+
+        :param int index:
+            Index of the model to be removed from the database;
+            use -1 for the last position (default)
+        """
+
+        model = self.model.pop(int(index))
+
+        # Update statistics incrementally
+        weight = _model_weight(model)
+        for path in self._stat:
+            value = _get_path(model, path)
+            if value is not None:
+                self._stat[path].remove(value, weight)
+                self._set_mean(path)
+                if path in self._sketch:
+                    self._sketch[path].remove(value, weight)
+
+    # -------------------------------------------------------------------------
+
+    @_ins.timed('Site1D.add_model_array')
+    def add_model_array(self, geo, index=-1):
+        """
+        Add a set of soil models from stacked arrays of soil
+        properties, as those produced by the randomisation module.
+
+        :param dict geo:
+            dictionary of arrays (models x layers) of soil properties;
+            missing keys are filled with nans
+
+        :param int index:
+            index of where to include the models in the database;
+            use -1 to append (default)
+        """
+
+        index = int(index)
+        if index < 0:
+            index = len(self.model)
+
+        if isinstance(self.model, Ensemble):
+            self.model.insert_arrays(index, geo)
+            return
+
+        shape = _np.shape(geo['hl'])
+
+        for nm in range(shape[0]):
+            model = Model()
+            for K in GEO_KEYS:
+                if K in geo:
+                    model.geo[K] = _np.array(geo[K][nm], dtype='float64')
+                else:
+                    model.geo[K] = _np.full(shape[1], _np.nan)
+
+            self.add_model(model, index + nm)
+
+    # -------------------------------------------------------------------------
+
+    @_ins.timed('Site1D.read_model')
+    def read_model(self, ascii_file, header=[], skip=0, comment='#',
+                   delimiter=',', index=-1, owrite=False):
+        """
+        Method to parse soil properties from a single tabular
+        ascii file or a list of files; arbitrary formatting is allowed
+
+        The method is essentially a wrapper of the read_model
+        method of the Model() class, from whom it inherits the
+        input paramters (header, skip, ...)
+
+        :param string or list ascii_file:
+            single input model file or list of files
+
+        :param list header:
+            list of header keys, to be used when not
+            available within the input file
+
+        :param int skip:
+            number of intitial lines to skip;
+            default value is 0
+
+        :param char or string comment:
+            string to mark comments (which are not parsed);
+            default value is the hash character
+
+        :param char delimiter:
+            character separator between data fields;
+            default value is comma
+
+        :param int index:
+            index of where to include the model in the database;
+            use -1 to append (default)
+
+        :param boolean owrite:
+            flag to enable model overwriting; in this case,
+            the index is that of the model to be overwritten
+        """
+
+        if not isinstance(ascii_file, list):
+            ascii_file = [ascii_file]
+
+        for af in ascii_file:
+            model = Model()
+            model.from_file(af, header, skip, comment, delimiter)
+
+            if owrite:
+                self.del_model(index)
+                self.add_model(model, index)
+            else:
+                self.add_model(model, index)
+
+    # -------------------------------------------------------------------------
+
+    @_ins.timed('Site1D.statistics')
+    def _update_stat(self, path, log=True):
+        """
+        Internal: (re)initialise the running statistic of a product
+        from the whole model set and update the mean model.
+
+        :param tuple path:
+            location of the product in the model (e.g. ('eng', 'kappa'))
+
+        :param boolean log:
+            switch between log-normal (default) or normal statistic
+        """
+
+        data, weights = _collect(self.model, path, True)
+        stat = _ut.RunningStat.from_data(data, log, STAT_CHUNK, weights)
+
+        self._stat[path] = stat
+        self._set_mean(path)
+
+        if self.sketch and len(data) and not _np.iscomplexobj(data[0]):
+            self._sketch[path] = _ut.QuantileSketch.from_data(
+                data, self.sketch, weights, STAT_CHUNK)
+        else:
+            self._sketch.pop(path, None)
+
+    def _reset_stat(self, path):
+        """
+        Internal: remove all running statistics below a given path
+        """
+
+        for key in list(self._stat):
+            if key[:len(path)] == path:
+                del self._stat[key]
+                self._sketch.pop(key, None)
+
+    def _set_mean(self, path):
+        """
+        Internal: store the current statistic of a product
+        into the mean model
+        """
+
+        _set_path(self.mean, path, self._stat[path].stat())
+
+    # -------------------------------------------------------------------------
+
+    def set_weights(self, weights):
+        """
+        Assign the logic-tree weights of the models (stored in the
+        'weight' engineering parameter) and recompute the statistics
+        of the products already available. Weights are relative
+        and do not need to sum to one.
+
+        :param list or numpy.ndarray weights:
+            weights of the models in the site database
+        """
+
+        weights = _np.array(weights, dtype='float64')
+
+        if len(weights) != len(self.model):
+            raise ValueError('Number of weights does not match the models')
+
+        if isinstance(self.model, Ensemble):
+            self.model.set_array(('eng', 'weight'), weights)
+        else:
+            for mod, weight in zip(self.model, weights):
+                mod.eng['weight'] = weight
+
+        for path, stat in list(self._stat.items()):
+            self._update_stat(path, stat.log)
+
+    def model_weights(self):
+        """
+        Logic-tree weights of the models (1 if not assigned).
+
+        :returns numpy.ndarray:
+            weights of the models in the site database
+        """
+
+        return _model_weights(self.model)
+
+    def get_product(self, path, weights=False):
+        """
+        Collect a product from all the models; for ensembles the
+        stacked array is returned directly (without copy if possible).
+
+        :param tuple path:
+            location of the product in the model (e.g. ('amp', 'shtf'))
+
+        :param boolean weights:
+            if True, the weights of the models having the product
+            are also returned
+
+        :returns numpy.ndarray or list:
+            the product of each model (and the weights, if requested)
+        """
+
+        return _collect(self.model, tuple(path), weights)
+
+    # -------------------------------------------------------------------------
+
+    def apply_precision(self, decimals=DECIMALS, models=False):
+        """
+        Round the products of the mean and percentile models
+        (and optionally of all the models) to a given precision.
+        Products are otherwise kept at full precision, and rounding
+        is normally applied at export only; note that statistics
+        updated after this call are again at full precision.
+
+        :param int decimals:
+            rounding decimals (default is DECIMALS)
+
+        :param boolean models:
+            if True, also the products of the models in the
+            site database are rounded (vectorised, in place)
+        """
+
+        for mod in [self.mean, self.percentiles]:
+            mod.eng = _ut.set_precision(mod.eng, decimals)
+            mod.amp = _ut.set_precision(mod.amp, decimals)
+
+        if not models:
+            return
+
+        if isinstance(self.model, Ensemble):
+            for column in self.model._columns():
+                _ut.a_round(column.data, decimals)
+        else:
+            for mod in self.model:
+                mod.eng = _ut.set_precision(mod.eng, decimals)
+                mod.amp = _ut.set_precision(mod.amp, decimals)
+
+    # -------------------------------------------------------------------------
+
+    @_ins.timed('Site1D.model_average')
+    def model_average(self):
+        """
+        Compute the mean soil profile and its uncertainty
+        (weighted by the model weights, if assigned).
+        Note: values of 0. in the model are replaced with
+        numpy nans, to compute log-normal statistic
+        """
+
+        weights = _model_weights(self.model)
+
+        for key in GEO_KEYS:
+            data = [mod.geo[key] for mod in self.model]
+            self.mean.geo[key] = _ut.log_stat(data, weights)
+
+    # -------------------------------------------------------------------------
+
+    @_ins.timed('Site1D.traveltime_velocity')
+    def traveltime_velocity(self, depth=30.):
+        """
+        Compute and store travel-time average velocity at a given depth.
+        Multiple depths are also allowed (as list). Default is Vs30.
+
+        :param float or list depth:
+            calculation depth
+        """
+
+        if not isinstance(depth, list):
+            depth = [depth]
+
+        if isinstance(self.model, Ensemble):
+            geo = self.model.geo
+            self.model.del_array(('eng', 'vsz'))
+            for z in depth:
+                self.model.set_array(('eng', 'vsz', z),
+                                     _avg.traveltime_velocity_array(
+                                         geo['hl'], geo['vs'], depth=z))
+
+        else:
+            for mod in self.model:
+                mod.eng['vsz'] = {}
+                for z in depth:
+                    vz = _avg.traveltime_velocity(mod.geo['hl'],
+                                                  mod.geo['vs'],
+                                                  depth=z)
+                    mod.eng['vsz'][z] = vz
+
+        # Perform statistics (log-normal)
+        self._reset_stat(('eng', 'vsz'))
+        self.mean.eng['vsz'] = {}
+        for z in depth:
+            self._update_stat(('eng', 'vsz', z))
+
+    # -------------------------------------------------------------------------
+
+    @_ins.timed('Site1D.compute_soil_class')
+    def compute_soil_class(self, code='EC8'):
+        """
+        Compute geotechnical classification according to specified
+        building code. Default is EC8 (missing special classes).
+
+        :param string code:
+            the reference building code for the classification
+            (default EC8)
+        """
+
+        try:
+            # Class from the mean Vs30 model
+            vs30 = self.mean.eng['vsz'][30.][0]
+            self.mean.eng['class'] = _avg.gt_soil_class(vs30, code)
+
+            # Class of each profile
+            for mod in self.model:
+                vs30 = mod.eng['vsz'][30.]
+                mod.eng['class'] = _avg.gt_soil_class(vs30, code)
+
+        except:
+            print 'Error: Vs30 must be calculated first'
+            return
+
+    # -------------------------------------------------------------------------
+
+    def frequency_axis(self, fmin, fmax, fnum, log=True):
+        """
+        Compute a linear or logarithmic frequency axis.
+
+        :param float fmin:
+            minimum frequency
+
+        :param float fmax:
+            maximum frequency
+
+        :param int fnum:
+            number of frequencies
+
+        :param boolean log:
+            switch between linear or logarithmic spacing
+            (default is logarithmic)
+        """
+
+        self.freq = _amp.frequency_axis(fmin, fmax, fnum, log)
+
+    def _check_frequency(self):
+        """
+        Internal: check if the frequency axis has been instantiated
+        """
+
+        if not _np.sum(self.freq):
+            raise ValueError('Frequency axis must be first instantiated')
+
+    # -------------------------------------------------------------------------
+
+    @_ins.timed('Site1D.quarter_wavelength_average')
+    def quarter_wavelength_average(self):
+        """
+        Compute quarter-wavelength parameters (velocity and density)
+        and store them into the site database.
+        """
+
+        self._check_frequency()
+
+        if isinstance(self.model, Ensemble):
+            geo = self.model.geo
+            qwl_par = _avg.quarter_wavelength_average_array(geo['hl'],
+                                                            geo['vs'],
+                                                            geo['dn'],
+                                                            self.freq)
+
+            self.model.del_array(('eng', 'qwl'))
+            for key, value in zip(['z', 'vs', 'dn'], qwl_par):
+                self.model.set_array(('eng', 'qwl', key), value)
+
+        else:
+            for mod in self.model:
+
+                # Compute average velocity
+                qwl_par = _avg.quarter_wavelength_average(mod.geo['hl'],
+                                                          mod.geo['vs'],
+                                                          mod.geo['dn'],
+                                                          self.freq)
+
+                mod.eng['qwl'] = {}
+                mod.eng['qwl']['z'] = qwl_par[0]
+                mod.eng['qwl']['vs'] = qwl_par[1]
+                mod.eng['qwl']['dn'] = qwl_par[2]
+
+        # Perform statistics (log-normal)
+        self.mean.eng['qwl'] = {}
+        for key in ['z', 'vs', 'dn']:
+            self._update_stat(('eng', 'qwl', key))
+
+    # -------------------------------------------------------------------------
+
+    @_ins.timed('Site1D.quarter_wavelength_amplification')
+    def quarter_wavelength_amplification(self, vs_ref=[],
+                                         dn_ref=[], inc_ang=0.):
+        """
+        Compute the amplification as impedance contrast of
+        quarter-wavelength parameters. Aribitrary reference
+        can be provided, otherwise the last layer of each model
+        is used. Angle of incidence is optional.
+
+        :param float or numpy.array vs_ref:
+            lowermost (reference) shear-wave velocity in m/s,
+            the same for all the models or one for each model
+            (nan for the half-space of the model)
+
+        :param float or numpy.array dn_ref:
+            lowermost (reference) density in kg/m3, as vs_ref
+
+        :param float inc_ang:
+            angle of incidence in degrees, relative to the vertical
+            (default is vertical incidence)
+        """
+
+        qwl_amp = self.quarter_wavelength_amplification_array(
+            _reference_row(vs_ref), _reference_row(dn_ref),
+            _reference_row(inc_ang))[0]
+
+        if isinstance(self.model, Ensemble):
+            self.model.set_array(('amp', 'qwl'), qwl_amp)
+        else:
+            for mod, amp in zip(self.model, qwl_amp):
+                mod.amp['qwl'] = amp
+
+        # Perform statistics (log-normal)
+        self._update_stat(('amp', 'qwl'))
+
+    @_ins.timed('Site1D.quarter_wavelength_amplification_array')
+    def quarter_wavelength_amplification_array(self, vs_ref=[],
+                                               dn_ref=[], inc_ang=0.):
+        """
+        Compute the quarter-wavelength amplification of all the models
+        for a set of reference conditions at once (e.g. for host-to-
+        target adjustments), vectorised over reference conditions,
+        models and frequencies. Results are returned, and not stored
+        into the site database.
+
+        Reference parameters and angles are given for each reference
+        condition, either as (references) arrays, the same for all
+        the models, or as (references x models) arrays, with a value
+        for each model. Missing values (nan, or parameter not given)
+        are replaced by the half-space of each model.
+
+        :param float or numpy.array vs_ref:
+            reference shear-wave velocities in m/s
+
+        :param float or numpy.array dn_ref:
+            reference densities in kg/m3
+
+        :param float or numpy.array inc_ang:
+            angles of incidence in degrees, relative to the vertical
+            (default is vertical incidence)
+
+        :return numpy.array qwl_amp:
+            amplification (references x models x frequencies)
+        """
+
+        mnum = len(self.model)
+
+        qwl_vs = _collect(self.model, ('eng', 'qwl', 'vs'))
+        qwl_dn = _collect(self.model, ('eng', 'qwl', 'dn'))
+
+        if len(qwl_vs) != mnum or len(qwl_dn) != mnum:
+            raise ValueError('Quarter-wavelength parameters not available')
+
+        vs_ref = _reference(vs_ref, _halfspace(self.model, 'vs'))
+        dn_ref = _reference(dn_ref, _halfspace(self.model, 'dn'))
+        inc_ang = _reference(inc_ang, _np.zeros(mnum))
+
+        return _amp.impedance_amplification_array(_np.asarray(qwl_vs),
+                                                  _np.asarray(qwl_dn),
+                                                  vs_ref, dn_ref, inc_ang)
+
+    # -------------------------------------------------------------------------
+
+    @_ins.timed('Site1D.compute_site_kappa')
+    def compute_site_kappa(self, depth=[]):
+        """
+        Compute the Kappa parameter directly from the site model
+        using harmonic averaging. Caculation depth can be speficied,
+        otherwise the depth of the last layer interface is used.
+
+        :param float depth:
+            averaging depth in meters (optional)
+        """
+
+        if isinstance(self.model, Ensemble):
+            geo = self.model.geo
+            self.model.set_array(('eng', 'kappa'),
+                                 _avg.compute_site_kappa_array(
+                                     geo['hl'], geo['vs'], geo['qs'], depth))
+
+        else:
+            for mod in self.model:
+
+                # Compute kappa attenuation
+                kappa = _avg.compute_site_kappa(mod.geo['hl'],
+                                                mod.geo['vs'],
+                                                mod.geo['qs'],
+                                                depth)
+
+                mod.eng['kappa'] = kappa
+
+        # Perform statistics (normal)
+        self._update_stat(('eng', 'kappa'), log=False)
+
+    # -------------------------------------------------------------------------
+
+    @_ins.timed('Site1D.attenuation_decay')
+    def attenuation_decay(self):
+        """
+        Compute the frequency-dependent attenuation function
+        for a given site Kappa (0).
+        """
+
+        self._check_frequency()
+
+        kappa = None
+        if isinstance(self.model, Ensemble):
+            kappa = self.model.get_array(('eng', 'kappa'))
+
+        if kappa is not None and len(kappa) == len(self.model):
+            self.model.set_array(('amp', 'kappa'), _amp.attenuation_decay(
+                self.freq, _np.reshape(kappa, (-1, 1))))
+
+        else:
+            for mod in self.model:
+
+                # Compute attenuation decay
+                att_fun = _amp.attenuation_decay(self.freq, mod.eng['kappa'])
+
+                mod.amp['kappa'] = att_fun
+
+        # Perform statistics (log-normal)
+        self._update_stat(('amp', 'kappa'))
+
+    # -------------------------------------------------------------------------
+
+    @_ins.timed('Site1D.sh_transfer_function')
+    def sh_transfer_function(self, inc_ang=0., elastic=False, complex=False,
+                             attenuation=None):
+        """
+        Compute the complex SH-wave transfer function at the
+        surface for outcropping rock reference conditions.
+        Calculation can be done for an arbitrary angle of
+        incidence (0-90), elastic or anelastic.
+
+        For more options (e.g. calculation at arbitrary depth)
+        see the generic sh_transfer_function method in the
+        amplification module
+
+        Statistic is performed linearly on complex spectra
+        (to check!)
+
+        Propagator terms are kept between calls for each model
+        (up to SH_STATES models), so that after editing some layers
+        of the models only the changed part of the profiles is
+        recomputed (see response.SHPropagator).
+
+        :param float inc_ang:
+            angle of incidence in degrees, relative to the
+            vertical (default is vertical incidence)
+
+        :param boolean elastic:
+            switch between elastic and anelastic calculation
+            (default is anelastic)
+
+        :param boolean complex:
+            switch to output real (abs) or complex spectra
+            (note that type of statistic is affected)
+
+        :param attenuation.QModel attenuation:
+            attenuation model, e.g. frequency-dependent Q
+            (default is constant Q)
+        """
+
+        self._check_frequency()
+
+        if attenuation is None:
+            attenuation = _att.ConstantQ()
+
+        prop = self._shprop
+        if (prop is None or prop.inc_ang != inc_ang or
+                prop.attenuation != attenuation or
+                not _np.array_equal(prop.freq, self.freq)):
+            prop = _amp.SHPropagator(self.freq, inc_ang,
+                                     attenuation=attenuation,
+                                     state_size=SH_STATES)
+            self._shprop = prop
+
+        for index, mod in enumerate(self.model):
+
+            qs = mod.geo['qs'] if not elastic else None
+
+            # Compute transfer function
+            shtf = prop.transfer_function(mod.geo['hl'],
+                                          mod.geo['vs'],
+                                          mod.geo['dn'],
+                                          qs, index)
+
+            if complex:
+                mod.amp['shtf'] = shtf
+            else:
+                mod.amp['shtf'] = _np.abs(shtf)
+
+        # Perform statistics (normal on complex)
+        self._update_stat(('amp', 'shtf'), log=not complex)
+
+    # -------------------------------------------------------------------------
+
+    @_ins.timed('Site1D.psv_transfer_function')
+    def psv_transfer_function(self, inc_ang=0., wave='p', elastic=False,
+                              complex=False):
+        """
+        Compute the P-SV transfer function (radial and vertical
+        components) at the surface for outcropping rock reference
+        conditions, for an incident P or SV wave (see the
+        psv_transfer_function method in the amplification module).
+        Results are stored as 'psv_r' and 'psv_z'.
+
+        Models of an ensemble are processed together in blocks
+        (PSV_CHUNK), vectorised over models and frequencies.
+
+        :param float inc_ang:
+            angle of incidence (as for sh_transfer_function)
+
+        :param string wave:
+            type of incident wave, 'p' (default) or 'sv'
+
+        :param boolean elastic:
+            switch between elastic and anelastic calculation
+            (default is anelastic)
+
+        :param boolean complex:
+            switch to output real (abs) or complex spectra
+            (note that type of statistic is affected)
+        """
+
+        self._check_frequency()
+
+        def output(spec):
+            return spec if complex else _np.abs(spec)
+
+        if isinstance(self.model, Ensemble):
+            geo = self.model.geo
+            mnum = len(self.model)
+            dtype = 'complex128' if complex else 'float64'
+            result = [_np.zeros((mnum, len(self.freq)), dtype=dtype),
+                      _np.zeros((mnum, len(self.freq)), dtype=dtype)]
+
+            for i0 in range(0, mnum, PSV_CHUNK):
+                block = dict((K, geo[K][i0:i0+PSV_CHUNK]) for K in geo)
+                spec = _amp.psv_transfer_function_array(
+                    self.freq, block['hl'], block['vp'], block['vs'],
+                    block['dn'], None if elastic else block['qp'],
+                    None if elastic else block['qs'], inc_ang, wave)
+                for nc in range(2):
+                    result[nc][i0:i0+PSV_CHUNK] = output(spec[nc])
+
+            self.model.set_array(('amp', 'psv_r'), result[0])
+            self.model.set_array(('amp', 'psv_z'), result[1])
+
+        else:
+            for mod in self.model:
+                spec = _amp.psv_transfer_function(
+                    self.freq, mod.geo['hl'], mod.geo['vp'], mod.geo['vs'],
+                    mod.geo['dn'], None if elastic else mod.geo['qp'],
+                    None if elastic else mod.geo['qs'], inc_ang, wave)
+                mod.amp['psv_r'] = output(spec[0])
+                mod.amp['psv_z'] = output(spec[1])
+
+        # Perform statistics (normal on complex)
+        self._update_stat(('amp', 'psv_r'), log=not complex)
+        self._update_stat(('amp', 'psv_z'), log=not complex)
+
+    # -------------------------------------------------------------------------
+
+    @_ins.timed('Site1D.dispersion_curve')
+    def dispersion_curve(self, wave='rayleigh', modes=1, grid=_dsp.GRID):
+        """
+        Compute the phase velocity dispersion curves of surface waves
+        (see the dispersion_curve method in the dispersion module).
+        Results are stored as 'rayleigh' or 'love', as arrays of
+        frequencies (or modes x frequencies if more than one mode
+        is requested), with nan where a mode does not exist.
+
+        Models of an ensemble are processed together, vectorised
+        over models and frequencies.
+
+        :param string wave:
+            'rayleigh' (default) or 'love'
+
+        :param int modes:
+            number of modes (default is the fundamental only)
+
+        :param int grid:
+            number of phase velocities for the root bracketing
+        """
+
+        self._check_frequency()
+
+        def output(velocity):
+            if modes == 1:
+                return velocity[..., 0]
+            return _np.swapaxes(velocity, -1, -2)
+
+        if isinstance(self.model, Ensemble):
+            geo = self.model.geo
+            self.model.set_array(('amp', wave), output(
+                _dsp.dispersion_curve_array(self.freq, geo['hl'], geo['vp'],
+                                            geo['vs'], geo['dn'], wave,
+                                            modes, grid)))
+
+        else:
+            for mod in self.model:
+                mod.amp[wave] = output(_dsp.dispersion_curve(
+                    self.freq, mod.geo['hl'], mod.geo['vp'], mod.geo['vs'],
+                    mod.geo['dn'], wave, modes, grid))
+
+        # Perform statistics
+        self._update_stat(('amp', wave))
+
+    # -------------------------------------------------------------------------
+
+    @_ins.timed('Site1D.hv_ratio')
+    def hv_ratio(self, grid=_dsp.GRID):
+        """
+        Compute the H/V spectral ratio as the ellipticity of the
+        fundamental mode of Rayleigh waves (see the ellipticity method
+        in the dispersion module). Results are stored as 'hv'.
+
+        :param int grid:
+            number of phase velocities for the root bracketing
+        """
+
+        self._check_frequency()
+
+        if isinstance(self.model, Ensemble):
+            geo = self.model.geo
+            self.model.set_array(('amp', 'hv'), _dsp.ellipticity_array(
+                self.freq, geo['hl'], geo['vp'], geo['vs'], geo['dn'],
+                grid=grid))
+
+        else:
+            for mod in self.model:
+                mod.amp['hv'] = _dsp.ellipticity(
+                    self.freq, mod.geo['hl'], mod.geo['vp'], mod.geo['vs'],
+                    mod.geo['dn'], grid=grid)
+
+        # Perform statistics
+        self._update_stat(('amp', 'hv'))
+
+    # -------------------------------------------------------------------------
+
+    @_ins.timed('Site1D.resonance_frequency')
+    def resonance_frequency(self):
+        """
+        Identify resonance frequencies on an amplification spectrum.
+        Note that frequency on the average spectrum are identified
+        directly without performing statistic on the single models.
+        """
+
+        for mod in self.model:
+            mod.amp['fn'] = _amp.resonance_frequency(self.freq,
+                                                     mod.amp['shtf'])
 
         fn = _amp.resonance_frequency(self.freq,
                                       self.mean.amp['shtf'][0])
         self.mean.amp['fn'] = fn
+
+    # -------------------------------------------------------------------------
+
+    @_ins.timed('Site1D.compute_percentiles')
+    def compute_percentiles(self, perc=[16., 50., 84.], exact=None):
+        """
+        Compute percentiles of all the products with available
+        statistics. Results are stored as a dictionary of
+        {percentile: values} in the percentiles model.
+        Complex products are skipped. Percentiles are weighted
+        if the models have different weights.
+
+        :param list perc:
+            list of percentiles (0-100) to compute
+            (default is 16, 50 and 84)
+
+        :param boolean exact:
+            if True, percentiles are computed from the models in
+            the site database; if False, from the quantile sketches.
+            By default, sketches are used when available.
+        """
+
+        for path in self._stat:
+            if path in self._sketch and not exact:
+                values = self._sketch[path].quantile(perc)
+                _set_path(self.percentiles, path,
+                          {p: v for p, v in zip(perc, values)})
+                continue
+
+            if exact is False:
+                continue
+
+            data, weights = _collect(self.model, path, True)
+
+            if not len(data) or _np.iscomplexobj(data[0]):
+                continue
+
+            values = _ut.weighted_percentile(data, perc, weights)
+            _set_path(self.percentiles, path,
+                      {p: v for p, v in zip(perc, values)})
+
+    # -------------------------------------------------------------------------
+
+    @_ins.timed('Site1D.stream_models')
+    def stream_models(self, models, products, chunk=1000, sample=0,
+                      perc=[], seed=None):
+        """
+        Streaming (Monte Carlo) mode: models are taken from an
+        arbitrary iterable (e.g. a generator), processed in chunks
+        and then discarded; only the accumulated statistics and an
+        optional random subset of the models (reservoir sampling)
+        are retained. Memory usage is then bounded by the chunk size.
+
+        Any previous model in the site database is replaced.
+        Note that percentiles, if requested, are computed on the
+        retained random subset of models only, unless quantile
+        sketches are enabled (see Site1D).
+
+        :param iterable models:
+            the models to be processed, as Model objects or
+            model file names (default csv format)
+
+        :param list products:
+            sequence of Site1D methods to be executed on each chunk,
+            as method names or tuples (name, dictionary of arguments),
+            e.g. [('traveltime_velocity', {'depth': 30.}),
+                  'compute_site_kappa']
+
+        :param int chunk:
+            number of models processed at once (default 1000)
+
+        :param int sample:
+            number of models to retain in the site database
+            (default is none)
+
+        :param list perc:
+            list of percentiles (0-100) to compute on the
+            retained subset (optional)
+
+        :param int seed:
+            seed of the random generator used for the sampling
+            (optional)
+        """
+
+        rnd = _np.random.RandomState(seed)
+
+        # Site used as a temporary container for each chunk
+        site = Site1D(sketch=self.sketch)
+        site.freq = self.freq
+
+        # Products of the previous models are discarded
+        self.mean = Model()
+        self.percentiles = Model()
+        self._stat = {}
+        self._sketch = {}
+        subset = []
+        count = 0
+
+        for models_chunk in _ut.chunk_iter(models, chunk):
+
+            site.model = []
+            site._stat = {}
+            site._sketch = {}
+
+            for mod in models_chunk:
+                if not isinstance(mod, Model):
+                    mod, file_name = Model(), mod
+                    mod.from_file(file_name)
+                site.model.append(mod)
+
+            for product in products:
+                name, kwargs = _product_args(product)
+                getattr(site, name)(**kwargs)
+
+            # Merging chunk statistic
+            for path, stat in site._stat.items():
+                if path in self._stat:
+                    self._stat[path].merge(stat)
+                else:
+                    self._stat[path] = stat
+
+            for path, sketch in site._sketch.items():
+                if path in self._sketch:
+                    self._sketch[path].merge(sketch)
+                else:
+                    self._sketch[path] = sketch
+
+            # Reservoir sampling of the models
+            for mod in site.model:
+                if len(subset) < sample:
+                    subset.append(mod)
+                else:
+                    i = rnd.randint(0, count + 1)
+                    if i < sample:
+                        subset[i] = mod
+                count += 1
+
+        self.model = Ensemble.from_models(subset)
+
+        for path in self._stat:
+            self._set_mean(path)
+
+        # Products derived from the mean model
+        names = dict(_product_args(product) for product in products)
+
+        if 'compute_soil_class' in names:
+            vs30 = self.mean.eng['vsz'][30.][0]
+            self.mean.eng['class'] = _avg.gt_soil_class(
+                vs30, **names['compute_soil_class'])
+
+        if 'resonance_frequency' in names:
+            self.mean.amp['fn'] = _amp.resonance_frequency(
+                self.freq, self.mean.amp['shtf'][0])
+
+        if perc:
+            self.compute_percentiles(perc)
+
+
+# =============================================================================
+
+def _product_args(product):
+    """
+    Internal: split a product specification into
+    method name and dictionary of arguments.
+    """
+
+    if isinstance(product, (list, tuple)):
+        return product[0], dict(product[1])
+
+    return product, {}
+
+
+# =============================================================================
+
+def _get_path(model, path):
+    """
+    Internal: extract a (possibly nested) product from a model,
+    e.g. ('eng', 'vsz', 30.) for model.eng['vsz'][30.].
+    Returns None if the product is not available.
+    """
+
+    value = getattr(model, path[0])
+
+    try:
+        for key in path[1:]:
+            value = value[key]
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+
+    if isinstance(value, _np.ndarray) and not value.size:
+        return None
+
+    return value
+
+
+def _set_path(model, path, value):
+    """
+    Internal: store a (possibly nested) product into a model,
+    creating the intermediate dictionaries if missing.
+    """
+
+    container = getattr(model, path[0])
+
+    for key in path[1:-1]:
+        if not isinstance(container.get(key), dict):
+            container[key] = {}
+        container = container[key]
+
+    container[path[-1]] = value
+
+
+# =============================================================================
+
+class SiteCollection(object):
+    """
+    Collection of one-dimensional sites (e.g. for regional studies),
+    with a spatial index (kd-tree) over the site coordinates
+    for fast nearest-site, radius and bounding-box queries.
+    """
+
+    def __init__(self, sites=[]):
+
+        self.site = list(sites)
+        self._index_reset()
+
+    def _index_reset(self):
+        """
+        Internal: invalidate the spatial index
+        """
+
+        self._xy = None
+        self._tree = None
+        self._xsort = None
+        self._xs = None
+
+    # -------------------------------------------------------------------------
+
+    def __len__(self):
+
+        return len(self.site)
+
+    def __iter__(self):
+
+        return iter(self.site)
+
+    def __getitem__(self, index):
+
+        return self.site[index]
+
+    # -------------------------------------------------------------------------
+
+    def add_site(self, site, index=-1):
+        """
+        Add a single site to the collection
+
+        :param Site1D site:
+            the site to be added
+
+        :param int index:
+            index of where to include the site in the collection;
+            use -1 to append (default)
+        """
+
+        index = int(index)
+        if index < 0:
+            index = len(self.site)
+
+        self.site.insert(index, site)
+        self._index_reset()
+
+    def del_site(self, index=-1):
+        """
+        Remove a site from the collection
+
+        :param int index:
+            index of the site to be removed from the collection;
+            use -1 for the last position (default)
+        """
+
+        del self.site[int(index)]
+        self._index_reset()
+
+    # -------------------------------------------------------------------------
+
+    @property
+    def coords(self):
+        """
+        Array (sites x 2) of the horizontal site coordinates
+        """
+
+        if self._xy is None:
+            xy = [(s.head['x'], s.head['y']) for s in self.site]
+            self._xy = _np.array(xy, dtype='float64').reshape(-1, 2)
+
+        return self._xy
+
+    def build_index(self):
+        """
+        Build the spatial index of the site coordinates.
+        The index is also built on the first query, and it is
+        invalidated when sites are added or removed (note that
+        changes of the site coordinates are not tracked).
+        """
+
+        self._tree = _sps.cKDTree(self.coords)
+        self._xsort = _np.argsort(self.coords[:, 0], kind='mergesort')
+        self._xs = self.coords[self._xsort, 0]
+
+    def _check_index(self):
+        """
+        Internal: build the spatial index if missing
+        """
+
+        if self._tree is None:
+            self.build_index()
+
+    # -------------------------------------------------------------------------
+
+    def nearest(self, x, y, k=1):
+        """
+        Find the nearest site(s) to one or more locations.
+
+        :param float or numpy.array x, y:
+            coordinates of the query location(s)
+
+        :param int k:
+            number of nearest sites to return (default is one)
+
+        :return numpy.array (dist, index):
+            distances and indexes of the nearest sites
+        """
+
+        self._check_index()
+
+        points = _np.column_stack((_np.ravel(x), _np.ravel(y)))
+        dist, index = self._tree.query(points, k)
+
+        if _np.ndim(x) == 0:
+            dist, index = dist[0], index[0]
+
+        return dist, index
+
+    def within_radius(self, x, y, radius):
+        """
+        Find the sites within a given distance from a location.
+
+        :param float x, y:
+            coordinates of the query location
+
+        :param float radius:
+            search radius (same units of the coordinates)
+
+        :return numpy.array index:
+            sorted indexes of the sites
+        """
+
+        self._check_index()
+
+        index = self._tree.query_ball_point((x, y), radius)
+
+        return _np.sort(_np.array(index, dtype='int64'))
+
+    def within_bbox(self, xmin, ymin, xmax, ymax):
+        """
+        Find the sites within a bounding box (boundaries included).
+
+        :param float xmin, ymin, xmax, ymax:
+            limits of the bounding box
+
+        :return numpy.array index:
+            sorted indexes of the sites
+        """
+
+        self._check_index()
+
+        i0 = _np.searchsorted(self._xs, xmin, side='left')
+        i1 = _np.searchsorted(self._xs, xmax, side='right')
+
+        index = self._xsort[i0:i1]
+        y = self.coords[index, 1]
+        index = index[(y >= ymin) & (y <= ymax)]
+
+        return _np.sort(index)
+
+    # -------------------------------------------------------------------------
+
+    def frequency_axis(self, fmin, fmax, fnum, log=True):
+        """
+        Set the same frequency axis to all the sites
+        (see Site1D.frequency_axis)
+        """
+
+        freq = _amp.frequency_axis(fmin, fmax, fnum, log)
+
+        for site in self.site:
+            site.freq = freq
+
+    def run(self, products, index=None):
+        """
+        Execute a sequence of Site1D methods on all (or a subset)
+        of the sites of the collection.
+
+        :param list products:
+            sequence of Site1D methods to be executed,
+            as method names or tuples (name, dictionary of arguments),
+            e.g. [('traveltime_velocity', {'depth': 30.}),
+                  'compute_site_kappa']
+
+        :param list or numpy.array index:
+            indexes of the sites to process (default is all)
+        """
+
+        if index is None:
+            index = range(len(self.site))
+
+        products = [_product_args(product) for product in products]
+
+        for ns in index:
+            for name, kwargs in products:
+                getattr(self.site[ns], name)(**kwargs)
+
+    # -------------------------------------------------------------------------
+
+    def summary(self):
+        """
+        Collect the main (mean) parameters of all the sites:
+        coordinates, Vs30, kappa, fundamental frequency and class.
+        Missing parameters are set to nan (or None for the class).
+
+        :return dict summary:
+            dictionary of arrays with the site parameters
+        """
+
+        keys = ['id', 'x', 'y', 'z', 'vs30', 'kappa', 'f0', 'class']
+        data = {key: [] for key in keys}
+
+        for site in self.site:
+            for key in ['id', 'x', 'y', 'z']:
+                data[key].append(site.head[key])
+
+            value = _get_path(site.mean, ('eng', 'vsz', 30.))
+            data['vs30'].append(value[0] if value is not None else _np.nan)
+
+            value = _get_path(site.mean, ('eng', 'kappa'))
+            data['kappa'].append(value[0] if value is not None else _np.nan)
+
+            value = _get_path(site.mean, ('amp', 'fn'))
+            data['f0'].append(value[0][0] if value else _np.nan)
+
+            value = _get_path(site.mean, ('eng', 'class'))
+            data['class'].append(value)
+
+        summary = {key: _np.array(data[key], dtype='float64')
+                   for key in ['x', 'y', 'z', 'vs30', 'kappa', 'f0']}
+        summary['id'] = _np.array(data['id'], dtype='object')
+        summary['class'] = _np.array(data['class'], dtype='object')
+
+        return summary
+
+    def to_file(self, ascii_file, delimiter=',', decimals=DECIMALS):
+        """
+        Export the summary parameters of all the sites
+        to a tabular ascii file.
+
+        :param string ascii_file:
+            output file name
+
+        :param char delimiter:
+            character separator between data fields;
+            default value is comma
+
+        :param int decimals:
+            output precision (None for full precision)
+        """
+
+        keys = ['id', 'x', 'y', 'z', 'vs30', 'kappa', 'f0', 'class']
+        summary = _ut.set_precision(self.summary(), decimals)
+
+        with open(ascii_file, 'w') as f:
+            f.write(delimiter.join(keys) + '\n')
+            for ns in range(len(self.site)):
+                line = [str(summary[key][ns]) for key in keys]
+                f.write(delimiter.join(line) + '\n')
@@ -28,6 +28,8 @@ soil parameters, such as travel-time average velocity and site kappa.
 import numpy as _np
 import scipy.optimize as _spo
 
+import openquake.srtk.instrument as _ins
+
 
 # =============================================================================
 
@@ -126,7 +128,7 @@ def compute_site_kappa(thickness, s_velocity, s_quality, depth=[]):
 
     # If depth not given, using the whole profile
     if not depth:
-        depth = _np.sum(thickness)
+        depth = _np.nansum(thickness)
 
     # Kappa vector
     layer_kappa = depth/(s_velocity*s_quality)
@@ -139,6 +141,158 @@ def compute_site_kappa(thickness, s_velocity, s_quality, depth=[]):
 
 # =============================================================================
 
+def depth_weighted_average_array(thickness, soil_param, depth):
+    """
+    Vectorised version of depth_weighted_average for a set of profiles
+    stored as (models x layers) arrays. Profiles can have a different
+    number of layers, padded with nans (the last valid layer of each
+    profile is the half-space).
+
+    :param numpy.array tickness:
+        array (models x layers) of layer's thicknesses in meters
+
+    :param numpy.array soil_param:
+        array (models x layers) of soil properties
+
+    :param float or numpy.array depth:
+        averaging depth in meters (scalar or one per model)
+
+    :return numpy.array mean_param:
+        the weighted mean of the given soil property for each model
+    """
+
+    portion, param = _depth_portion(thickness, soil_param, depth)
+
+    return _np.sum(portion*param, axis=1)/depth
+
+
+def _depth_portion(thickness, soil_param, depth, valid=None):
+    """
+    Internal: thickness of each layer within the averaging depth
+    (valid layers are those with non-nan parameter, if not given)
+    """
+
+    thickness = _np.atleast_2d(_np.asarray(thickness, dtype='float64'))
+    param = _np.atleast_2d(_np.asarray(soil_param, dtype='float64'))
+    depth = _np.reshape(depth, (-1, 1))
+
+    if valid is None:
+        valid = ~_np.isnan(param)
+    last = _np.sum(valid, axis=1) - 1
+
+    # Half-space has infinite thickness
+    thickness = _np.where(valid, _np.nan_to_num(thickness), 0.)
+    thickness[_np.arange(len(last)), last] = _np.inf
+
+    top = _np.cumsum(thickness[:, :-1], axis=1)
+    top = _np.hstack((_np.zeros((len(top), 1)), top))
+
+    portion = _np.clip(depth - top, 0., thickness)
+
+    return portion, _np.where(valid, param, 0.)
+
+
+def traveltime_velocity_array(thickness, s_velocity, depth=30):
+    """
+    Vectorised version of traveltime_velocity for a set of profiles
+    stored as (models x layers) arrays (see depth_weighted_average_array).
+
+    :param numpy.array tickness:
+        array (models x layers) of layer's thicknesses in meters
+
+    :param numpy.array s_velocity:
+        array (models x layers) of shear-wave velocities in m/s
+
+    :param float depth:
+        averaging depth in meters (default is 30m)
+
+    :return numpy.array mean_velocity:
+        the average velocity in m/s for each model
+    """
+
+    slowness = 1./_np.asarray(s_velocity, dtype='float64')
+
+    return 1./depth_weighted_average_array(thickness, slowness, depth)
+
+
+def compute_site_kappa_array(thickness, s_velocity, s_quality, depth=[]):
+    """
+    Vectorised version of compute_site_kappa for a set of profiles
+    stored as (models x layers) arrays (see depth_weighted_average_array).
+
+    :param numpy.array tickness:
+        array (models x layers) of layer's thicknesses in meters
+
+    :param numpy.array s_velocity:
+        array (models x layers) of shear-wave velocities in m/s
+
+    :param numpy.array s_quality:
+        array (models x layers) of shear-wave quality factors
+
+    :param float depth:
+        averaging depth in meters; if depth is not specified,
+        the last layer interface of each profile is used instead
+
+    :return numpy.array kappa0:
+        the site attenuation parameter kappa(0) in seconds
+    """
+
+    s_velocity = _np.atleast_2d(_np.asarray(s_velocity, dtype='float64'))
+
+    if not _np.size(depth):
+        # Sum of the thicknesses above the half-space
+        depth = _np.nansum(_np.where(_np.isnan(s_velocity), 0.,
+                                     thickness), axis=1)
+
+    portion, param = _depth_portion(thickness, 1./(s_velocity*s_quality),
+                                    depth, ~_np.isnan(s_velocity))
+
+    return _np.sum(portion*param, axis=1)
+
+
+# =============================================================================
+
+def depth_to_velocity(thickness, s_velocity, velocity=1000.):
+    """
+    Compute the depth to the top of the first layer with shear-wave
+    velocity equal or larger than a given value (e.g. the Z1.0 and
+    Z2.5 parameters). Works for single profiles or for sets of profiles
+    stored as (models x layers) arrays, padded with nans.
+
+    :param numpy.array tickness:
+        array of layer's thicknesses in meters (half-space is 0.)
+
+    :param numpy.array s_velocity:
+        array of layer's shear-wave velocities in m/s
+
+    :param float velocity:
+        the velocity threshold in m/s (default is 1000 m/s)
+
+    :return float or numpy.array depth:
+        depth in meters (nan if the velocity is never reached)
+    """
+
+    single = (_np.ndim(s_velocity) == 1)
+
+    thickness = _np.atleast_2d(_np.asarray(thickness, dtype='float64'))
+    s_velocity = _np.atleast_2d(_np.asarray(s_velocity, dtype='float64'))
+
+    top = _np.cumsum(_np.nan_to_num(thickness), axis=1)
+    top = _np.hstack((_np.zeros((len(top), 1)), top[:, :-1]))
+
+    # Nans are never above the threshold
+    above = _np.nan_to_num(s_velocity) >= velocity
+    first = _np.argmax(above, axis=1)
+
+    depth = top[_np.arange(len(top)), first]
+    depth[~_np.any(above, axis=1)] = _np.nan
+
+    return depth[0] if single else depth
+
+
+# =============================================================================
+
+@_ins.timed('soil.quarter_wavelength_average')
 def quarter_wavelength_average(thickness, s_velocity, density, frequency):
     """
     This function solves the quarter-wavelength problem (Boore 2003)
@@ -183,7 +337,10 @@ def quarter_wavelength_average(thickness, s_velocity, density, frequency):
         args = (thickness, slowness, frequency[nf])
 
         # Compute the quarter-wavelength depth
-        qwl_depth[nf] = _spo.fminbound(_qwl_fit_func, 0., ubnd, args)
+        result = _spo.fminbound(_qwl_fit_func, 0., ubnd, args,
+                                full_output=True)
+        qwl_depth[nf] = result[0]
+        _ins.count('evals', result[3])
 
         # Computing average soil property at the qwl-depth
         qwl_velocity[nf] = 1./depth_weighted_average(thickness,
@@ -198,6 +355,164 @@ def quarter_wavelength_average(thickness, s_velocity, density, frequency):
     return qwl_depth, qwl_velocity, qwl_density
 
 
+def quarter_wavelength_jacobian(thickness, s_velocity, density, frequency):
+    """
+    Quarter-wavelength average velocity and density (Boore 2003)
+    together with their analytic derivatives with respect to the
+    layer parameters.
+
+    The quarter-wavelength depth is that at which the vertical
+    travel-time equals a quarter of the period, and it is here
+    obtained in closed form (vectorised over frequency) from the
+    travel-time at the layer interfaces; the derivatives follow
+    by implicit differentiation. Results are equivalent to those
+    of quarter_wavelength_average (within its search tolerance).
+    Quality factors do not affect the averages.
+
+    :param numpy.array tickness:
+        array of layer's thicknesses in meters (half-space is 0.)
+
+    :param numpy.array s_velocity:
+        array of layer's shear-wave velocities in m/s
+
+    :param numpy.array density:
+        array of layer's densities in kg/m3
+
+    :param numpy.array frequency:
+        array of frequencies in Hz for the calculation
+
+    :return numpy.array qwl_depth:
+        array of averaging depths
+
+    :return numpy.array qwl_velocity:
+        array of quarter-wavelength average velocities
+
+    :return numpy.array qwl_density:
+        array of quarter-wavelength average dencities
+
+    :return dict jac:
+        derivatives of depth ('z'), velocity ('vs') and density
+        ('dn'), each as a dictionary of (frequencies x layers)
+        arrays for the parameters 'hl', 'vs' and 'dn'
+    """
+
+    hl = _np.nan_to_num(_np.array(thickness, dtype='float64'))
+    vs = _np.asarray(s_velocity, dtype='float64')
+    dn = _np.asarray(density, dtype='float64')
+    freq = _np.asarray(frequency, dtype='float64')
+
+    # Half-space has infinite thickness
+    hl[-1] = _np.inf
+
+    # Depth and travel-time at the top of the layers
+    top = _np.append(0., _np.cumsum(hl[:-1]))
+    ttop = _np.append(0., _np.cumsum(hl[:-1]/vs[:-1]))
+
+    # Layer of the quarter-wavelength depth
+    target = 1./(4.*freq)
+    lay = _np.searchsorted(ttop, target, side='right') - 1
+
+    qwl_depth = top[lay] + (target - ttop[lay])*vs[lay]
+    qwl_velocity = 4.*freq*qwl_depth
+
+    z = qwl_depth[:, None]
+    portion = _np.clip(z - top, 0., hl)
+    qwl_density = _np.dot(portion, dn)/qwl_depth
+
+    # Implicit derivatives of the depth (at fixed travel-time);
+    # thicker layers above the depth shift the deeper interfaces
+    above = _np.arange(len(vs)) < lay[:, None]
+    vs_q = vs[lay][:, None]
+    dn_q = dn[lay][:, None]
+
+    dz = {'hl': _np.where(above, 1. - vs_q/vs, 0.),
+          'vs': portion*vs_q/(vs**2.),
+          'dn': _np.zeros_like(portion)}
+
+    # Density: mass per unit area over depth
+    dr = {'hl': _np.where(above, dn - dn_q, 0.),
+          'vs': 0.,
+          'dn': portion}
+
+    jac = {'z': dz, 'vs': {}, 'dn': {}}
+    for key in dz:
+        jac['vs'][key] = 4.*freq[:, None]*dz[key]
+        jac['dn'][key] = ((dr[key] + (dn_q - qwl_density[:, None])*dz[key]) /
+                          z)
+
+    return qwl_depth, qwl_velocity, qwl_density, jac
+
+
+@_ins.timed('soil.quarter_wavelength_average_array')
+def quarter_wavelength_average_array(thickness, s_velocity, density,
+                                     frequency):
+    """
+    Vectorised version of quarter_wavelength_average for a set of
+    profiles stored as (models x layers) arrays, padded with nans
+    (see depth_weighted_average_array). The quarter-wavelength depth
+    is obtained in closed form from the travel-time at the layer
+    interfaces, as in quarter_wavelength_jacobian.
+
+    :param numpy.array tickness:
+        array (models x layers) of layer's thicknesses in meters
+
+    :param numpy.array s_velocity:
+        array (models x layers) of shear-wave velocities in m/s
+
+    :param numpy.array density:
+        array (models x layers) of densities in kg/m3
+
+    :param numpy.array frequency:
+        array of frequencies in Hz for the calculation
+
+    :return numpy.array qwl_depth:
+        array (models x frequencies) of averaging depths
+
+    :return numpy.array qwl_velocity:
+        array (models x frequencies) of average velocities
+
+    :return numpy.array qwl_density:
+        array (models x frequencies) of average densities
+    """
+
+    vs = _np.atleast_2d(_np.asarray(s_velocity, dtype='float64'))
+    freq = _np.asarray(frequency, dtype='float64')
+
+    valid = ~_np.isnan(vs)
+    last = _np.sum(valid, axis=1) - 1
+    index = _np.arange(len(vs))
+
+    # Half-space has infinite thickness (padding layers none)
+    hl = _np.atleast_2d(_np.array(thickness, dtype='float64'))
+    hl = _np.where(valid, _np.nan_to_num(hl), 0.)
+    hl[index, last] = _np.inf
+    vs = _np.where(valid, vs, 1.)
+    dn = _np.where(valid, _np.atleast_2d(density), 0.)
+
+    # Depth, travel-time and mass at the top of the layers
+    def tops(value):
+        return _np.hstack((_np.zeros((len(value), 1)),
+                           _np.cumsum(value[:, :-1], axis=1)))
+
+    top = tops(hl)
+    ttop = tops(hl/vs)
+    mtop = tops(hl*dn)
+
+    # Layer of the quarter-wavelength depth
+    target = 1./(4.*freq)
+    lay = -_np.ones((len(vs), len(freq)), dtype='int64')
+    for nl in range(vs.shape[1]):
+        lay += ttop[:, nl, None] <= target
+
+    nm = index[:, None]
+    qwl_depth = top[nm, lay] + (target - ttop[nm, lay])*vs[nm, lay]
+    qwl_velocity = 4.*freq*qwl_depth
+    qwl_density = (mtop[nm, lay] + (qwl_depth - top[nm, lay])*dn[nm, lay]
+                   )/qwl_depth
+
+    return qwl_depth, qwl_velocity, qwl_density
+
+
 # =============================================================================
 
 def _qwl_fit_func(search_depth, thickness, slowness, frequency):
@@ -0,0 +1,184 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+
+import unittest
+import numpy as np
+import numpy.testing as npt
+
+from openquake.srtk import attenuation
+from openquake.srtk import response
+from openquake.srtk import sitedb
+
+
+# =============================================================================
+
+class AttenuationTestCase(unittest.TestCase):
+    """
+    Test the attenuation models and their use in the SH-wave solvers
+    """
+
+    def setUp(self):
+
+        self.freq = response.frequency_axis(0.5, 20., 30)
+        self.geo = {'hl': np.array([10., 20., 15., 0.]),
+                    'vs': np.array([200., 400., 700., 1500.]),
+                    'dn': np.array([1800., 1900., 2000., 2300.]),
+                    'qs': np.array([10., 20., 30., 100.])}
+
+        self.models = [attenuation.PowerLawQ(0.4, 2.),
+                       attenuation.CausalQ(),
+                       attenuation.CausalQ(-0.3, 5.)]
+
+    def test_models(self):
+        """
+        Quality factor and velocity dispersion of the models
+        """
+
+        vs, qs = self.geo['vs'], self.geo['qs']
+        freq = np.array([1., 5., 20.])
+
+        # Constant Q: frequency-independent, as the solvers
+        vel = attenuation.ConstantQ().complex_velocity(freq, vs, qs)
+        npt.assert_array_equal(vel, vs*(2.*qs*1j)/(2.*qs*1j - 1.))
+
+        for model in [attenuation.PowerLawQ(0.5, 5.),
+                      attenuation.CausalQ(0.5, 5.),
+                      attenuation.CausalQ(0., 5.)]:
+            vel = model.complex_velocity(freq, vs, qs)
+            self.assertEqual(vel.shape, (4, 3))
+
+            # Quality factor from the complex velocity
+            qual = np.real(1./vel)/(2.*np.imag(1./vel))
+            npt.assert_allclose(qual, model.quality(freq, qs), rtol=1e-10)
+
+            # Phase velocity at the reference frequency
+            npt.assert_allclose(np.real(vel[:, 1]), np.real(
+                attenuation.ConstantQ().complex_velocity(5., vs, qs)))
+
+        # Causal models: phase velocity increases with frequency
+        for model in self.models[1:]:
+            vel = model.complex_velocity(freq, vs, qs)
+            self.assertTrue(np.all(np.diff(np.real(1./vel), axis=1) < 0.))
+
+        self.assertEqual(attenuation.CausalQ(0.2), attenuation.CausalQ(0.2))
+        self.assertNotEqual(attenuation.CausalQ(0.2),
+                            attenuation.PowerLawQ(0.2))
+        self.assertRaises(ValueError, attenuation.CausalQ, 1.)
+
+    def test_reference(self):
+        """
+        Frequency-independent limits of the models
+        """
+
+        geo = self.geo
+        shtf = response.SHPropagator(self.freq).transfer_function(**geo)
+
+        prop = response.SHPropagator(self.freq,
+                                     attenuation=attenuation.PowerLawQ(0.))
+        npt.assert_allclose(prop.transfer_function(**geo), shtf, rtol=1e-12)
+
+        # Single frequency at the reference
+        model = attenuation.CausalQ(0.3, self.freq[7])
+        prop = response.SHPropagator(self.freq[7:8], attenuation=model)
+        npt.assert_allclose(prop.transfer_function(**geo), shtf[7:8],
+                            rtol=1e-12)
+
+    def test_solvers(self):
+        """
+        Knopoff, propagator and vectorised solvers, against
+        constant-Q calculations at each frequency
+        """
+
+        geo = self.geo
+
+        for model in self.models:
+            for inc_ang in [0., 0.3]:
+                prop = response.SHPropagator(self.freq, inc_ang,
+                                             attenuation=model)
+                shtf = prop.transfer_function(**geo)
+
+                disp = response.sh_transfer_function(
+                    self.freq, inc_ang=inc_ang, attenuation=model, **geo)
+                npt.assert_allclose(disp[0]/2., shtf, rtol=1e-10)
+
+                array = response.sh_transfer_function_array(
+                    self.freq, [geo['hl']], [geo['vs']], [geo['dn']],
+                    [geo['qs']], inc_ang, attenuation=model)
+                npt.assert_allclose(array[0], shtf, rtol=1e-10)
+
+                vel = model.complex_velocity(self.freq, geo['vs'], geo['qs'])
+                for nf in [0, 12, 29]:
+                    single = response.SHPropagator(self.freq[nf], inc_ang)
+                    npt.assert_allclose(single.transfer_function(
+                        geo['hl'], vel[:, nf], geo['dn']), shtf[nf:nf+1],
+                        rtol=1e-10)
+
+    def test_jacobian(self):
+        """
+        Analytic derivatives against finite differences
+        """
+
+        geo = self.geo
+
+        for model in self.models:
+            for inc_ang in [0., 0.3]:
+                shtf, jac = response.sh_transfer_jacobian(
+                    self.freq, inc_ang=inc_ang, attenuation=model, **geo)
+
+                for key in ['vs', 'qs']:
+                    for nl in range(4):
+                        delta = 1e-6*geo[key][nl]
+                        upper = dict(geo)
+                        upper[key] = geo[key].copy()
+                        upper[key][nl] += delta
+                        lower = dict(geo)
+                        lower[key] = geo[key].copy()
+                        lower[key][nl] -= delta
+
+                        prop = response.SHPropagator(self.freq, inc_ang,
+                                                     attenuation=model)
+                        diff = (prop.transfer_function(**upper) -
+                                prop.transfer_function(**lower))/(2.*delta)
+
+                        npt.assert_allclose(jac[key][:, nl], diff,
+                                            rtol=1e-5, atol=1e-7)
+
+    def test_site(self):
+        """
+        Site calculation with a frequency-dependent model
+        """
+
+        site = sitedb.Site1D()
+        site.frequency_axis(0.5, 20., 30)
+        site.add_model_array(dict((k, v[None]) for k, v in self.geo.items()))
+
+        site.sh_transfer_function()
+        npt.assert_array_equal(site.model[0].amp['shtf'], np.abs(
+            response.SHPropagator(site.freq).transfer_function(**self.geo)))
+
+        model = attenuation.CausalQ(0.2)
+        site.sh_transfer_function(attenuation=model)
+        self.assertEqual(site._shprop.attenuation, model)
+        npt.assert_allclose(site.model[0].amp['shtf'], np.abs(
+            response.SHPropagator(site.freq, attenuation=model)
+            .transfer_function(**self.geo)), rtol=1e-12)
@@ -0,0 +1,257 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from openquake.srtk import batch
+from openquake.srtk import memory
+from openquake.srtk import sitedb
+
+MODEL = """hl,vp,vs,dn,qp,qs
+10,300,{0},1900,50,20
+10,500,300,1900,50,20
+0,1000,800,2100,100,50
+"""
+
+CONFIG = {'frequency': [0.5, 20., 20],
+          'products': [['traveltime_velocity', {'depth': 30}],
+                       'compute_soil_class',
+                       'sh_transfer_function']}
+
+
+# =============================================================================
+
+class BatchRunnerTestCase(unittest.TestCase):
+    """
+    Test the resumable batch runner
+    """
+
+    def setUp(self):
+
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'sites')
+        self.out = os.path.join(self.tmp, 'results')
+        os.makedirs(self.src)
+
+        for ns in range(6):
+            name = os.path.join(self.src, 'site{0:02d}.csv'.format(ns))
+            with open(name, 'w') as f:
+                f.write(MODEL.format(150 + 10*ns))
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmp)
+
+    def test_resume(self):
+        """
+        Processing with two workers, then resuming the full list
+        """
+
+        sites = batch.read_manifest(self.src)
+        self.assertEqual(len(sites), 6)
+
+        stats = batch.run_batch(sites, CONFIG, self.out, worker=1,
+                                workers=2, stream=None)
+        self.assertEqual(stats['processed'], 3)
+        self.assertEqual(batch.completed_sites(self.out),
+                         set(['site01', 'site03', 'site05']))
+
+        stats = batch.run_batch(sites, CONFIG, self.out, stream=None)
+        self.assertEqual(stats['processed'], 3)
+        self.assertEqual(stats['skipped'], 3)
+
+        with open(os.path.join(self.out, 'site02.json')) as f:
+            record = json.load(f)
+        self.assertEqual(record['head']['id'], 'site02')
+        self.assertEqual(record['mean']['eng']['class'], 'C')
+        self.assertEqual(len(record['mean']['amp']['shtf'][0]), 20)
+
+    def test_manifest(self):
+        """
+        Command-line run from a manifest file with failures
+        """
+
+        manifest = os.path.join(self.tmp, 'manifest.csv')
+        with open(manifest, 'w') as f:
+            f.write('id,x,y,z,file\n')
+            f.write('a,1.,2.,0.,sites/site00.csv;sites/site01.csv\n')
+            f.write('b,3.,4.,0.,sites/missing.csv\n')
+
+        config = os.path.join(self.tmp, 'config.json')
+        with open(config, 'w') as f:
+            json.dump(CONFIG, f)
+
+        status = batch.main([manifest, self.out, '-c', config,
+                             '--report', '0'])
+
+        self.assertEqual(status, 1)
+        self.assertEqual(batch.completed_sites(self.out), set(['a']))
+
+        with open(os.path.join(self.out, 'a.json')) as f:
+            record = json.load(f)
+        self.assertEqual(record['models'], 2)
+        self.assertEqual(record['head']['x'], 1.)
+
+    def test_site_ids(self):
+        """
+        Model files of other formats, duplicate and unsafe site ids
+        """
+
+        with open(os.path.join(self.src, 'site01.mod'), 'w') as f:
+            f.write('other format')
+        sites = batch.read_manifest(self.src)
+        self.assertEqual([s['id'] for s in sites],
+                         ['site{0:02d}'.format(ns) for ns in range(6)])
+        self.assertEqual(len(batch.read_manifest(self.src, pattern='*.mod')),
+                         1)
+        self.assertRaises(ValueError, batch.read_manifest, self.src,
+                          pattern='*')
+
+        manifest = os.path.join(self.tmp, 'manifest.csv')
+        with open(manifest, 'w') as f:
+            f.write('id,x,y,z,file\n')
+            f.write('a/b,1.,2.,0.,sites/site00.csv\n')
+            f.write('c,3.,4.,0.,sites/site01.csv\n')
+
+        sites = batch.read_manifest(manifest)
+        stats = batch.run_batch(sites, CONFIG, self.out, stream=None)
+        self.assertEqual(stats['processed'], 2)
+        self.assertEqual(batch.completed_sites(self.out), set(['a/b', 'c']))
+        self.assertTrue(os.path.isfile(os.path.join(self.out, 'a_b.json')))
+
+        with open(manifest, 'a') as f:
+            f.write('a_b,5.,6.,0.,sites/site02.csv\n')
+        self.assertRaises(ValueError, batch.read_manifest, manifest)
+
+    def test_instrument(self):
+        """
+        Per-site and aggregated instrumentation reports
+        """
+
+        sites = batch.read_manifest(self.src)[:2]
+        config = dict(CONFIG, instrument=True)
+
+        stats = batch.run_batch(sites, config, self.out, stream=None)
+        self.assertEqual(stats['profile']['Site1D.read_model']['calls'], 2)
+
+        with open(os.path.join(self.out, 'site01.json')) as f:
+            record = json.load(f)
+        self.assertEqual(
+            record['profile']['response.SHPropagator']['calls'], 1)
+        self.assertTrue(os.path.isfile(os.path.join(self.out,
+                                                    'profile.0.json')))
+
+    def test_interrupted(self):
+        """
+        Logs are closed if the run is interrupted by an error
+        """
+
+        sites = batch.read_manifest(self.src)[:3]
+        sites[0]['file'] = ['missing.csv']
+        files = []
+        site_record = batch.site_record
+
+        def tracked_open(*args):
+            files.append(open(*args))
+            return files[-1]
+
+        def failing_record(site, *args):
+            if site.head['id'] == 'site02':
+                raise RuntimeError('Interrupted')
+            return site_record(site, *args)
+
+        batch.open = tracked_open
+        batch.site_record = failing_record
+        try:
+            self.assertRaises(RuntimeError, batch.run_batch, sites, CONFIG,
+                              self.out, stream=None)
+        finally:
+            del batch.open
+            batch.site_record = site_record
+
+        self.assertTrue(all(f.closed for f in files))
+        self.assertEqual(batch.completed_sites(self.out), set(['site01']))
+        with open(os.path.join(self.out, batch.FAIL_LOG.format(0))) as f:
+            self.assertTrue(f.read().startswith('site00\t'))
+
+    def test_memory_budget(self):
+        """
+        Sites above the memory budget, in chunked mode or refused
+        """
+
+        sites = batch.read_manifest(self.src)[:2]
+        sites[0]['file'] = sites[0]['file']*4
+
+        site = batch.run_site(sites[0], CONFIG)
+        config = dict(CONFIG, memory_budget=0.001, memory_action='chunk')
+        chunked = batch.run_site(sites[0], config)
+
+        self.assertEqual(chunked.mean.eng['class'], site.mean.eng['class'])
+        self.assertAlmostEqual(chunked.mean.amp['shtf'][0][5],
+                               site.mean.amp['shtf'][0][5])
+
+        config['memory_action'] = 'refuse'
+        stats = batch.run_batch(sites, config, self.out, stream=None)
+        self.assertEqual(stats['failed'], 2)
+
+    def test_memory_chunk(self):
+        """
+        In chunked mode, models are never loaded all together
+        and each model file is parsed once
+        """
+
+        site_info = batch.read_manifest(self.src)[0]
+        site_info['file'] = site_info['file']*20
+
+        self.assertEqual(batch.scan_models(site_info['file']), (20, 3))
+
+        parsed = []
+        from_file = sitedb.Model.__dict__['from_file']
+        read_model = sitedb.Site1D.__dict__['read_model']
+
+        def count_file(model, *args, **kwargs):
+            parsed.append(args[0])
+            return from_file(model, *args, **kwargs)
+
+        def no_read(site, *args, **kwargs):
+            raise AssertionError('Full ensemble loaded')
+
+        config = dict(CONFIG, memory_budget=0.01, memory_action='chunk')
+        chunk = memory.chunk_size(0.01*1024.**2, 3, 20, CONFIG['products'])
+        self.assertTrue(1 <= chunk < 20)
+
+        sitedb.Model.from_file = count_file
+        sitedb.Site1D.read_model = no_read
+        try:
+            site = batch.run_site(site_info, config)
+        finally:
+            sitedb.Model.from_file = from_file
+            sitedb.Site1D.read_model = read_model
+
+        self.assertEqual(len(parsed), 20)
+        self.assertEqual(len(site.model), 0)
+        self.assertEqual(len(site.mean.amp['shtf'][0]), 20)
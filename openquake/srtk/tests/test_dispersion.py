@@ -0,0 +1,130 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+
+import unittest
+import numpy as np
+import numpy.testing as npt
+
+from openquake.srtk import dispersion
+
+
+# =============================================================================
+
+class DispersionTestCase(unittest.TestCase):
+    """
+    Test the surface-wave dispersion curves and ellipticity
+    """
+
+    def setUp(self):
+
+        # Layer over half-space (Poisson solids)
+        self.geo = {'hl': np.array([20., 0.]),
+                    'vp': np.array([200., 1000.])*np.sqrt(3.),
+                    'vs': np.array([200., 1000.]),
+                    'dn': np.array([1800., 2000.])}
+
+    def test_halfspace(self):
+        """
+        Rayleigh velocity and ellipticity of a homogeneous half-space
+        """
+
+        freq = np.array([1., 10.])
+        vs = np.array([500., 500.])
+        args = (freq, [5., 0.], vs*np.sqrt(3.), vs, [2000., 2000.])
+
+        velocity = dispersion.dispersion_curve(*args)
+        npt.assert_allclose(velocity[:, 0], 0.919402*vs[0], rtol=1e-5)
+
+        hv = dispersion.ellipticity(*args)
+        npt.assert_allclose(hv, 0.681250, rtol=1e-5)
+
+    def test_love(self):
+        """
+        Love modes of a layer over half-space (analytic secular equation)
+        """
+
+        geo = self.geo
+        freq = np.array([2., 10., 30.])
+        velocity = dispersion.dispersion_curve(freq, geo['hl'], geo['vp'],
+                                               geo['vs'], geo['dn'],
+                                               'love', modes=2)
+
+        # Second mode only above its cut-off frequency
+        beta = geo['vs']
+        cutoff = beta[0]/(2.*geo['hl'][0]*np.sqrt(1. - (beta[0]/beta[1])**2.))
+        npt.assert_array_equal(np.isnan(velocity[:, 1]), freq < cutoff)
+
+        omega = 2.*np.pi*freq[:, None]
+        eta1 = np.sqrt(1./beta[0]**2. - 1./velocity**2.)
+        eta2 = np.sqrt(1./velocity**2. - 1./beta[1]**2.)
+        mu = geo['dn']*beta**2.
+        residual = (np.tan(omega*geo['hl'][0]*eta1) -
+                    mu[1]*eta2/(mu[0]*eta1))
+
+        npt.assert_allclose(residual[~np.isnan(residual)], 0., atol=1e-6)
+
+    def test_rayleigh(self):
+        """
+        Limits of the Rayleigh fundamental mode and ellipticity
+        of a layer over half-space
+        """
+
+        geo = self.geo
+        freq = np.array([0.05, 100.])
+        args = (freq, geo['hl'], geo['vp'], geo['vs'], geo['dn'])
+
+        velocity = dispersion.dispersion_curve(*args)
+        npt.assert_allclose(velocity[:, 0], 0.919402*geo['vs'][::-1],
+                            rtol=2e-3)
+
+        hv = dispersion.ellipticity(*args)
+        npt.assert_allclose(hv[1], 0.681250, rtol=1e-4)
+
+    def test_array(self):
+        """
+        Vectorised solution of profiles with different number of layers
+        """
+
+        freq = np.array([1., 5., 20.])
+        geo = {'hl': [[10., 30., 0.], [15., 0., np.nan]],
+               'vp': [[400., 900., 2000.], [500., 1500., np.nan]],
+               'vs': [[200., 450., 1000.], [250., 800., np.nan]],
+               'dn': [[1800., 1900., 2200.], [1800., 2100., np.nan]]}
+
+        for wave in dispersion.WAVES:
+            velocity = dispersion.dispersion_curve_array(
+                freq, geo['hl'], geo['vp'], geo['vs'], geo['dn'], wave, 2)
+
+            for nm in range(2):
+                lnum = 3 - nm
+                single = dispersion.dispersion_curve(
+                    freq, geo['hl'][nm][:lnum], geo['vp'][nm][:lnum],
+                    geo['vs'][nm][:lnum], geo['dn'][nm][:lnum], wave, 2)
+                npt.assert_allclose(velocity[nm], single, rtol=1e-8)
+
+        hv = dispersion.ellipticity_array(freq, geo['hl'], geo['vp'],
+                                          geo['vs'], geo['dn'])
+        single = dispersion.ellipticity(freq, geo['hl'][1][:2],
+                                        geo['vp'][1][:2], geo['vs'][1][:2],
+                                        geo['dn'][1][:2])
+        npt.assert_allclose(hv[1], single, rtol=1e-6)
@@ -0,0 +1,110 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+
+import os
+import tempfile
+import unittest
+import numpy as np
+import numpy.testing as npt
+
+from openquake.srtk import export
+from openquake.srtk import sitedb
+
+
+# =============================================================================
+
+class SiteModelTestCase(unittest.TestCase):
+    """
+    Test the export of the OpenQuake engine site model
+    """
+
+    def setUp(self):
+
+        self.sites = []
+        for ns in range(5):
+            site = sitedb.Site1D(ns, 10. + ns, 45.)
+            for vs in [200., 250.]:
+                mod = sitedb.Model()
+                mod.add_layer([10., 400., vs + 10.*ns, 1900., 20., 10.])
+                mod.add_layer([100., 2000., 1200., 2200., 100., 50.])
+                mod.add_layer([0., 4000., 2800., 2500., 200., 100.])
+                site.add_model(mod)
+            self.sites.append(site)
+
+    def test_site_parameters(self):
+        """
+        Vectorised parameters match the site statistics
+        """
+
+        param = export.site_parameters(self.sites)
+
+        for ns, site in enumerate(self.sites):
+            site.traveltime_velocity(30.)
+            site.compute_site_kappa()
+            npt.assert_allclose(param['vs30'][ns],
+                                site.mean.eng['vsz'][30.][0], rtol=1e-6)
+            npt.assert_allclose(param['kappa0'][ns],
+                                site.mean.eng['kappa'][0], atol=1e-6)
+
+        npt.assert_allclose(param['z1pt0'], 10.)
+        npt.assert_allclose(param['z2pt5'], 0.110)
+
+    def test_rock(self):
+        """
+        Rock profiles (zero depth to the reference velocity)
+        """
+
+        rock = sitedb.Site1D('rock', 0., 0.)
+        mixed = sitedb.Site1D('mixed', 1., 0.)
+        for vs in [1500., 3000.]:
+            mod = sitedb.Model()
+            mod.add_layer([50., 4000., vs, 2500., 200., 100.])
+            mod.add_layer([0., 5000., 3200., 2600., 200., 100.])
+            rock.add_model(mod)
+        mixed.add_model(rock.model[1])
+        mixed.add_model(self.sites[0].model[0])
+
+        param = export.site_parameters([rock, mixed])
+
+        npt.assert_allclose(param['z1pt0'], [0., 5.])
+        npt.assert_allclose(param['z2pt5'], [0.025, 0.055])
+
+    def test_write(self):
+        """
+        Streaming write of the csv file
+        """
+
+        fd, csv_file = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+
+        try:
+            count = export.write_site_model(iter(self.sites), csv_file,
+                                            chunk=2)
+            data = np.genfromtxt(csv_file, delimiter=',', names=True)
+        finally:
+            os.remove(csv_file)
+
+        self.assertEqual(count, 5)
+        self.assertEqual(list(data.dtype.names), export.SITE_MODEL_FIELDS)
+        npt.assert_allclose(data['lon'], [10., 11., 12., 13., 14.])
+        npt.assert_array_equal(data['vs30measured'], 1)
@@ -0,0 +1,137 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+
+
+import os
+import copy
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import numpy.testing as npt
+
+from openquake.srtk import sitedb
+from openquake.srtk import graphycs
+
+graphycs.BACKEND = 'Agg'
+
+
+# =============================================================================
+
+class EnsemblePlotTestCase(unittest.TestCase):
+    """
+    Test the ensemble plotting utilities
+    """
+
+    def setUp(self):
+
+        rnd = np.random.RandomState(4)
+        self.site = sitedb.Site1D()
+        self.site.frequency_axis(0.5, 20., 30)
+
+        for nm in range(20):
+            mod = sitedb.Model()
+            for nl in range(2 + nm % 3):
+                mod.add_layer([10., 800., rnd.uniform(200., 800.), 1900.,
+                               40., 20.])
+            mod.add_layer([0., 2000., 1000., 2200., 100., 50.])
+            self.site.add_model(mod)
+
+        self.site.sh_transfer_function()
+
+    def test_step_layers(self):
+        """
+        Step profiles of models with different number of layers
+        """
+
+        geo = self.site.model.geo
+        lnum = self.site.model.lnum
+        top, bot, val = graphycs.step_layers(geo['hl'], geo['vs'], lnum)
+
+        for nm in [0, 1, 2]:
+            mod = self.site.model[nm]
+            t, b, v = graphycs.step_layers(mod.geo['hl'], mod.geo['vs'])
+            n = lnum[nm]
+            npt.assert_allclose(top[nm, :n], t[0])
+            npt.assert_allclose(bot[nm, :n], b[0])
+            npt.assert_allclose(val[nm, :n], mod.geo['vs'])
+
+            # Padding collapsed onto the last point
+            npt.assert_allclose(top[nm, n:], b[0, -1])
+            npt.assert_allclose(val[nm, n:], mod.geo['vs'][-1])
+
+        npt.assert_allclose(top[0], [0., 10., 20., 28., 28.])
+        npt.assert_allclose(bot[0], [10., 20., 28., 28., 28.])
+
+    def test_plot(self):
+        """
+        Single collection of lines and bands
+        """
+
+        import matplotlib.pyplot as plt
+
+        for mode in ['lines', 'bands', 'density']:
+            graphycs.plot_models(self.site, mode=mode)
+            graphycs.plot_amplification(self.site, mode=mode)
+
+        graphycs.plot_models(self.site)
+        self.assertEqual(len(plt.gca().collections), 1)
+        plt.close('all')
+
+    def test_report_sites(self):
+        """
+        Parallel rendering of the site reports to files
+        """
+
+        self.site.compute_site_kappa(50.)
+        self.site.attenuation_decay()
+
+        sites = [self.site, copy.deepcopy(self.site)]
+        sites[0].head['id'] = 'site01'
+
+        tmp = tempfile.mkdtemp()
+        try:
+            files = graphycs.report_sites(sites, tmp, processes=2,
+                                          mode='bands')
+            self.assertEqual([os.path.basename(f) for f in files],
+                             ['site01.png', '1.png'])
+            self.assertTrue(os.path.getsize(files[0]) > 0)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_report_backend(self):
+        """
+        Serial rendering restores the backend of the session
+        """
+
+        import matplotlib.pyplot as plt
+
+        plt.switch_backend('svg')
+        tmp = tempfile.mkdtemp()
+        try:
+            files = graphycs.report_sites([self.site], tmp, mode='lines')
+            self.assertTrue(os.path.getsize(files[0]) > 0)
+            self.assertEqual(plt.get_backend().lower(), 'svg')
+        finally:
+            plt.switch_backend(graphycs.BACKEND)
+            shutil.rmtree(tmp)
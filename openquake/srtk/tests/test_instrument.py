@@ -0,0 +1,76 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+
+import unittest
+
+from openquake.srtk import sitedb
+from openquake.srtk import response
+from openquake.srtk import instrument
+
+
+# =============================================================================
+
+class InstrumentTestCase(unittest.TestCase):
+    """
+    Test the opt-in instrumentation of the calculations
+    """
+
+    def setUp(self):
+
+        self.site = sitedb.Site1D()
+        self.site.frequency_axis(0.5, 20., 10)
+
+        for vs in [150., 250.]:
+            mod = sitedb.Model()
+            mod.add_layer([10., 300., vs, 1900., 50., 20.])
+            mod.add_layer([0., 1000., 800., 2100., 100., 50.])
+            self.site.add_model(mod)
+
+    def test_recording(self):
+
+        with instrument.recording() as rec:
+            self.site.quarter_wavelength_average()
+            self.site.sh_transfer_function()
+            for mod in self.site.model:
+                response.sh_transfer_function(self.site.freq, mod.geo['hl'],
+                                              mod.geo['vs'], mod.geo['dn'])
+
+        report = rec.report
+        self.assertEqual(report['Site1D.sh_transfer_function']['calls'], 1)
+        self.assertEqual(report['response.SHPropagator']['calls'], 2)
+        self.assertEqual(report['response.SHPropagator']['updates'], 2)
+        self.assertEqual(report['response.sh_transfer_function']['calls'], 2)
+        self.assertEqual(report['response.sh_transfer_function']['solves'],
+                         2*11)
+        self.assertEqual(report['response.sh_transfer_function']['failed'], 0)
+        self.assertEqual(
+            report['soil.quarter_wavelength_average_array']['calls'], 1)
+        self.assertTrue(report['Site1D.statistics']['time'] >= 0.)
+
+        # Disabled by default
+        self.assertFalse(instrument.is_enabled())
+        self.site.sh_transfer_function()
+        self.assertEqual(instrument.report(), {})
+
+        total = instrument.merge([report, report])
+        self.assertEqual(total['Site1D.sh_transfer_function']['calls'], 2)
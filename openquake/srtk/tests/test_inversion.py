@@ -0,0 +1,231 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+
+import unittest
+import numpy as np
+import numpy.testing as npt
+
+from openquake.srtk import sitedb
+from openquake.srtk import response
+from openquake.srtk import inversion
+from openquake.srtk import attenuation
+
+
+# =============================================================================
+
+class InversionTestCase(unittest.TestCase):
+    """
+    Test the inversion of a synthetic amplification function
+    """
+
+    def setUp(self):
+
+        self.freq = response.frequency_axis(0.5, 20., 40)
+
+        geo = {'hl': np.array([10., 25., 0.]),
+               'vp': np.array([400., 900., 2000.]),
+               'vs': np.array([200., 450., 1000.]),
+               'dn': np.array([1800., 1900., 2200.]),
+               'qp': np.array([20., 40., 100.]),
+               'qs': np.array([10., 20., 50.])}
+
+        shtf = response.SHPropagator(self.freq).transfer_function(
+            geo['hl'], geo['vs'], geo['dn'], geo['qs'])
+        self.target = (np.abs(shtf) *
+                       response.attenuation_decay(self.freq, 0.02))
+
+        # Reference profile with a fixed half-space velocity
+        ref = dict(geo)
+        ref['vs'] = np.array([300., 600., 1000.])
+        ref['hl'] = np.array([15., 20., 0.])
+
+        self.space = inversion.ProfileSpace(ref,
+                                            ([100., 100., 1000.],
+                                             [1000., 1000., 1000.]),
+                                            (2., 60.),
+                                            (0., 0.05))
+        self.inv = inversion.Inversion(self.freq, self.target, self.space)
+
+    def test_gradient(self):
+        """
+        Analytic gradient against finite differences
+        """
+
+        x = self.space.vector()
+        misfit, grad = self.inv.gradient(x)
+        self.assertAlmostEqual(misfit, self.inv.misfit(x)[0])
+
+        for npar in [0, 1, 3, 4, 5]:
+            delta = 1e-6*x[npar]
+            upper = x.copy()
+            upper[npar] += delta
+            lower = x.copy()
+            lower[npar] -= delta
+            diff = (self.inv.misfit(upper) - self.inv.misfit(lower))/(2.*delta)
+            self.assertAlmostEqual(grad[npar], diff[0],
+                                   delta=1e-5*np.abs(grad).max())
+
+    def test_local(self):
+        """
+        Local search from the reference profile
+        """
+
+        site = inversion.invert(self.freq, self.target, self.space, 'local')
+
+        self.assertEqual(len(site.model), 1)
+        self.assertTrue(site.model[0].eng['misfit'] < 1e-6)
+        npt.assert_allclose(site.model[0].geo['vs'], [200., 450., 1000.],
+                            rtol=1e-3)
+        self.assertAlmostEqual(site.model[0].eng['kappa'], 0.02, delta=1e-5)
+
+    def test_global(self):
+        """
+        Population search (and local refinement) returns
+        the best models sorted by misfit
+        """
+
+        site = inversion.invert(self.freq, self.target, self.space,
+                                'hybrid', best=3, seed=0, generations=40)
+
+        misfit = [mod.eng['misfit'] for mod in site.model]
+        self.assertEqual(len(misfit), 3)
+        self.assertEqual(misfit, sorted(misfit))
+        self.assertTrue(misfit[0] < 1e-3)
+
+        # Statistics of the inverted models
+        site.sh_transfer_function()
+        self.assertEqual(len(site.mean.amp['shtf'][0]), len(self.freq))
+
+        # Parallel evaluation of the population
+        serial = inversion.Inversion(self.freq, self.target, self.space)
+        pool = inversion.Inversion(self.freq, self.target, self.space,
+                                   processes=2)
+        npt.assert_allclose(serial.global_search(generations=5, seed=1)[1],
+                            pool.global_search(generations=5, seed=1)[1])
+
+
+# =============================================================================
+
+class ForwardModelTestCase(unittest.TestCase):
+    """
+    Test the selectable forward and attenuation models
+    """
+
+    def setUp(self):
+
+        self.freq = response.frequency_axis(0.5, 20., 40)
+
+        self.geo = {'hl': np.array([10., 25., 0.]),
+                    'vs': np.array([200., 450., 1000.]),
+                    'dn': np.array([1800., 1900., 2200.]),
+                    'qs': np.array([10., 20., 50.])}
+
+        ref = dict(self.geo)
+        ref['vs'] = np.array([300., 600., 1000.])
+        ref['hl'] = np.array([15., 20., 0.])
+
+        self.space = inversion.ProfileSpace(ref,
+                                            ([100., 100., 800.],
+                                             [1000., 1000., 1200.]),
+                                            (2., 60.),
+                                            (0., 0.05))
+        self.x = self.space.vector(self.geo, 0.02)
+
+    def check_gradient(self, inv, x):
+
+        misfit, grad = inv.gradient(x)
+        self.assertAlmostEqual(misfit, inv.misfit(x)[0])
+
+        for npar in range(len(x)):
+            delta = 1e-6*x[npar]
+            upper = x.copy()
+            upper[npar] += delta
+            lower = x.copy()
+            lower[npar] -= delta
+            diff = (inv.misfit(upper) - inv.misfit(lower))/(2.*delta)
+            self.assertAlmostEqual(grad[npar], diff[0],
+                                   delta=1e-5*np.abs(grad).max())
+
+    def test_attenuation(self):
+        """
+        SH-wave forward model with frequency-dependent attenuation
+        """
+
+        model = attenuation.PowerLawQ(0.5)
+        prop = response.SHPropagator(self.freq, attenuation=model)
+        shtf = prop.transfer_function(self.geo['hl'], self.geo['vs'],
+                                      self.geo['dn'], self.geo['qs'])
+        target = np.abs(shtf)*response.attenuation_decay(self.freq, 0.02)
+
+        inv = inversion.Inversion(self.freq, target, self.space,
+                                  attenuation=model)
+        npt.assert_allclose(inv.forward(self.x)[0], target, rtol=1e-10)
+        self.check_gradient(inv, self.space.vector())
+
+        # Constant Q does not fit the target
+        const = inversion.Inversion(self.freq, target, self.space)
+        self.assertTrue(const.misfit(self.x)[0] > 1e-3)
+
+        site = inversion.invert(self.freq, target, self.space, 'local',
+                                attenuation=model)
+        self.assertTrue(site.model[0].eng['misfit'] < 1e-6)
+
+    def test_qwl(self):
+        """
+        Quarter-wavelength forward model against the site products
+        """
+
+        site = sitedb.Site1D()
+        site.freq = self.freq
+        mod = sitedb.Model()
+        for hl, vs, dn in zip(self.geo['hl'], self.geo['vs'], self.geo['dn']):
+            mod.add_layer({'hl': hl, 'vs': vs, 'dn': dn})
+        site.add_model(mod)
+        site.quarter_wavelength_average()
+        site.quarter_wavelength_amplification()
+
+        target = (site.model[0].amp['qwl'] *
+                  response.attenuation_decay(self.freq, 0.02))
+
+        inv = inversion.Inversion(self.freq, target, self.space,
+                                  forward='qwl')
+        npt.assert_allclose(inv.forward(self.x)[0], target, rtol=1e-6)
+        self.check_gradient(inv, self.space.vector())
+
+        # Oblique incidence (radians, as for the SH-wave model)
+        oblique = inversion.Inversion(self.freq, target, self.space,
+                                      inc_ang=0.3, forward='qwl')
+        self.check_gradient(oblique, self.space.vector())
+
+        start = inv.misfit(self.space.vector())[0]
+        result = inversion.invert(self.freq, target, self.space, 'local',
+                                  forward='qwl')
+        self.assertTrue(result.model[0].eng['misfit'] < 0.1*start)
+
+    def test_options(self):
+
+        self.assertRaises(ValueError, inversion.Inversion, self.freq,
+                          self.freq, self.space, forward='psv')
+        self.assertRaises(ValueError, inversion.Inversion, self.freq,
+                          self.freq, self.space, forward='qwl',
+                          attenuation=attenuation.ConstantQ())
@@ -0,0 +1,133 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+
+import multiprocessing
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import numpy.testing as npt
+
+from openquake.srtk import lookup
+
+
+# =============================================================================
+
+def linear_amplification(params, freq):
+    """
+    Amplification whose logarithm is linear in the proxies
+    """
+
+    return np.exp(params['vs30']/1000. + 2.*params['f0'] + 0.*freq)
+
+
+def failing_amplification(params, freq):
+    """
+    Amplification raising an error (for the worker cleanup)
+    """
+
+    raise ValueError('Failing node')
+
+
+# =============================================================================
+
+class AmplificationTableTestCase(unittest.TestCase):
+    """
+    Test the construction, storage and interpolation
+    of the amplification lookup tables
+    """
+
+    def setUp(self):
+
+        self.axes = [('vs30', np.array([200., 400., 800.])),
+                     ('f0', np.array([1., 2., 5., 10.]))]
+        self.freq = np.array([0.5, 1., 2., 5.])
+
+    def test_interpolation(self):
+        """
+        Multilinear interpolation is exact for linear functions
+        """
+
+        table = lookup.AmplificationTable.build(self.axes, self.freq,
+                                                linear_amplification,
+                                                dtype='float64')
+
+        rnd = np.random.RandomState(0)
+        points = {'vs30': rnd.uniform(200., 800., 1000),
+                  'f0': rnd.uniform(1., 10., 1000)}
+
+        amp = table.interpolate(points, chunk=300)
+        expected = np.exp(points['vs30']/1000. + 2.*points['f0'])
+
+        self.assertEqual(amp.shape, (1000, 4))
+        npt.assert_allclose(amp[:, 2], expected, rtol=1e-10)
+
+        amp = table.interpolate({'vs30': 300., 'f0': 20.}, freq=[0.7])
+        npt.assert_allclose(amp, [[np.exp(0.3 + 20.)]], rtol=1e-10)
+
+    def test_failure(self):
+        """
+        Worker processes are stopped if a node fails
+        """
+
+        self.assertRaises(ValueError, lookup.AmplificationTable.build,
+                          self.axes, self.freq, failing_amplification,
+                          processes=2)
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_storage(self):
+        """
+        Saving and memory-mapping the table
+        """
+
+        table = lookup.AmplificationTable.build(self.axes, self.freq,
+                                                log=['f0'], processes=2)
+
+        tmp = tempfile.mkdtemp()
+        try:
+            table.save(tmp)
+            loaded = lookup.AmplificationTable.load(tmp)
+
+            self.assertIsInstance(loaded.values, np.memmap)
+            self.assertEqual(loaded.log, ['f0'])
+
+            points = {'vs30': [250., 700.], 'f0': [1.5, 7.]}
+            npt.assert_allclose(loaded.interpolate(points),
+                                table.interpolate(points))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_proxy_profile(self):
+        """
+        Proxy profile matches the target Vs30 and f0
+        """
+
+        from openquake.srtk import soil
+
+        for vs30, f0 in [(600., 8.), (400., 2.)]:
+            hl, vs, dn = lookup.proxy_profile({'vs30': vs30, 'f0': f0,
+                                               'vs_ref': 800.})
+
+            self.assertAlmostEqual(vs[0]/(4.*hl[0]), f0)
+            self.assertAlmostEqual(soil.traveltime_velocity(hl, vs, 30.),
+                                   vs30)
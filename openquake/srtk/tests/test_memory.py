@@ -0,0 +1,91 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+
+
+
+import unittest
+
+from openquake.srtk import sitedb
+from openquake.srtk import memory
+
+
+# =============================================================================
+
+class MemoryTestCase(unittest.TestCase):
+    """
+    Test the memory estimator against the actual site footprint
+    """
+
+    def test_estimate(self):
+
+        products = [('traveltime_velocity', {'depth': [10., 30.]}),
+                    'quarter_wavelength_average',
+                    'sh_transfer_function']
+
+        site = sitedb.Site1D()
+        site.frequency_axis(0.5, 20., 25)
+
+        for vs in range(100, 140):
+            mod = sitedb.Model()
+            mod.add_layer([10., 300., vs, 1900., 50., 20.])
+            mod.add_layer([20., 500., 2*vs, 1900., 50., 20.])
+            mod.add_layer([0., 1000., 800., 2100., 100., 50.])
+            site.add_model(mod)
+
+        for name, kwargs in map(sitedb._product_args, products):
+            getattr(site, name)(**kwargs)
+
+        size = memory.estimate(40, 3, 25, products)
+        real = memory.footprint(site)
+
+        for key in ['eng.vsz', 'eng.qwl', 'amp.shtf']:
+            self.assertEqual(size[key], real[key])
+
+        self.assertEqual(len(site.model._lnum), memory.capacity(40))
+        self.assertTrue(size['peak'] > size['total'] > 0)
+
+    def test_surface_waves(self):
+
+        products = [('dispersion_curve', {'wave': 'love', 'modes': 2}),
+                    'hv_ratio']
+        size = memory.estimate(40, 3, 25, products, grow=False)
+
+        self.assertEqual(size['amp.love'], 40*(2*25*8 + 1))
+        self.assertEqual(size['amp.hv'], 40*(25*8 + 1))
+        self.assertTrue(size['transient'] > 0)
+        self.assertTrue(memory.estimate(40, 3, 25, ['dispersion_curve'])
+                        ['amp.rayleigh'] > 0)
+
+    def test_budget(self):
+
+        products = ['sh_transfer_function']
+        size = memory.estimate(10000, 20, 1000, products)
+
+        self.assertTrue(memory.check_budget(size, None))
+        self.assertFalse(memory.check_budget(size, 4*1024**2, 'chunk'))
+        self.assertRaises(MemoryError, memory.check_budget, size, 4*1024**2)
+
+        chunk = memory.chunk_size(4*1024**2, 20, 1000, products)
+        size = memory.estimate(chunk, 20, 1000, products, grow=False)
+        self.assertTrue(size['peak'] <= 4*1024**2)
+        self.assertTrue(chunk > 1)
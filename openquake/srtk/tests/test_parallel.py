@@ -0,0 +1,150 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+
+import multiprocessing
+import pickle
+import unittest
+import numpy as np
+import numpy.testing as npt
+
+from openquake.srtk import parallel
+from openquake.srtk import sitedb
+from openquake.srtk import randomise
+
+
+# =============================================================================
+
+class SharedArrayTestCase(unittest.TestCase):
+    """
+    Test the shared memory-mapped arrays
+    """
+
+    def test_attach(self):
+
+        data = np.arange(12.).reshape(3, 4)
+        shared = parallel.SharedArray.create(data.shape, data=data)
+
+        try:
+            copy = pickle.loads(pickle.dumps(shared))
+            array = copy.attach()
+            npt.assert_array_equal(array, data)
+
+            array[1, 1] = -1.
+            self.assertEqual(shared.attach('r')[1, 1], -1.)
+        finally:
+            shared.unlink()
+
+
+def failing_model(geo):
+    """
+    Model function raising an error (for the worker cleanup)
+    """
+
+    raise ValueError('Failing model')
+
+
+# =============================================================================
+
+class EnsembleMapTestCase(unittest.TestCase):
+    """
+    Test the parallel map over the models of an ensemble
+    """
+
+    def test_failure(self):
+
+        geo = {'hl': np.array([10., 0.]),
+               'vs': np.array([200., 1000.])}
+        geo = randomise.toro_randomisation(geo, 8, seed=0)
+
+        site = sitedb.Site1D()
+        site.add_model_array(geo)
+
+        self.assertRaises(ValueError, parallel.ensemble_map, site.model,
+                          failing_model, (1,), processes=2)
+        self.assertEqual(multiprocessing.active_children(), [])
+
+
+# =============================================================================
+
+class ParallelTransferFunctionTestCase(unittest.TestCase):
+    """
+    Test the parallel SH-wave transfer function against
+    the serial calculation
+    """
+
+    def test_sh_transfer_function(self):
+
+        geo = {'hl': np.array([10., 20., 0.]),
+               'vs': np.array([200., 400., 1000.]),
+               'dn': np.array([1900., 2000., 2200.]),
+               'qs': np.array([10., 20., 50.])}
+        geo = randomise.toro_randomisation(geo, 20, seed=0)
+
+        serial = sitedb.Site1D()
+        serial.frequency_axis(0.5, 20., 50)
+        serial.add_model_array(geo)
+        serial.sh_transfer_function()
+
+        site = sitedb.Site1D()
+        site.frequency_axis(0.5, 20., 50)
+        site.add_model_array(geo)
+        parallel.sh_transfer_function(site, processes=2)
+
+        npt.assert_allclose(site.model.get_array(('amp', 'shtf')),
+                            serial.model.get_array(('amp', 'shtf')))
+        npt.assert_allclose(site.mean.amp['shtf'], serial.mean.amp['shtf'])
+        npt.assert_array_equal(site.model[5].amp['shtf'],
+                               serial.model[5].amp['shtf'])
+
+    def test_psv_transfer_function(self):
+        """
+        Parallel, vectorised (ensemble) and per-model calculations
+        """
+
+        geo = {'hl': np.array([10., 20., 0.]),
+               'vp': np.array([450., 900., 2000.]),
+               'vs': np.array([200., 400., 1000.]),
+               'dn': np.array([1900., 2000., 2200.]),
+               'qp': np.array([20., 40., 100.]),
+               'qs': np.array([10., 20., 50.])}
+        geo = randomise.toro_randomisation(geo, 20, seed=0)
+
+        serial = sitedb.Site1D()
+        serial.frequency_axis(0.5, 20., 50)
+        serial.add_model_array(geo)
+        serial.psv_transfer_function(0.3)
+
+        models = sitedb.Site1D()
+        models.frequency_axis(0.5, 20., 50)
+        models.model = serial.model.to_models()
+        models.psv_transfer_function(0.3)
+
+        site = sitedb.Site1D()
+        site.frequency_axis(0.5, 20., 50)
+        site.add_model_array(geo)
+        parallel.psv_transfer_function(site, 0.3, processes=2)
+
+        for key in ['psv_r', 'psv_z']:
+            npt.assert_allclose(site.model.get_array(('amp', key)),
+                                serial.model.get_array(('amp', key)))
+            npt.assert_allclose(models.mean.amp[key], serial.mean.amp[key])
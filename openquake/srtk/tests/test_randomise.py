@@ -0,0 +1,123 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+
+import unittest
+import numpy as np
+import numpy.testing as npt
+
+from openquake.srtk import randomise
+from openquake.srtk import sitedb
+
+
+# =============================================================================
+
+class ToroRandomisationTestCase(unittest.TestCase):
+    """
+    Test the generation of randomised soil profiles
+    """
+
+    def setUp(self):
+
+        self.geo = {'hl': np.array([5., 10., 20., 0.]),
+                    'vp': np.array([400., 600., 1000., 2000.]),
+                    'vs': np.array([200., 300., 500., 1000.]),
+                    'dn': np.array([1800., 1900., 2000., 2200.])}
+
+    def test_reproducibility(self):
+        """
+        Same seed must produce the same profiles
+        """
+
+        geo1 = randomise.toro_randomisation(self.geo, 10, seed=3)
+        geo2 = randomise.toro_randomisation(self.geo, 10, seed=3)
+
+        for key in self.geo:
+            npt.assert_array_equal(geo1[key], geo2[key])
+
+    def test_statistic(self):
+        """
+        Checking bounds, coupling and velocity correlation
+        """
+
+        geo = randomise.toro_randomisation(self.geo, 20000, site='USGS B',
+                                           hl_sigma=0.2, trunc=3., seed=0)
+
+        self.assertEqual(geo['vs'].shape, (20000, 4))
+        npt.assert_array_equal(geo['hl'][:, -1], 0.)
+        npt.assert_allclose(geo['vp']/geo['vs'],
+                            np.tile(self.geo['vp']/self.geo['vs'],
+                                    (20000, 1)))
+        npt.assert_array_equal(geo['dn'][0], self.geo['dn'])
+
+        res = np.log(geo['vs']/self.geo['vs'])
+        npt.assert_allclose(np.std(res, axis=0), 0.27, rtol=0.05)
+
+    def test_correlation(self):
+        """
+        Checking the inter-layer correlation of the velocity
+        """
+
+        geo = randomise.toro_randomisation(self.geo, 20000, site='USGS B',
+                                           trunc=5., seed=0)
+        res = np.log(geo['vs']/self.geo['vs'])
+
+        # Correlation between the last layer and the half-space
+        rho = np.corrcoef(res[:, 2], res[:, 3])[0, 1]
+        expected = randomise.toro_correlation(30., 10., 0.97, 3.8,
+                                              1.00, 0.0, 0.293)
+
+        self.assertAlmostEqual(rho, expected, delta=0.02)
+
+    def test_site_import(self):
+        """
+        Importing the profiles into a site
+        """
+
+        geo = randomise.toro_randomisation(self.geo, 5, seed=1)
+
+        site = sitedb.Site1D()
+        site.add_model_array(geo)
+
+        self.assertEqual(len(site.model), 5)
+        npt.assert_array_equal(site.model[2].geo['vs'], geo['vs'][2])
+        self.assertTrue(np.all(np.isnan(site.model[0].geo['qs'])))
+
+    def test_model(self):
+        """
+        Randomisation of a site model (half-space thickness is nan)
+        """
+
+        mod = sitedb.Model()
+        for layer in zip(self.geo['hl'], self.geo['vp'], self.geo['vs'],
+                         self.geo['dn']):
+            mod.add_layer(list(layer) + [50., 20.])
+
+        self.assertTrue(np.isnan(mod.geo['hl'][-1]))
+
+        geo = randomise.toro_randomisation(mod.geo, 3, hl_sigma=0.2, seed=0)
+        ref = randomise.toro_randomisation(self.geo, 3, hl_sigma=0.2, seed=0)
+
+        self.assertTrue(np.all(np.isfinite(geo['vs'])))
+        self.assertTrue(np.all(np.isnan(geo['hl'][:, -1])))
+        npt.assert_array_equal(geo['vs'], ref['vs'])
+        npt.assert_array_equal(geo['hl'][:, :-1], ref['hl'][:, :-1])
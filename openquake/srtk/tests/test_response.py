@@ -26,7 +26,14 @@ import numpy as np
 import numpy.testing as npt
 
 from openquake.srtk.response import impedance_amplification
+from openquake.srtk.response import impedance_amplification_array
 from openquake.srtk.response import sh_transfer_function
+from openquake.srtk.response import frequency_axis
+from openquake.srtk.response import SHPropagator
+from openquake.srtk.response import sh_transfer_jacobian
+from openquake.srtk.response import sh_transfer_function_array
+from openquake.srtk.response import psv_transfer_function
+from openquake.srtk.response import psv_transfer_function_array
 
 
 # =============================================================================
@@ -97,6 +104,33 @@ class ImpedanceAmplificationTestCase(unittest.TestCase):
                                  np.array([3.63, 1.72, 1.]),
                                  0.01)
 
+    def test_array(self):
+        """
+        Vectorised calculation over references, models and frequencies
+        """
+
+        top_vs = np.array([[200., 800., 2000.], [300., 500., 900.]])
+        top_dn = np.array([[1900., 2100., 2500.], [1800., 2000., 2200.]])
+        ref_vs = np.array([[2000., 2500.], [1500., 1500.], [1200., 3000.]])
+        ref_dn = np.array([2500., 2400., 2300.])
+        inc_ang = np.array([0., 45., 20.])
+
+        amp = impedance_amplification_array(top_vs, top_dn, ref_vs, ref_dn,
+                                            inc_ang)
+        self.assertEqual(amp.shape, (3, 2, 3))
+
+        for nr in range(3):
+            for nm in range(2):
+                npt.assert_allclose(amp[nr, nm], impedance_amplification(
+                    top_vs[nm], top_dn[nm], ref_vs[nr, nm], ref_dn[nr],
+                    inc_ang[nr]), rtol=1e-12)
+
+        # Same reference for all, different angles
+        amp = impedance_amplification_array(top_vs, top_dn, 2000., 2500.,
+                                            [0., 10.])
+        self.assertEqual(amp.shape, (2, 2, 3))
+        npt.assert_allclose(amp[0, 0], [3.63, 1.72, 1.], atol=0.01)
+
 
 # =============================================================================
 
@@ -205,3 +239,237 @@ class ShTansferFunctionTestCase(unittest.TestCase):
                                  np.array([10., 20., 100.]),
                                  0.,
                                  60.)
+
+
+# =============================================================================
+
+class SHPropagatorTestCase(unittest.TestCase):
+    """
+    Test of the propagator method (with incremental recomputation)
+    against the SH-wave transfer function at the surface
+    """
+
+    def setUp(self):
+
+        self.freq = frequency_axis(0.5, 20., 50)
+        self.hl = np.array([10., 20., 15., 0.])
+        self.vs = np.array([200., 400., 700., 1500.])
+        self.dn = np.array([1800., 1900., 2000., 2300.])
+        self.qs = np.array([10., 20., 30., 100.])
+
+    def check_response(self, prop, hl, vs, dn, qs, inc_ang=0.):
+
+        disp = sh_transfer_function(self.freq, hl, vs, dn, qs, inc_ang, 0.)
+        shtf = prop.transfer_function(hl, vs, dn, qs)
+
+        npt.assert_allclose(shtf, disp[0]/2, rtol=1e-8)
+
+    def test_transfer_function(self):
+        """
+        Elastic and anelastic, vertical and oblique incidence
+        """
+
+        for inc_ang in [0., 0.3]:
+            for qs in [None, self.qs]:
+                prop = SHPropagator(self.freq, inc_ang)
+                self.check_response(prop, self.hl, self.vs, self.dn,
+                                    qs, inc_ang)
+
+    def test_incremental(self):
+        """
+        Only the changed layers are recomputed
+        """
+
+        prop = SHPropagator(self.freq)
+        self.check_response(prop, self.hl, self.vs, self.dn, self.qs)
+        self.assertEqual(prop.updated, 3)
+
+        # Change of a deep layer (shallow terms are reused)
+        vs = self.vs.copy()
+        vs[2] = 800.
+        self.check_response(prop, self.hl, vs, self.dn, self.qs)
+        self.assertEqual(prop.updated, 1)
+
+        # In-place change of the half-space only
+        vs[3] = 1800.
+        self.check_response(prop, self.hl, vs, self.dn, self.qs)
+        self.assertEqual(prop.updated, 0)
+
+        # Additional layer
+        hl = np.array([10., 20., 15., 30., 0.])
+        vs = np.array([200., 400., 800., 1000., 1800.])
+        dn = np.array([1800., 1900., 2000., 2100., 2300.])
+        qs = np.array([10., 20., 30., 50., 100.])
+        self.check_response(prop, hl, vs, dn, qs)
+        self.assertEqual(prop.updated, 1)
+
+    def test_model_states(self):
+        """
+        Propagator state kept per model
+        """
+
+        prop = SHPropagator(self.freq, state_size=2)
+        vs = [self.vs, self.vs*1.1, self.vs*1.2]
+
+        for key in range(3):
+            prop.transfer_function(self.hl, vs[key], self.dn, self.qs, key)
+            self.assertEqual(prop.updated, 3)
+
+        # Edit of a deep layer of the first model
+        vs[0] = self.vs.copy()
+        vs[0][2] = 800.
+        self.check_response(prop, self.hl, vs[0], self.dn, self.qs)
+        prop.transfer_function(self.hl, vs[0], self.dn, self.qs, 0)
+        self.assertEqual(prop.updated, 1)
+
+        prop.transfer_function(self.hl, vs[1], self.dn, self.qs, 1)
+        self.assertEqual(prop.updated, 0)
+
+        # State of the third model is not kept
+        prop.transfer_function(self.hl, vs[2], self.dn, self.qs, 2)
+        self.assertEqual(prop.updated, 3)
+        self.assertEqual(sorted(prop._states), [0, 1])
+
+        npt.assert_allclose(
+            prop.transfer_function(self.hl, vs[0], self.dn, self.qs, 0),
+            SHPropagator(self.freq).transfer_function(self.hl, vs[0],
+                                                      self.dn, self.qs),
+            rtol=1e-12)
+
+    def test_array(self):
+        """
+        Vectorised calculation over profiles (padded with nans)
+        """
+
+        hl = np.array([self.hl, [10., 20., 0., np.nan]])
+        vs = np.array([self.vs, [250., 500., 900., np.nan]])
+        dn = np.array([self.dn, [1800., 1900., 2000., np.nan]])
+        qs = np.array([self.qs, [10., 20., 30., np.nan]])
+
+        for inc_ang in [0., 0.3]:
+            shtf = sh_transfer_function_array(self.freq, hl, vs, dn, qs,
+                                              inc_ang)
+
+            for nm, ln in enumerate([4, 3]):
+                prop = SHPropagator(self.freq, inc_ang)
+                npt.assert_allclose(shtf[nm],
+                                    prop.transfer_function(hl[nm, :ln],
+                                                           vs[nm, :ln],
+                                                           dn[nm, :ln],
+                                                           qs[nm, :ln]),
+                                    rtol=1e-10)
+
+    def test_jacobian(self):
+        """
+        Analytic derivatives against finite differences
+        """
+
+        geo = {'hl': self.hl, 'vs': self.vs, 'dn': self.dn, 'qs': self.qs}
+
+        for inc_ang in [0., 0.3]:
+            for complex in [True, False]:
+                shtf, jac = sh_transfer_jacobian(self.freq, inc_ang=inc_ang,
+                                                 complex=complex, **geo)
+
+                for key in ['hl', 'vs', 'dn', 'qs']:
+                    for nl in range(4):
+                        if key == 'hl' and nl == 3:
+                            continue
+                        delta = 1e-6*geo[key][nl]
+                        upper = dict(geo)
+                        upper[key] = geo[key].copy()
+                        upper[key][nl] += delta
+                        lower = dict(geo)
+                        lower[key] = geo[key].copy()
+                        lower[key][nl] -= delta
+
+                        diff = (sh_transfer_jacobian(
+                            self.freq, inc_ang=inc_ang, complex=complex,
+                            **upper)[0] - sh_transfer_jacobian(
+                            self.freq, inc_ang=inc_ang, complex=complex,
+                            **lower)[0])/(2.*delta)
+
+                        npt.assert_allclose(jac[key][:, nl], diff,
+                                            rtol=1e-5, atol=1e-7)
+
+                npt.assert_array_equal(jac['hl'][:, -1], 0.)
+
+
+# =============================================================================
+
+class PSVTransferFunctionTestCase(unittest.TestCase):
+    """
+    Test of the P-SV transfer function
+    """
+
+    def setUp(self):
+
+        self.freq = frequency_axis(0.5, 20., 50)
+        self.hl = np.array([10., 20., 15., 0.])
+        self.vp = np.array([500., 900., 1500., 3000.])
+        self.vs = np.array([200., 400., 700., 1500.])
+        self.dn = np.array([1800., 1900., 2000., 2300.])
+        self.qp = np.array([20., 40., 60., 200.])
+        self.qs = np.array([10., 20., 30., 100.])
+
+    def test_vertical_incidence(self):
+        """
+        Vertical SV (P) equals the SH-wave transfer function
+        of the shear (compressional) properties
+        """
+
+        radial, vertical = psv_transfer_function(self.freq, self.hl, self.vp,
+                                                 self.vs, self.dn, self.qp,
+                                                 self.qs, 0., 'sv')
+        shtf = SHPropagator(self.freq).transfer_function(self.hl, self.vs,
+                                                         self.dn, self.qs)
+        npt.assert_allclose(radial, shtf, rtol=1e-10)
+        npt.assert_allclose(vertical, 0., atol=1e-10)
+
+        radial, vertical = psv_transfer_function(self.freq, self.hl, self.vp,
+                                                 self.vs, self.dn, self.qp,
+                                                 self.qs, 0., 'p')
+        shtf = SHPropagator(self.freq).transfer_function(self.hl, self.vp,
+                                                         self.dn, self.qp)
+        npt.assert_allclose(vertical, shtf, rtol=1e-10)
+        npt.assert_allclose(radial, 0., atol=1e-10)
+
+    def test_oblique_incidence(self):
+        """
+        Outcropping half-space and layer subdivision
+        """
+
+        for wave in ['p', 'sv']:
+            radial, vertical = psv_transfer_function(
+                self.freq, [30., 0.], [3000., 3000.], [1500., 1500.],
+                [2300., 2300.], inc_ang=0.3, wave=wave)
+            npt.assert_allclose(np.abs(radial)**2. + np.abs(vertical)**2., 1.)
+
+            split = psv_transfer_function(
+                self.freq, [4., 6., 20., 15., 0.], self.vp[[0, 0, 1, 2, 3]],
+                self.vs[[0, 0, 1, 2, 3]], self.dn[[0, 0, 1, 2, 3]],
+                self.qp[[0, 0, 1, 2, 3]], self.qs[[0, 0, 1, 2, 3]], 0.3, wave)
+            whole = psv_transfer_function(
+                self.freq, self.hl, self.vp, self.vs, self.dn, self.qp,
+                self.qs, 0.3, wave)
+            npt.assert_allclose(split, whole, rtol=1e-10)
+
+    def test_array(self):
+        """
+        Vectorised calculation over profiles (padded with nans)
+        """
+
+        pad = lambda x: np.append(x[[0, 1, 3]], np.nan)
+        geo = [np.array([self.hl, [10., 20., 0., np.nan]])]
+        for par in [self.vp, self.vs, self.dn, self.qp, self.qs]:
+            geo.append(np.array([par, pad(par)]))
+
+        radial, vertical = psv_transfer_function_array(self.freq, *geo,
+                                                       inc_ang=0.3)
+
+        for nm, ln in enumerate([4, 3]):
+            expected = psv_transfer_function(self.freq,
+                                             *[g[nm, :ln] for g in geo],
+                                             inc_ang=0.3)
+            npt.assert_allclose(radial[nm], expected[0], rtol=1e-10)
+            npt.assert_allclose(vertical[nm], expected[1], rtol=1e-10)
@@ -0,0 +1,738 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+
+
+import pickle
+import unittest
+import numpy as np
+import numpy.testing as npt
+
+from openquake.srtk import sitedb
+from openquake.srtk import utils
+from openquake.srtk import instrument
+from openquake.srtk import response
+from openquake.srtk.response import impedance_amplification
+
+
+# =============================================================================
+
+def random_model(rnd):
+    """
+    Build a three-layer model with random velocities
+    """
+
+    mod = sitedb.Model()
+    mod.add_layer([10., 400., 200.*rnd.uniform(0.8, 1.2), 1900., 20., 10.])
+    mod.add_layer([20., 800., 400.*rnd.uniform(0.8, 1.2), 2000., 40., 20.])
+    mod.add_layer([0., 2000., 1000., 2200., 100., 50.])
+
+    return mod
+
+
+# =============================================================================
+
+class IncrementalStatisticTestCase(unittest.TestCase):
+    """
+    Test the incremental update of the site statistics
+    when models are added to or removed from the site
+    """
+
+    def setUp(self):
+
+        self.rnd = np.random.RandomState(0)
+        self.site = sitedb.Site1D()
+        self.site.frequency_axis(0.5, 20., 30)
+
+        for _ in range(10):
+            self.site.add_model(random_model(self.rnd))
+
+        self.site.traveltime_velocity([10., 30.])
+        self.site.compute_site_kappa()
+        self.site.sh_transfer_function()
+
+    def check_mean(self):
+
+        for z in [10., 30.]:
+            data = [mod.eng['vsz'][z] for mod in self.site.model]
+            npt.assert_allclose(self.site.mean.eng['vsz'][z],
+                                utils.log_stat(data), rtol=1e-5)
+
+        data = [mod.eng['kappa'] for mod in self.site.model]
+        npt.assert_allclose(self.site.mean.eng['kappa'],
+                            utils.lin_stat(data), rtol=1e-5)
+
+        data = [mod.amp['shtf'] for mod in self.site.model]
+        npt.assert_allclose(self.site.mean.amp['shtf'],
+                            utils.log_stat(data), rtol=1e-10)
+
+    def test_add_model(self):
+        """
+        Adding a model with precomputed products
+        """
+
+        site = sitedb.Site1D()
+        site.frequency_axis(0.5, 20., 30)
+        site.add_model(random_model(self.rnd))
+        site.traveltime_velocity([10., 30.])
+        site.compute_site_kappa()
+        site.sh_transfer_function()
+
+        self.site.add_model(site.model[0], 3)
+        self.check_mean()
+
+    def test_del_model(self):
+        """
+        Removing models from the site
+        """
+
+        self.site.del_model()
+        self.site.del_model(2)
+        self.check_mean()
+
+    def test_layer_edit(self):
+        """
+        Transfer function recomputed after editing the models
+        """
+
+        self.site.model[0].geo['vs'][1] *= 1.1
+        self.site.model[4].add_layer([5., 300., 150., 1800., 10., 5.], 0)
+        self.site.sh_transfer_function()
+
+        site = sitedb.Site1D()
+        site.frequency_axis(0.5, 20., 30)
+        site.model = self.site.model
+        site.sh_transfer_function()
+
+        npt.assert_allclose(self.site.mean.amp['shtf'],
+                            site.mean.amp['shtf'], rtol=1e-10)
+
+    def test_model_edit(self):
+        """
+        Only the edited layer is recomputed in a large ensemble
+        """
+
+        site = sitedb.Site1D()
+        site.frequency_axis(0.5, 20., 30)
+        for _ in range(100):
+            mod = random_model(self.rnd)
+            mod.add_layer([15., 600., 300., 1950., 30., 15.], 2)
+            mod.add_layer([25., 1000., 600., 2100., 60., 30.], 3)
+            site.add_model(mod)
+        site.sh_transfer_function()
+
+        site.model[40].geo['vs'][3] *= 1.1
+        with instrument.recording() as rec:
+            site.sh_transfer_function()
+        self.assertEqual(rec.report['response.SHPropagator']['updates'], 1)
+
+        npt.assert_allclose(site.model[40].amp['shtf'], np.abs(
+            response.SHPropagator(site.freq).transfer_function(
+                site.model[40].geo['hl'], site.model[40].geo['vs'],
+                site.model[40].geo['dn'], site.model[40].geo['qs'])),
+            rtol=1e-12)
+
+
+# =============================================================================
+
+class StreamModelsTestCase(unittest.TestCase):
+    """
+    Test the streaming mode against the statistic computed
+    on the full set of models
+    """
+
+    def test_stream_models(self):
+
+        rnd = np.random.RandomState(1)
+        models = [random_model(rnd) for _ in range(25)]
+        products = [('traveltime_velocity', {'depth': 30.}),
+                    'compute_soil_class',
+                    'compute_site_kappa',
+                    'sh_transfer_function']
+
+        site = sitedb.Site1D()
+        site.frequency_axis(0.5, 20., 30)
+        site.model = list(models)
+        site.traveltime_velocity(30.)
+        site.compute_soil_class()
+        site.compute_site_kappa()
+        site.sh_transfer_function()
+
+        stream = sitedb.Site1D()
+        stream.frequency_axis(0.5, 20., 30)
+        stream.stream_models(iter(models), products, chunk=7,
+                             sample=5, perc=[50.], seed=0)
+
+        self.assertEqual(len(stream.model), 5)
+        self.assertEqual(stream.mean.eng['class'], site.mean.eng['class'])
+
+        npt.assert_allclose(stream.mean.eng['vsz'][30.],
+                            site.mean.eng['vsz'][30.], rtol=1e-5)
+        npt.assert_allclose(stream.mean.eng['kappa'],
+                            site.mean.eng['kappa'], rtol=1e-5)
+        npt.assert_allclose(stream.mean.amp['shtf'],
+                            site.mean.amp['shtf'], rtol=1e-10)
+
+        self.assertIn(50., stream.percentiles.amp['shtf'])
+
+        # Products of a previous run are not retained
+        stream.stream_models(iter(models), ['compute_site_kappa'],
+                             chunk=7)
+        self.assertEqual(len(stream.mean.amp['shtf']), 0)
+        self.assertEqual(len(stream.mean.eng['vsz']), 0)
+        self.assertEqual(len(stream.percentiles.amp['shtf']), 0)
+        npt.assert_allclose(stream.mean.eng['kappa'],
+                            site.mean.eng['kappa'], rtol=1e-5)
+
+
+# =============================================================================
+
+class EnsembleTestCase(unittest.TestCase):
+    """
+    Test the array-backed model ensemble
+    """
+
+    def setUp(self):
+
+        rnd = np.random.RandomState(2)
+        self.models = [random_model(rnd) for _ in range(6)]
+        self.models[1].add_layer([5., 300., 150., 1800., 10., 5.], 0)
+
+        self.ensemble = sitedb.Ensemble.from_models(self.models)
+
+    def test_views(self):
+        """
+        Per-model views and stacked arrays
+        """
+
+        self.assertEqual(len(self.ensemble), 6)
+        npt.assert_array_equal(self.ensemble.lnum, [3, 4, 3, 3, 3, 3])
+        self.assertEqual(self.ensemble.geo['vs'].shape, (6, 4))
+
+        for mod, view in zip(self.models, self.ensemble):
+            npt.assert_array_equal(mod.geo['vs'], view.geo['vs'])
+
+        # Views share memory with the ensemble
+        self.ensemble[2].geo['vs'][0] = 123.
+        self.assertEqual(self.ensemble.geo['vs'][2, 0], 123.)
+
+    def test_layer_edit(self):
+        """
+        Adding and removing layers through a view
+        """
+
+        view = self.ensemble[0]
+        view.add_layer([5., 300., 150., 1800., 10., 5.], 1)
+        self.models[0].add_layer([5., 300., 150., 1800., 10., 5.], 1)
+        npt.assert_array_equal(view.geo['dn'], self.models[0].geo['dn'])
+
+        view.del_layer(0)
+        self.models[0].del_layer(0)
+        npt.assert_array_equal(view.geo['hl'], self.models[0].geo['hl'])
+
+    def test_products(self):
+        """
+        Products are stored as arrays and removed models detached
+        """
+
+        for view in self.ensemble:
+            view.eng['vsz'] = {}
+            view.eng['vsz'][30.] = view.geo['vs'][0]
+            view.amp['kappa'] = np.ones(5)*view.geo['vs'][0]
+            view.eng['class'] = 'B'
+
+        npt.assert_array_equal(self.ensemble.get_array(('eng', 'vsz', 30.)),
+                               self.ensemble.geo['vs'][:, 0])
+        self.assertEqual(self.ensemble.get_array(('amp', 'kappa')).shape,
+                         (6, 5))
+
+        model = self.ensemble.pop(3)
+        self.assertEqual(model.eng['class'], 'B')
+        self.assertEqual(model.eng['vsz'][30.], model.geo['vs'][0])
+        self.assertEqual(len(self.ensemble), 5)
+        npt.assert_array_equal(self.ensemble[3].geo['vs'],
+                               self.models[4].geo['vs'])
+
+        self.ensemble.insert(0, model)
+        self.assertEqual(self.ensemble[0].eng['vsz'][30.],
+                         model.geo['vs'][0])
+        npt.assert_array_equal(self.ensemble[0].amp['kappa'],
+                               model.amp['kappa'])
+
+    def test_set_array(self):
+        """
+        Arrays are stored without copy also after growth
+        """
+
+        self.assertTrue(len(self.ensemble._lnum) > len(self.ensemble))
+
+        data = np.arange(24.).reshape(6, 4)
+        self.ensemble.set_array(('amp', 'test'), data)
+        self.assertTrue(np.shares_memory(
+            self.ensemble.get_array(('amp', 'test')), data))
+
+        self.ensemble[2].amp['test'][:] = -1.
+        npt.assert_array_equal(data[2], -1.)
+        rows = data.copy()
+
+        # Adding models moves the product to a larger array
+        model = self.ensemble.pop(0)
+        self.ensemble.insert(3, model)
+        self.ensemble.append(self.models[0])
+        self.assertEqual(len(self.ensemble), 7)
+        for nm, row in enumerate([1, 2, 3, 0, 4, 5]):
+            npt.assert_array_equal(self.ensemble[nm].amp['test'], rows[row])
+        self.assertFalse(np.shares_memory(
+            self.ensemble.get_array(('amp', 'test')), data))
+        self.assertEqual(len(self.ensemble.get_array(('amp', 'test'))), 6)
+
+    def test_vectorised(self):
+        """
+        Products computed on the ensemble arrays match single models
+        """
+
+        sites = []
+        for models in [list(self.models), self.ensemble]:
+            site = sitedb.Site1D()
+            site.frequency_axis(0.5, 20., 15)
+            site.model = models
+            site.traveltime_velocity([10., 50.])
+            site.traveltime_velocity([5., 30.])
+            site.compute_site_kappa(40.)
+            site.attenuation_decay()
+            site.quarter_wavelength_average()
+            sites.append(site)
+
+        self.assertEqual(sorted(sites[1].model[0].eng['vsz']), [5., 30.])
+
+        for mod, view in zip(sites[0].model, sites[1].model):
+            for z in [5., 30.]:
+                npt.assert_allclose(view.eng['vsz'][z], mod.eng['vsz'][z],
+                                    rtol=1e-12)
+            npt.assert_allclose(view.eng['kappa'], mod.eng['kappa'],
+                                rtol=1e-12)
+            npt.assert_allclose(view.amp['kappa'], mod.amp['kappa'],
+                                rtol=1e-12)
+            for key in ['z', 'vs', 'dn']:
+                npt.assert_allclose(view.eng['qwl'][key],
+                                    mod.eng['qwl'][key], rtol=1e-5)
+
+        for path in [('eng', 'vsz', 30.), ('eng', 'kappa'), ('amp', 'kappa')]:
+            npt.assert_allclose(sitedb._get_path(sites[1].mean, path),
+                                sitedb._get_path(sites[0].mean, path),
+                                rtol=1e-10)
+
+    def test_kappa(self):
+        """
+        Kappa at the default depth (half-space thickness is nan)
+        """
+
+        site = sitedb.Site1D()
+        site.model = self.ensemble
+        site.compute_site_kappa()
+        kappa = site.model.get_array(('eng', 'kappa'))
+        self.assertTrue(np.all(np.isfinite(kappa)))
+
+        for mod, value in zip(self.models, kappa):
+            hl, vs, qs = mod.geo['hl'], mod.geo['vs'], mod.geo['qs']
+            npt.assert_allclose(value, np.sum(hl[:-1]/(vs[:-1]*qs[:-1])),
+                                rtol=1e-12)
+
+    def test_site(self):
+        """
+        Site computations with the ensemble match list of models
+        """
+
+        site = sitedb.Site1D()
+        site.frequency_axis(0.5, 20., 20)
+        site.model = list(self.models)
+        site.traveltime_velocity(30.)
+        site.sh_transfer_function()
+
+        ens = sitedb.Site1D()
+        ens.frequency_axis(0.5, 20., 20)
+        ens.model = self.ensemble
+        ens.traveltime_velocity(30.)
+        ens.sh_transfer_function()
+
+        npt.assert_allclose(ens.mean.eng['vsz'][30.],
+                            site.mean.eng['vsz'][30.])
+        npt.assert_allclose(ens.mean.amp['shtf'], site.mean.amp['shtf'])
+        npt.assert_array_equal(ens.model.get_array(('amp', 'shtf')),
+                               [mod.amp['shtf'] for mod in site.model])
+
+    def test_surface_waves(self):
+        """
+        Dispersion curves and H/V ratio of the ensemble match
+        list of models
+        """
+
+        site = sitedb.Site1D()
+        site.frequency_axis(0.5, 20., 10)
+        site.model = list(self.models)
+        site.dispersion_curve('love', modes=2)
+        site.hv_ratio()
+
+        ens = sitedb.Site1D()
+        ens.frequency_axis(0.5, 20., 10)
+        ens.model = self.ensemble
+        ens.dispersion_curve('love', modes=2)
+        ens.hv_ratio()
+
+        self.assertEqual(site.model[0].amp['love'].shape, (2, 10))
+        npt.assert_allclose(ens.model.get_array(('amp', 'love')),
+                            [mod.amp['love'] for mod in site.model],
+                            rtol=1e-8)
+        npt.assert_allclose(ens.mean.amp['hv'], site.mean.amp['hv'],
+                            rtol=1e-6)
+
+    def test_qwl_references(self):
+        """
+        Quarter-wavelength amplification with the half-space of each
+        model as reference, and for a set of reference conditions
+        """
+
+        self.models[2].geo['vs'][-1] = 1500.
+        self.models[2].geo['dn'][-1] = 2400.
+
+        sites = []
+        for models in [list(self.models),
+                       sitedb.Ensemble.from_models(self.models)]:
+            site = sitedb.Site1D()
+            site.frequency_axis(0.5, 20., 10)
+            site.model = models
+            site.quarter_wavelength_average()
+            site.quarter_wavelength_amplification()
+            sites.append(site)
+
+        for mod in sites[0].model:
+            npt.assert_allclose(mod.amp['qwl'], impedance_amplification(
+                mod.eng['qwl']['vs'], mod.eng['qwl']['dn'],
+                mod.geo['vs'][-1], mod.geo['dn'][-1]), rtol=1e-12)
+
+        # Closed-form (ensemble) and searched (models) qwl depths
+        npt.assert_allclose(sites[1].model.get_array(('amp', 'qwl')),
+                            [mod.amp['qwl'] for mod in sites[0].model],
+                            rtol=1e-6)
+
+        # Same references for all the models (nan for the half-space)
+        vs_ref = [800., 1500., np.nan]
+        inc_ang = [0., 30., 10.]
+        amp = sites[1].quarter_wavelength_amplification_array(vs_ref, 2200.,
+                                                              inc_ang)
+        self.assertEqual(amp.shape, (3, 6, 10))
+
+        for nr in range(3):
+            sites[1].quarter_wavelength_amplification(vs_ref[nr], 2200.,
+                                                      inc_ang[nr])
+            npt.assert_allclose(amp[nr],
+                                [mod.amp['qwl'] for mod in sites[1].model],
+                                rtol=1e-12)
+
+        # Reference of each model
+        vs_ref = np.linspace(800., 1800., 12).reshape(2, 6)
+        amp = sites[0].quarter_wavelength_amplification_array(vs_ref)
+        self.assertEqual(amp.shape, (2, 6, 10))
+
+        for mod, ref, spec in zip(sites[0].model, vs_ref.T,
+                                  np.swapaxes(amp, 0, 1)):
+            for nr in range(2):
+                npt.assert_allclose(spec[nr], impedance_amplification(
+                    mod.eng['qwl']['vs'], mod.eng['qwl']['dn'], ref[nr],
+                    mod.geo['dn'][-1]), rtol=1e-12)
+
+
+# =============================================================================
+
+class SiteCollectionTestCase(unittest.TestCase):
+    """
+    Test the spatial queries and the batch processing
+    of a collection of sites
+    """
+
+    def setUp(self):
+
+        rnd = np.random.RandomState(3)
+        self.xy = rnd.uniform(0., 100., (500, 2))
+
+        self.collection = sitedb.SiteCollection()
+        for ns, (x, y) in enumerate(self.xy):
+            self.collection.add_site(sitedb.Site1D(ns, x, y, 0.))
+
+    def test_queries(self):
+        """
+        Queries compared to brute force search
+        """
+
+        dist = np.sqrt(np.sum((self.xy - [40., 60.])**2, axis=1))
+
+        d, i = self.collection.nearest(40., 60.)
+        self.assertEqual(i, np.argmin(dist))
+        self.assertAlmostEqual(d, np.min(dist))
+
+        index = self.collection.within_radius(40., 60., 10.)
+        npt.assert_array_equal(index, np.where(dist <= 10.)[0])
+
+        index = self.collection.within_bbox(20., 30., 50., 45.)
+        inside = ((self.xy[:, 0] >= 20.) & (self.xy[:, 0] <= 50.) &
+                  (self.xy[:, 1] >= 30.) & (self.xy[:, 1] <= 45.))
+        npt.assert_array_equal(index, np.where(inside)[0])
+
+    def test_run(self):
+        """
+        Batch processing and summary of the site parameters
+        """
+
+        rnd = np.random.RandomState(4)
+        for site in self.collection[:3]:
+            site.add_model(random_model(rnd))
+
+        self.collection.frequency_axis(0.5, 20., 50)
+        self.collection.run([('traveltime_velocity', {'depth': 30.}),
+                             'compute_soil_class',
+                             ('compute_site_kappa', {'depth': 50.}),
+                             'sh_transfer_function',
+                             'resonance_frequency'], index=[0, 1, 2])
+
+        summary = self.collection.summary()
+        self.assertEqual(len(summary['vs30']), 500)
+        self.assertTrue(np.isnan(summary['vs30'][3]))
+        self.assertEqual(summary['vs30'][1],
+                         self.collection[1].mean.eng['vsz'][30.][0])
+        self.assertEqual(summary['f0'][2],
+                         self.collection[2].mean.amp['fn'][0][0])
+        self.assertEqual(summary['class'][0],
+                         self.collection[0].mean.eng['class'])
+
+    def test_to_file(self):
+        """
+        Export of sites with string identifiers and missing parameters
+        """
+
+        import os
+        import shutil
+        import tempfile
+
+        collection = sitedb.SiteCollection()
+        collection.add_site(sitedb.Site1D('A1', 1.23456789, 2., 0.))
+        collection.add_site(sitedb.Site1D('B2', 3., 4., 5.))
+
+        collection[0].add_model(random_model(np.random.RandomState(5)))
+        collection[0].traveltime_velocity(30.)
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(tmp_dir, 'sites.csv')
+            collection.to_file(file_name)
+
+            with open(file_name) as f:
+                lines = [line.strip().split(',') for line in f]
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertEqual(lines[0], ['id', 'x', 'y', 'z', 'vs30', 'kappa',
+                                    'f0', 'class'])
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[1][0], 'A1')
+        self.assertEqual(lines[2][0], 'B2')
+        self.assertEqual(lines[1][-1], 'None')
+        self.assertEqual(float(lines[1][1]),
+                         round(1.23456789, sitedb.DECIMALS))
+        self.assertAlmostEqual(float(lines[1][4]),
+                               collection[0].mean.eng['vsz'][30.][0],
+                               places=sitedb.DECIMALS)
+        self.assertEqual(lines[2][4], 'nan')
+
+
+# =============================================================================
+
+class DiskEnsembleTestCase(unittest.TestCase):
+    """
+    Test the site products backed by memory-mapped files
+    """
+
+    def test_work_dir(self):
+
+        import shutil
+        import tempfile
+
+        rnd = np.random.RandomState(5)
+        models = [random_model(rnd) for _ in range(40)]
+
+        tmp = tempfile.mkdtemp()
+        try:
+            site = sitedb.Site1D(work_dir=tmp)
+            site.frequency_axis(0.5, 20., 30)
+            for mod in models:
+                site.add_model(mod)
+            site.sh_transfer_function()
+
+            memory = sitedb.Site1D()
+            memory.frequency_axis(0.5, 20., 30)
+            memory.model = list(models)
+            memory.sh_transfer_function()
+
+            data = site.model.get_array(('amp', 'shtf'))
+            self.assertIsInstance(data, np.memmap)
+            for value in site.model.geo.values():
+                self.assertIsInstance(value, np.memmap)
+            npt.assert_array_equal(site.model[7].amp['shtf'],
+                                   memory.model[7].amp['shtf'])
+
+            # Chunked statistics
+            stat = utils.RunningStat.from_data(data, True, chunk=7)
+            npt.assert_allclose(stat.stat(), memory.mean.amp['shtf'])
+            npt.assert_allclose(site.mean.amp['shtf'],
+                                memory.mean.amp['shtf'])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_partial(self):
+        """
+        Product available for part of the models (rows read in blocks)
+        """
+
+        import shutil
+        import tempfile
+
+        rnd = np.random.RandomState(6)
+        models = [random_model(rnd) for _ in range(20)]
+
+        tmp = tempfile.mkdtemp()
+        try:
+            site = sitedb.Site1D(work_dir=tmp)
+            site.frequency_axis(0.5, 20., 30)
+            for mod in models:
+                site.add_model(mod)
+            site.sh_transfer_function()
+            site.add_model(random_model(rnd), 5)
+
+            data = site.model.get_array(('amp', 'shtf'))
+            self.assertNotIsInstance(data, np.ndarray)
+            self.assertEqual(data.shape, (20, 30))
+
+            expected = np.array([mod.amp['shtf'] for mod in site.model
+                                 if len(mod.amp['shtf'])])
+            npt.assert_array_equal(data[6:13], expected[6:13])
+            npt.assert_array_equal(np.asarray(data), expected)
+
+            site._update_stat(('amp', 'shtf'))
+            npt.assert_allclose(site.mean.amp['shtf'],
+                                utils.log_stat(expected), rtol=1e-10)
+        finally:
+            shutil.rmtree(tmp)
+
+
+# =============================================================================
+
+class WeightedSiteTestCase(unittest.TestCase):
+    """
+    Test the site statistics with logic-tree weights
+    """
+
+    def test_weights(self):
+
+        rnd = np.random.RandomState(11)
+        models = [random_model(rnd) for _ in range(5)]
+        count = [1, 3, 2, 1, 2]
+
+        site = sitedb.Site1D()
+        site.frequency_axis(0.5, 20., 30)
+        site.model = sitedb.Ensemble.from_models(models)
+        site.traveltime_velocity(30.)
+        site.sh_transfer_function()
+        site.set_weights(count)
+
+        full = sitedb.Site1D()
+        full.frequency_axis(0.5, 20., 30)
+        for mod, n in zip(models, count):
+            for _ in range(n):
+                full.add_model(mod)
+        full.traveltime_velocity(30.)
+        full.sh_transfer_function()
+
+        npt.assert_allclose(site.mean.eng['vsz'][30.],
+                            full.mean.eng['vsz'][30.], atol=1e-6)
+        npt.assert_allclose(site.mean.amp['shtf'],
+                            full.mean.amp['shtf'], rtol=1e-10)
+
+        # Incremental update with weighted model
+        mod = random_model(rnd)
+        mod.eng['weight'] = 2.
+        site.add_model(mod)
+        full.add_model(mod)
+        full.add_model(mod)
+        npt.assert_allclose(site.mean.amp['shtf'],
+                            full.mean.amp['shtf'], rtol=1e-10)
+
+        # Public access to weights and products
+        npt.assert_allclose(site.model_weights(), count + [2.])
+        data, weights = site.get_product(('amp', 'shtf'), True)
+        self.assertEqual(len(data), 5)
+        npt.assert_allclose(weights, count)
+        npt.assert_allclose(site.get_product(['eng', 'vsz', 30.])[0],
+                            site.model[0].eng['vsz'][30.])
+
+    def test_pickle(self):
+        """
+        The cached SH-wave propagator is not pickled
+        """
+
+        rnd = np.random.RandomState(5)
+        site = sitedb.Site1D()
+        site.frequency_axis(0.5, 20., 30)
+        for _ in range(4):
+            site.add_model(random_model(rnd))
+        site.sh_transfer_function()
+        self.assertTrue(site._shprop is not None)
+
+        copy = pickle.loads(pickle.dumps(site, 2))
+        self.assertTrue(copy._shprop is None)
+        self.assertTrue(site._shprop is not None)
+        npt.assert_allclose(copy.mean.amp['shtf'], site.mean.amp['shtf'])
+
+        copy.sh_transfer_function()
+        npt.assert_allclose(copy.mean.amp['shtf'], site.mean.amp['shtf'])
+
+    def test_stream_sketch(self):
+        """
+        Percentiles of all the streamed models from quantile sketches
+        """
+
+        rnd = np.random.RandomState(2)
+        models = [random_model(rnd) for _ in range(40)]
+
+        stream = sitedb.Site1D(sketch=0.01)
+        stream.frequency_axis(0.5, 20., 30)
+        stream.stream_models(iter(models), ['sh_transfer_function'],
+                             chunk=9, perc=[5., 95.])
+
+        site = sitedb.Site1D()
+        site.frequency_axis(0.5, 20., 30)
+        site.model = list(models)
+        site.sh_transfer_function()
+
+        data = np.sort([mod.amp['shtf'] for mod in site.model], axis=0)
+        for p in [5., 95.]:
+            exact = data[int(np.ceil(p/100.*len(data))) - 1]
+            npt.assert_allclose(stream.percentiles.amp['shtf'][p],
+                                exact, rtol=0.01)
@@ -23,6 +23,7 @@
 
 import unittest
 import numpy as np
+import numpy.testing as npt
 
 from openquake.srtk import soil
 
@@ -244,3 +245,110 @@ class QuarterWavelengthTestCase(unittest.TestCase):
                                 np.array([0.1, 0.5, 1., 10., 100.]),
                                 expected_result,
                                 tolerance=0.00001)
+
+    def test_jacobian(self):
+        """
+        Closed-form averages and derivatives (finite differences)
+        """
+
+        geo = {'hl': np.array([10., 50., 0.]),
+               'vs': np.array([100., 500., 1000.]),
+               'dn': np.array([1900., 2000., 2100.])}
+        freq = np.array([0.1, 0.5, 1., 10., 100.])
+
+        result = soil.quarter_wavelength_jacobian(geo['hl'], geo['vs'],
+                                                  geo['dn'], freq)
+        expected = soil.quarter_wavelength_average(geo['hl'], geo['vs'],
+                                                   geo['dn'], freq)
+
+        for nr in range(3):
+            npt.assert_allclose(result[nr], expected[nr], rtol=1e-5)
+
+        for key in ['hl', 'vs', 'dn']:
+            for nl in range(2):
+                delta = 1e-6*geo[key][nl]
+                upper = dict(geo)
+                upper[key] = geo[key].copy()
+                upper[key][nl] += delta
+                lower = dict(geo)
+                lower[key] = geo[key].copy()
+                lower[key][nl] -= delta
+
+                diff = [(u - l)/(2.*delta) for u, l in zip(
+                    soil.quarter_wavelength_jacobian(upper['hl'], upper['vs'],
+                                                     upper['dn'], freq)[:3],
+                    soil.quarter_wavelength_jacobian(lower['hl'], lower['vs'],
+                                                     lower['dn'], freq)[:3])]
+
+                for nr, par in enumerate(['z', 'vs', 'dn']):
+                    npt.assert_allclose(result[3][par][key][:, nl],
+                                        diff[nr], rtol=1e-5, atol=1e-8)
+
+
+# =============================================================================
+
+class VectorisedAverageTestCase(unittest.TestCase):
+    """
+    Test the vectorised averages on sets of profiles against
+    the single-profile functions
+    """
+
+    def setUp(self):
+
+        rnd = np.random.RandomState(0)
+
+        self.hl = rnd.uniform(2., 20., (50, 6))
+        self.vs = np.sort(rnd.uniform(100., 1500., (50, 6)), axis=1)
+        self.qs = rnd.uniform(5., 50., (50, 6))
+
+        # Profiles with variable number of layers (nan padded)
+        self.lnum = rnd.randint(1, 7, 50)
+        for nm, ln in enumerate(self.lnum):
+            self.hl[nm, ln-1] = np.nan
+            self.hl[nm, ln:] = np.nan
+            self.vs[nm, ln:] = np.nan
+            self.qs[nm, ln:] = np.nan
+
+    def test_traveltime_velocity(self):
+
+        vsz = soil.traveltime_velocity_array(self.hl, self.vs, 30.)
+
+        for nm, ln in enumerate(self.lnum):
+            expected = soil.traveltime_velocity(self.hl[nm, :ln],
+                                                self.vs[nm, :ln], 30.)
+            self.assertAlmostEqual(vsz[nm], expected, delta=1e-8)
+
+    def test_site_kappa(self):
+
+        for depth in [[], 25.]:
+            kappa = soil.compute_site_kappa_array(self.hl, self.vs,
+                                                  self.qs, depth)
+
+            for nm, ln in enumerate(self.lnum):
+                if ln == 1 and not depth:
+                    continue
+                expected = soil.compute_site_kappa(self.hl[nm, :ln],
+                                                   self.vs[nm, :ln],
+                                                   self.qs[nm, :ln],
+                                                   depth)
+                self.assertAlmostEqual(kappa[nm], expected, delta=1e-10)
+
+    def test_depth_to_velocity(self):
+
+        self.assertEqual(soil.depth_to_velocity(np.array([10., 20., 0.]),
+                                                np.array([200., 1000.,
+                                                          2000.]),
+                                                1000.), 10.)
+        self.assertTrue(np.isnan(
+            soil.depth_to_velocity(np.array([10., 0.]),
+                                   np.array([200., 800.]), 1000.)))
+
+        depth = soil.depth_to_velocity(self.hl, self.vs, 800.)
+
+        for nm, ln in enumerate(self.lnum):
+            above = np.where(self.vs[nm, :ln] >= 800.)[0]
+            if len(above):
+                expected = np.sum(self.hl[nm, :above[0]])
+                self.assertAlmostEqual(depth[nm], expected)
+            else:
+                self.assertTrue(np.isnan(depth[nm]))
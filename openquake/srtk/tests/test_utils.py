@@ -0,0 +1,204 @@
+# =============================================================================
+#
+# Copyright (C) 2010-2017 GEM Foundation
+#
+# This file is part of the OpenQuake's Site Response Toolkit (OQ-SRTK)
+#
+# OQ-SRTK is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# OQ-SRTK is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# with this download. If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Valerio Poggi
+#
+# =============================================================================
+
+
+import unittest
+import numpy as np
+import numpy.testing as npt
+
+from openquake.srtk import utils
+
+
+# =============================================================================
+
+class RunningStatTestCase(unittest.TestCase):
+    """
+    Test for the running (incremental) statistic accumulator
+    """
+
+    def setUp(self):
+
+        rnd = np.random.RandomState(42)
+        self.data = np.exp(rnd.normal(5., 0.3, (50, 20)))
+
+    def check_stat(self, stat, data, log):
+
+        if log:
+            mn, sd = utils.log_stat(data)
+        else:
+            mn, sd = utils.lin_stat(data)
+
+        npt.assert_allclose(stat.stat()[0], mn, rtol=1e-10)
+        npt.assert_allclose(stat.stat()[1], sd, rtol=1e-10)
+
+    def test_add(self):
+        """
+        Adding samples one at the time
+        """
+
+        for log in [False, True]:
+            stat = utils.RunningStat(log)
+            for d in self.data:
+                stat.add(d)
+            self.check_stat(stat, self.data, log)
+
+    def test_remove(self):
+        """
+        Removing samples from a full accumulator
+        """
+
+        for log in [False, True]:
+            stat = utils.RunningStat.from_data(self.data, log)
+            for d in self.data[:10]:
+                stat.remove(d)
+            self.check_stat(stat, self.data[10:], log)
+
+    def test_merge(self):
+        """
+        Merging two partial accumulators
+        """
+
+        stat = utils.RunningStat.from_data(self.data[:15], True)
+        stat.merge(utils.RunningStat.from_data(self.data[15:], True))
+        self.check_stat(stat, self.data, True)
+
+    def test_complex(self):
+        """
+        Normal statistic on complex data
+        """
+
+        data = self.data*np.exp(1j*self.data)
+        stat = utils.RunningStat.from_data(data[:-1])
+        stat.add(data[-1])
+        self.check_stat(stat, data, False)
+
+
+# =============================================================================
+
+class WeightedStatTestCase(unittest.TestCase):
+    """
+    Test the weighted (logic-tree) statistics
+    """
+
+    def setUp(self):
+
+        rnd = np.random.RandomState(7)
+        self.data = np.exp(rnd.normal(5., 0.3, (12, 20)))
+        self.count = rnd.randint(1, 4, 12)
+
+    def test_repeated(self):
+        """
+        Integer weights are equivalent to repeated samples
+        """
+
+        full = np.repeat(self.data, self.count, axis=0)
+        weights = self.count/3.
+
+        for log in [False, True]:
+            func = utils.log_stat if log else utils.lin_stat
+            npt.assert_allclose(func(self.data, weights), func(full),
+                                rtol=1e-10)
+
+            stat = utils.RunningStat(log)
+            for d, w in zip(self.data, weights):
+                stat.add(d, w)
+            stat.remove(self.data[0], weights[0])
+            npt.assert_allclose(stat.stat(), func(full[self.count[0]:]),
+                                rtol=1e-10)
+
+    def test_percentile(self):
+        """
+        Weighted percentiles
+        """
+
+        npt.assert_allclose(utils.weighted_percentile(self.data, [16., 84.],
+                                                      np.ones(12)),
+                            np.percentile(self.data, [16., 84.], axis=0))
+
+        value = utils.weighted_percentile([3., 1., 2.], [50.], [2., 1., 1.])
+        npt.assert_allclose(value, [2.+1./3.])
+
+        # Multi-dimensional data, as columns
+        rnd = np.random.RandomState(3)
+        data = rnd.uniform(size=(7, 4, 3))
+        weights = rnd.uniform(0.5, 2., 7)
+        value = utils.weighted_percentile(data, [10., 50., 90.], weights)
+        self.assertEqual(value.shape, (3, 4, 3))
+        for i in range(4):
+            for j in range(3):
+                npt.assert_allclose(value[:, i, j], utils.weighted_percentile(
+                    data[:, i, j], [10., 50., 90.], weights), rtol=1e-12)
+
+
+# =============================================================================
+
+class QuantileSketchTestCase(unittest.TestCase):
+    """
+    Test the mergeable quantile sketch
+    """
+
+    def test_accuracy(self):
+
+        rnd = np.random.RandomState(3)
+        data = rnd.normal(0., 2., (2001, 10))
+        perc = [1., 5., 50., 95., 99.]
+
+        sketch = utils.QuantileSketch.from_data(data[:900], 0.02, chunk=100)
+        sketch.merge(utils.QuantileSketch.from_data(data[900:], 0.02))
+        sketch.add(data[0])
+        sketch.remove(data[0])
+
+        # Reference: samples of rank q*n
+        data = np.sort(data, axis=0)
+        for p, value in zip(perc, sketch.quantile(perc)):
+            exact = data[int(np.ceil(p/100.*len(data))) - 1]
+            self.assertTrue(np.all(np.abs(value - exact) <=
+                                   0.02*np.abs(exact) + 1e-12))
+
+
+# =============================================================================
+
+class PrecisionTestCase(unittest.TestCase):
+    """
+    Test the output precision policy
+    """
+
+    def test_set_precision(self):
+
+        data = np.array([1.23456789, 2.5e-7])
+        value = {'a': data, 'b': [(0.123456, 1j/3.)], 'c': 'text'}
+
+        value = utils.set_precision(value, 3)
+        npt.assert_array_equal(value['a'], [1.235, 0.])
+        npt.assert_array_equal(value['b'][0], [0.123, 0.333j])
+        self.assertEqual(value['c'], 'text')
+
+        # Input is not modified
+        self.assertEqual(data[0], 1.23456789)
+
+        # Non-float arrays are unchanged
+        ids = np.array(['A1', 2, None], dtype='object')
+        self.assertIs(utils.set_precision(ids, 3), ids)
+
+        utils.a_round(data, 2)
+        npt.assert_array_equal(data, [1.23, 0.])
@@ -24,6 +24,7 @@
 Collection of utilities for the SRTK
 """
 
+import itertools as _it
 import numpy as _np
 
 
@@ -44,7 +45,12 @@ def a_round(number, decimals=3):
         Rounded output
     """
 
-    if isinstance(number, (list, tuple, _np.ndarray)):
+    if isinstance(number, _np.ndarray):
+        if number.dtype.kind in 'fc':
+            _np.round(number, decimals, out=number)
+        else:
+            number = _np.round(number, decimals)
+    elif isinstance(number, (list, tuple)):
         for i, n in enumerate(number):
             number[i] = round(n, decimals)
     else:
@@ -53,9 +59,45 @@ def a_round(number, decimals=3):
     return number
 
 
+def set_precision(value, decimals=None):
+    """
+    Output precision policy: return a rounded copy of a value,
+    which can be a scalar, an array or a (nested) container of
+    those (e.g. model dictionaries). Rounding is vectorised;
+    non-float arrays and other values are returned unchanged.
+
+    :param [float, list, tuple, dict, numpy.ndarray] value:
+        Input value
+
+    :param int decimals:
+        Rounding decimals (None to return the value unchanged)
+
+    :return [float, list, tuple, dict, numpy.ndarray] value:
+        Rounded output
+    """
+
+    if decimals is None:
+        return value
+
+    if isinstance(value, dict):
+        return {k: set_precision(v, decimals) for k, v in value.items()}
+
+    if isinstance(value, (list, tuple)):
+        return type(value)(set_precision(v, decimals) for v in value)
+
+    # Non-float arrays (e.g. of identifiers) are left unchanged
+    if isinstance(value, _np.ndarray) and value.dtype.kind not in 'fc':
+        return value
+
+    if isinstance(value, (_np.ndarray, _np.number, float, complex)):
+        return _np.round(value, decimals)
+
+    return value
+
+
 # =============================================================================
 
-def lin_stat(data):
+def lin_stat(data, weights=None):
     """
     Compute mean and standard deviation of data array
     assuming normal (linear) statistic.
@@ -63,19 +105,23 @@ def lin_stat(data):
     :param list or numpy.ndarray data:
         The input dataset
 
+    :param list or numpy.ndarray weights:
+        weights of the samples along the first axis
+        (optional, default is equal weights)
+
     :return float (mn, sd):
         Mean and standard deviation
     """
 
-    mn = _np.mean(data, axis=0)
-    sd = _np.std(data, axis=0)
+    data = _np.asarray(data)
+    weight, mn, m2 = _moments(data.astype(_np.result_type(data, 0.)), weights)
 
-    return (mn, sd)
+    return (mn, _np.sqrt(m2/weight))
 
 
 # =============================================================================
 
-def log_stat(data):
+def log_stat(data, weights=None):
     """
     Compute mean and standard deviation of data array
     assuming log-normal statistic.
@@ -83,15 +129,541 @@ def log_stat(data):
     :param list or numpy.ndarray data:
         The input dataset
 
+    :param list or numpy.ndarray weights:
+        weights of the samples along the first axis
+        (optional, default is equal weights)
+
     :return float (mn, sd):
         Mean and standard deviation
 
     """
 
-    mn = _np.exp(_np.mean(_np.log(data), axis=0))
-    sd = _np.exp(_np.std(_np.log(data), axis=0))
+    weight, mn, m2 = _moments(_np.log(data), weights)
+
+    return (_np.exp(mn), _np.exp(_np.sqrt(m2/weight)))
+
+
+def _moments(x, weights=None):
+    """
+    Internal: fused (single pass) weighted moments along the first
+    axis. Data are shifted by the first sample to limit cancellation,
+    and accumulated as matrix-vector products. The input array
+    is overwritten.
+
+    :return (weight, mn, m2):
+        total weight, mean and sum of weighted squared residuals
+    """
+
+    if weights is None:
+        weights = _np.ones(len(x))
+    weights = _np.asarray(weights, dtype='float64')
+
+    weight = _np.sum(weights)
+
+    shift = x[0].copy()
+    x -= shift
+
+    mn = _np.tensordot(weights, x, axes=1)/weight
+
+    if _np.iscomplexobj(x):
+        x = _np.real(x*_np.conj(x))
+    else:
+        _np.multiply(x, x, out=x)
+
+    m2 = _np.tensordot(weights, x, axes=1) - weight*_np.real(mn*_np.conj(mn))
+
+    return (weight, shift + mn, _np.maximum(m2, 0.))
+
+
+# =============================================================================
+
+def weighted_percentile(data, perc, weights=None):
+    """
+    Compute percentiles of data array along the first axis,
+    with samples of different weight (e.g. logic-tree branches).
+    The weighted empirical distribution is linearly interpolated
+    between the centres of the sample weights. For equal weights,
+    the exact (numpy) percentiles are returned.
+
+    :param list or numpy.ndarray data:
+        The input dataset
+
+    :param list perc:
+        list of percentiles (0-100)
+
+    :param list or numpy.ndarray weights:
+        weights of the samples along the first axis
+        (optional, default is equal weights)
+
+    :return numpy.ndarray values:
+        percentiles (perc x ...)
+    """
+
+    data = _np.asarray(data)
+
+    if weights is None or _np.all(_np.equal(weights, weights[0])):
+        return _np.percentile(data, perc, axis=0)
+
+    weights = _np.asarray(weights, dtype='float64')
+
+    # Sorting along the first axis (weights follow the data)
+    # (explicit index arrays, for compatibility with older numpy)
+    order = _np.argsort(data, axis=0)
+    grid = tuple(_np.indices(data.shape[1:]))
+    data = data[(order,) + tuple(_np.indices(data.shape)[1:])]
+    wgt = weights[order]
+
+    # Cumulative weight at the centre of each sample
+    cum = _np.cumsum(wgt, axis=0)
+    cum -= 0.5*wgt
+    cum /= cum[-1] + 0.5*wgt[-1]
+
+    values = []
+    for p in _np.atleast_1d(perc):
+        q = p/100.
+        # Upper bracketing sample (last one if beyond)
+        i1 = _np.minimum(_np.sum(cum < q, axis=0), len(data) - 1)
+        i0 = _np.maximum(i1 - 1, 0)
+        c0, c1 = cum[(i0,) + grid], cum[(i1,) + grid]
+        v0, v1 = data[(i0,) + grid], data[(i1,) + grid]
+        dc = _np.where(c1 > c0, c1 - c0, 1.)
+        a = _np.clip((q - c0)/dc, 0., 1.)
+        values.append(v0 + a*(v1 - v0))
+
+    return _np.array(values)
+
+
+# =============================================================================
+
+class RunningStat(object):
+    """
+    Running accumulator of mean and standard deviation, based on
+    the Welford's algorithm (weighted form of West, 1979). Data can
+    be added and removed one at the time (at constant cost) or merged
+    from another accumulator. For log-normal statistic, data are
+    accumulated in log space. Complex data are allowed for normal
+    statistic only.
+
+    :param boolean log:
+        switch between normal (linear) or log-normal statistic
+        (default is normal)
+    """
+
+    def __init__(self, log=False):
+
+        self.log = log
+        self.count = 0
+        self.weight = 0.
+        self._mn = 0.
+        self._m2 = 0.
+
+    # -------------------------------------------------------------------------
+
+    @classmethod
+    def from_data(cls, data, log=False, chunk=None, weights=None):
+        """
+        Initialise the accumulator from a full dataset
+        (vectorised along the first axis).
+
+        :param list or numpy.ndarray data:
+            The input dataset
+
+        :param boolean log:
+            switch between normal (linear) or log-normal statistic
+
+        :param int chunk:
+            if given, data are processed in blocks of this size
+            and merged (e.g. for memory-mapped arrays)
+
+        :param list or numpy.ndarray weights:
+            weights of the samples (optional, default is equal weights)
+
+        :return RunningStat stat:
+            The initialised accumulator
+        """
+
+        stat = cls(log)
+
+        if weights is not None:
+            weights = _np.asarray(weights, dtype='float64')
+
+        if chunk and len(data) > chunk:
+            for i0 in range(0, len(data), chunk):
+                wgt = None if weights is None else weights[i0:i0 + chunk]
+                stat.merge(cls.from_data(data[i0:i0 + chunk], log,
+                                         weights=wgt))
+
+        elif len(data):
+            x = stat._transform(data)
+            if not log:
+                x = x.astype(_np.result_type(x, 0.))
+            stat.count = x.shape[0]
+            stat.weight, stat._mn, stat._m2 = _moments(x, weights)
+
+        return stat
+
+    def _transform(self, value):
+        """
+        Internal: move data to the statistic space
+        """
+
+        value = _np.asarray(value)
+
+        return _np.log(value) if self.log else value
+
+    # -------------------------------------------------------------------------
+
+    def add(self, value, weight=1.):
+        """
+        Add a single sample to the statistic.
+
+        :param float or numpy.ndarray value:
+            The sample to be added
+
+        :param float weight:
+            The sample weight (default is 1)
+        """
+
+        x = self._transform(value)
+
+        self.count += 1
+        self.weight += weight
+        delta = x - self._mn
+        self._mn = self._mn + delta*weight/self.weight
+        self._m2 = self._m2 + weight*_np.real(delta*_np.conj(x - self._mn))
+
+    def remove(self, value, weight=1.):
+        """
+        Remove a single (previously added) sample from the statistic.
+
+        :param float or numpy.ndarray value:
+            The sample to be removed
+
+        :param float weight:
+            The sample weight, as when added (default is 1)
+        """
+
+        if self.count <= 1 or self.weight <= weight:
+            count = self.count - 1
+            self.__init__(self.log)
+            self.count = max(count, 0)
+            return
+
+        x = self._transform(value)
+
+        total = self.weight - weight
+        mn = (self.weight*self._mn - weight*x)/total
+        m2 = self._m2 - weight*_np.real((x - mn)*_np.conj(x - self._mn))
+
+        self.count -= 1
+        self.weight = total
+        self._mn = mn
+        self._m2 = _np.maximum(m2, 0.)
+
+    def merge(self, other):
+        """
+        Merge the statistic of another accumulator
+        (Chan et al. parallel algorithm).
+
+        :param RunningStat other:
+            The accumulator to be merged
+        """
+
+        if not other.count:
+            return
+
+        if not self.count:
+            self.count = other.count
+            self.weight = other.weight
+            self._mn = other._mn
+            self._m2 = other._m2
+            return
+
+        weight = self.weight + other.weight
+        delta = other._mn - self._mn
+
+        self._mn = self._mn + delta*other.weight/weight
+        self._m2 = (self._m2 + other._m2 +
+                    _np.real(delta*_np.conj(delta)) *
+                    self.weight*other.weight/weight)
+        self.count += other.count
+        self.weight = weight
+
+    # -------------------------------------------------------------------------
+
+    def stat(self):
+        """
+        Return the current mean and standard deviation, with the
+        same convention of lin_stat and log_stat.
+
+        :return float or numpy.ndarray (mn, sd):
+            Mean and standard deviation
+        """
+
+        if not self.count or not self.weight:
+            return (_np.nan, _np.nan)
+
+        mn = self._mn
+        sd = _np.sqrt(self._m2/self.weight)
+
+        if self.log:
+            mn = _np.exp(mn)
+            sd = _np.exp(sd)
+
+        return (mn, sd)
+
+
+# =============================================================================
+
+class QuantileSketch(object):
+    """
+    Mergeable quantile sketch with relative accuracy guarantee
+    (DDSketch, Masson et al., 2019), vectorised over the elements
+    of an array-valued quantity (e.g. one sketch per frequency).
+
+    Samples are counted in logarithmically spaced bins, so that any
+    estimated quantile x' satisfies |x' - x| <= alpha*|x|, where x is
+    the sample of (weighted) rank q*W in the accumulated data. Values
+    smaller than MIN_VALUE (in absolute sense) are counted as zeros.
+    Memory grows with the logarithmic range of the data only, and
+    sketches can be merged (e.g. across chunks or worker processes)
+    and samples removed without loss of accuracy.
+
+    :param float alpha:
+        relative accuracy of the quantiles (default is 1%)
+    """
+
+    MIN_VALUE = 1e-12
+
+    def __init__(self, alpha=0.01):
+
+        self.alpha = alpha
+        self.gamma = (1. + alpha)/(1. - alpha)
+        self.count = 0
+        self.weight = 0.
+        self.shape = None
+        self._lg = _np.log(self.gamma)
+        self._zero = None
+        self._bins = {1: None, -1: None}
+        self._key = {1: 0, -1: 0}
+
+    # -------------------------------------------------------------------------
+
+    @classmethod
+    def from_data(cls, data, alpha=0.01, weights=None, chunk=None):
+        """
+        Initialise the sketch from a full dataset
+        (samples along the first axis).
+
+        :param list or numpy.ndarray data:
+            The input dataset
+
+        :param float alpha:
+            relative accuracy of the quantiles
+
+        :param list or numpy.ndarray weights:
+            weights of the samples (optional, default is equal weights)
+
+        :param int chunk:
+            if given, data are processed in blocks of this size
+
+        :return QuantileSketch sketch:
+            The initialised sketch
+        """
+
+        sketch = cls(alpha)
+
+        if weights is not None:
+            weights = _np.asarray(weights, dtype='float64')
+
+        chunk = chunk or max(len(data), 1)
+
+        for i0 in range(0, len(data), chunk):
+            wgt = None if weights is None else weights[i0:i0 + chunk]
+            sketch.update(data[i0:i0 + chunk], wgt)
+
+        return sketch
+
+    # -------------------------------------------------------------------------
+
+    def update(self, data, weights=None):
+        """
+        Add a set of samples to the sketch (vectorised).
+
+        :param list or numpy.ndarray data:
+            The samples to be added (along the first axis)
+
+        :param list or numpy.ndarray weights:
+            weights of the samples (optional, default is equal weights)
+        """
+
+        self._count(data, weights, 1.)
+
+    def _count(self, data, weights, sign):
+        """
+        Internal: add (sign=1) or remove (sign=-1) samples
+        """
+
+        x = _np.asarray(data, dtype='float64')
+        if not len(x):
+            return
+
+        if weights is None:
+            weights = _np.ones(len(x))
+        weights = sign*_np.asarray(weights, dtype='float64')
+
+        if self.shape is None:
+            self.shape = x.shape[1:]
+            self._zero = _np.zeros(int(_np.prod(self.shape)))
+
+        x = x.reshape(len(x), -1)
+        size = x.shape[1]
+        w = _np.repeat(weights, size).reshape(x.shape)
+        elem = _np.tile(_np.arange(size), len(x)).reshape(x.shape)
+
+        for side in [1, -1]:
+            sel = side*x > self.MIN_VALUE
+            if not _np.any(sel):
+                continue
+
+            keys = _np.ceil(_np.log(side*x[sel])/self._lg).astype(int)
+            self._extend(side, keys.min(), keys.max())
 
-    return (mn, sd)
+            bins = self._bins[side]
+            index = elem[sel]*bins.shape[1] + keys - self._key[side]
+            bins += _np.bincount(index, w[sel], bins.size).reshape(bins.shape)
+
+        sel = _np.abs(x) <= self.MIN_VALUE
+        if _np.any(sel):
+            self._zero += _np.bincount(elem[sel], w[sel], size)
+
+        self.count += int(sign)*len(x)
+        self.weight += _np.sum(weights)
+
+    def add(self, value, weight=1.):
+        """
+        Add a single sample to the sketch.
+
+        :param float or numpy.ndarray value:
+            The sample to be added
+
+        :param float weight:
+            The sample weight (default is 1)
+        """
+
+        self.update([value], [weight])
+
+    def remove(self, value, weight=1.):
+        """
+        Remove a single (previously added) sample from the sketch.
+
+        :param float or numpy.ndarray value:
+            The sample to be removed
+
+        :param float weight:
+            The sample weight, as when added (default is 1)
+        """
+
+        self._count([value], [weight], -1.)
+
+    def merge(self, other):
+        """
+        Merge the samples of another sketch (same accuracy).
+
+        :param QuantileSketch other:
+            The sketch to be merged
+        """
+
+        if other.alpha != self.alpha:
+            raise ValueError('Sketches of different accuracy')
+
+        if not other.count:
+            return
+
+        if self.shape is None:
+            self.shape = other.shape
+            self._zero = _np.zeros_like(other._zero)
+
+        for side in [1, -1]:
+            bins = other._bins[side]
+            if bins is None:
+                continue
+            k0 = other._key[side]
+            self._extend(side, k0, k0 + bins.shape[1] - 1)
+            i0 = k0 - self._key[side]
+            self._bins[side][:, i0:i0 + bins.shape[1]] += bins
+
+        self._zero += other._zero
+        self.count += other.count
+        self.weight += other.weight
+
+    def _extend(self, side, kmin, kmax):
+        """
+        Internal: enlarge the bin range of one side of the sketch
+        """
+
+        bins = self._bins[side]
+
+        if bins is None:
+            self._bins[side] = _np.zeros((self._zero.size, kmax - kmin + 1))
+            self._key[side] = kmin
+            return
+
+        k0 = self._key[side]
+        k1 = k0 + bins.shape[1] - 1
+
+        if kmin < k0 or kmax > k1:
+            lo = max(k0 - kmin, 0)
+            hi = max(kmax - k1, 0)
+            self._bins[side] = _np.pad(bins, ((0, 0), (lo, hi)), 'constant')
+            self._key[side] = k0 - lo
+
+    # -------------------------------------------------------------------------
+
+    def quantile(self, perc):
+        """
+        Estimate percentiles of the accumulated samples.
+
+        :param list perc:
+            list of percentiles (0-100)
+
+        :return numpy.ndarray values:
+            percentiles (perc x ...)
+        """
+
+        perc = _np.atleast_1d(perc)
+
+        if not self.count:
+            return _np.full((len(perc),) + (self.shape or ()), _np.nan)
+
+        counts = [self._zero[:, None]]
+        values = [_np.zeros(1)]
+
+        for side in [1, -1]:
+            bins = self._bins[side]
+            if bins is None:
+                continue
+            keys = self._key[side] + _np.arange(bins.shape[1])
+            value = side*2.*self.gamma**keys/(self.gamma + 1.)
+            if side > 0:
+                counts.append(bins)
+                values.append(value)
+            else:
+                counts.insert(0, bins[:, ::-1])
+                values.insert(0, value[::-1])
+
+        cum = _np.cumsum(_np.hstack(counts), axis=1)
+        values = _np.concatenate(values)
+        total = cum[:, -1]
+
+        result = []
+        for p in perc:
+            rank = _np.maximum(p/100.*total, 1e-12*total)
+            index = _np.sum(cum < rank[:, None]*(1. - 1e-12), axis=1)
+            index = _np.minimum(index, len(values) - 1)
+            result.append(values[index].reshape(self.shape))
+
+        return _np.array(result)
 
 
 # =============================================================================
@@ -120,6 +692,32 @@ def slice(data, index=[]):
     return data_slice
 
 
+# =============================================================================
+
+def chunk_iter(data, size):
+    """
+    Split an arbitrary iterable (e.g. a generator) into consecutive
+    lists of given size, without consuming it in advance.
+
+    :param iterable data:
+        Input data to be chunked
+
+    :param int size:
+        Maximum number of items per chunk
+
+    :return generator chunks:
+        Generator of lists with the chunked data
+    """
+
+    data = iter(data)
+
+    while True:
+        chunk = list(_it.islice(data, int(size)))
+        if not chunk:
+            break
+        yield chunk
+
+
 # =============================================================================
 
 def is_empty(value):